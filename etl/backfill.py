@@ -0,0 +1,587 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, NamedTuple
+
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+import instrumentation
+from checkpoint import file_fingerprint, make_key
+from helpers import fix_missing_records, read_data
+from etl import (
+    WINDOWS,
+    AGGREGATIONS,
+    OTHER_CODE,
+    Aggregation,
+    Window,
+    add_datetime_dimension_to_df,
+    compute_connectivity_features,
+    compute_features,
+    get_top_k,
+    sketch_aggregations,
+)
+from pipeline import (
+    POLLING_COLUMNS,
+    get_lookback_lookahead,
+    join_polling_orders,
+    prepare_connectivity,
+    prepare_orders,
+    prepare_polling,
+)
+from writers import (
+    DEFAULT_OUTPUT,
+    FORMATS,
+    OutputConfig,
+    output_path,
+    require_pyarrow,
+    select_input_dump,
+    write_frame,
+)
+
+DEFAULT_BACKFILL_DIR = ".etl_backfill"
+MANIFEST_NAME = "manifest.json"
+INPUT_FILES = ["orders.csv", "polling.csv", "connectivity_status.csv"]
+# the columns kept by the split
+SPLIT_COLUMNS = {
+    "polling.csv": POLLING_COLUMNS,
+    "connectivity_status.csv": ["device_id", "creation_time", "status"],
+}
+# the split files of a day: its own rows after the rows other days hand over
+SLICE_FILES = {
+    "polling.csv": ["polling_lookback.csv", "polling.csv", "polling_lookahead.csv"],
+    "connectivity_status.csv": [
+        "connectivity_carry.csv",
+        "connectivity_lookback.csv",
+        "connectivity_status.csv",
+        "connectivity_lookahead.csv",
+    ],
+}
+
+
+class BackfillConfig(NamedTuple):
+    """How a backfill runs
+
+    directory: where the day partitions, their outputs and the manifest go
+    workers: the processes running day partitions, one per cpu when None
+    chunksize: rows of polling and connectivity read at a time by the split
+    join: "interval" or "hour", see `pipeline.join_polling_orders`
+    """
+
+    directory: str = DEFAULT_BACKFILL_DIR
+    workers: int = None
+    chunksize: int = 1000000
+    join: str = "interval"
+
+
+def partition_directory(directory: str, day: str) -> str:
+    """Returns the split inputs directory of a day"""
+    return os.path.join(directory, "partitions", f"date={day}")
+
+
+def result_directory(directory: str, day: str) -> str:
+    """Returns the outputs directory of a day"""
+    return os.path.join(directory, "output", f"date={day}")
+
+
+def read_manifest(directory: str) -> dict:
+    """Returns the manifest of a backfill directory, empty when missing"""
+    path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(directory: str, manifest: dict) -> None:
+    """Replaces the manifest atomically, so a crash leaves the previous one"""
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def backfill_key(
+    path: str, join: str, windows: List[Window], aggregations: List[Aggregation]
+) -> str:
+    """Returns the key of the inputs and settings of a backfill, a manifest
+    with another key describes other data"""
+    parts = [file_fingerprint(path + name) for name in INPUT_FILES]
+    parts += [join, repr(windows), repr(aggregations)]
+    return make_key(parts)
+
+
+def append_csv(df: DataFrame, path: str) -> None:
+    """Appends rows to a csv file, with a header when it is new"""
+    df.to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+
+
+def split_frame(
+    df: DataFrame,
+    time_column: str,
+    directory: str,
+    name: str,
+    lookback: pd.Timedelta,
+    lookahead: pd.Timedelta,
+) -> None:
+    """
+    Appends the rows of a frame to the partition of their day, and hands
+    the rows the windows of the neighbouring days reach over to them: the
+    last `lookback` of a day to the next day and the first `lookahead` of
+    a day to the previous one, both bounds inclusive like the windows
+
+    Parameters
+    ----------
+    df: DataFrame : Rows of an input file
+
+    time_column: str : The column deciding the day of a row
+
+    directory: str : The backfill directory
+
+    name: str : The file name of the rows, e.g. polling.csv
+
+    lookback: pd.Timedelta : How far before a day its orders look
+
+    lookahead: pd.Timedelta : How far after a day its orders look
+    """
+    stem = name[: -len(".csv")].split("_")[0]
+    day = df[time_column].dt.normalize()
+    next_day = day + pd.Timedelta(days=1)
+    routes = [
+        (name, day, slice(None)),
+        (f"{stem}_lookback.csv", next_day, df[time_column] >= next_day - lookback),
+        (
+            f"{stem}_lookahead.csv",
+            day - pd.Timedelta(days=1),
+            df[time_column] <= day + lookahead,
+        ),
+    ]
+    for file_name, target, selected in routes:
+        rows = df[selected]
+        for value, group in rows.groupby(target[selected], sort=True):
+            partition = partition_directory(directory, value.date().isoformat())
+            os.makedirs(partition, exist_ok=True)
+            append_csv(group, os.path.join(partition, file_name))
+
+
+def write_connectivity_carry(
+    directory: str, days: List[str], lookback: pd.Timedelta
+) -> None:
+    """Writes, for every day, the last connectivity change of every device
+    before the lookback slice of the day. A status holds until the next
+    change, so this is the status the day's windows start from"""
+    state = pending = empty_frame("connectivity_status.csv")
+    split_days = sorted(
+        name[len("date=") :]
+        for name in os.listdir(os.path.join(directory, "partitions"))
+    )
+    first = min(split_days[0], days[0])
+    for day in pd.date_range(first, days[-1]):
+        previous = partition_directory(
+            directory, (day - pd.Timedelta(days=1)).date().isoformat()
+        )
+        if os.path.exists(os.path.join(previous, "connectivity_status.csv")):
+            changes = read_data(
+                previous + "/", "connectivity_status.csv", "creation_time"
+            )
+            pending = pd.concat([pending, changes], ignore_index=True)
+        # changes before the cut are no longer in any slice of the day
+        before = pending["creation_time"] < day - lookback
+        state = (
+            pd.concat([state, pending[before]], ignore_index=True)
+            .sort_values("creation_time", kind="mergesort")
+            .drop_duplicates("device_id", keep="last")
+        )
+        pending = pending[~before]
+        if day.date().isoformat() in days:
+            state.to_csv(
+                os.path.join(
+                    partition_directory(directory, day.date().isoformat()),
+                    "connectivity_carry.csv",
+                ),
+                index=False,
+            )
+
+
+def split_inputs(
+    path: str,
+    directory: str,
+    chunksize: int,
+    windows: List[Window] = WINDOWS,
+) -> List[str]:
+    """
+    Splits the input files into one directory per day of orders. The
+    orders are read whole so their missing device_id are filled in file
+    order like the in-memory run, polling and connectivity are streamed in
+    chunks of `chunksize` rows
+
+    Parameters
+    ----------
+    path: str : The dataset directory
+
+    directory: str : The backfill directory
+
+    chunksize: int : Rows of polling and connectivity read at a time
+
+    windows: List[Window] : The windows the days must cover
+         (Default value = WINDOWS)
+
+    Returns
+    -------
+    The days with orders, as ISO dates
+    """
+    lookback, lookahead = get_lookback_lookahead(windows)
+    if max(lookback, lookahead) >= pd.Timedelta(days=1):
+        raise ValueError("a day partition only covers windows shorter than a day")
+    shutil.rmtree(os.path.join(directory, "partitions"), ignore_errors=True)
+
+    orders = fix_missing_records(read_data(path))
+    order_day = orders["order_creation_time"].dt.normalize()
+    days = []
+    for value, group in orders.groupby(order_day, sort=True):
+        day = value.date().isoformat()
+        os.makedirs(partition_directory(directory, day), exist_ok=True)
+        group.to_csv(
+            os.path.join(partition_directory(directory, day), "orders.csv"),
+            index=False,
+        )
+        days.append(day)
+
+    for name, usecols in SPLIT_COLUMNS.items():
+        for chunk in read_data(
+            path, name, "creation_time", usecols=usecols, chunksize=chunksize
+        ):
+            split_frame(chunk, "creation_time", directory, name, lookback, lookahead)
+        logging.info(f"Split {path + name} by day")
+    if days:
+        write_connectivity_carry(directory, days, lookback)
+    logging.info(f"Split the inputs into {len(days)} days with orders")
+    return days
+
+
+def empty_frame(name: str) -> DataFrame:
+    """Returns a frame without rows with the split columns of an input"""
+    return pd.DataFrame(columns=SPLIT_COLUMNS[name]).astype(
+        {"creation_time": "datetime64[ns]"}
+    )
+
+
+def read_partition(partition: str, name: str) -> DataFrame:
+    """Reads the split files of an input of a day, the slices handed over by
+    the neighbouring days included, in time order"""
+    frames = [
+        read_data(partition + "/", file_name, "creation_time")
+        for file_name in SLICE_FILES[name]
+        if os.path.exists(os.path.join(partition, file_name))
+    ]
+    if not frames:
+        return empty_frame(name)
+    return pd.concat(frames, ignore_index=True)
+
+
+def run_partition(
+    partition: str,
+    result: str,
+    join: str = "interval",
+    windows: List[Window] = WINDOWS,
+    aggregations: List[Aggregation] = AGGREGATIONS,
+    output: OutputConfig = DEFAULT_OUTPUT,
+) -> dict:
+    """
+    Worker entry point, computes the features of the orders of one day
+    from its split inputs and writes input_data and output_data to
+    `result`
+
+    Parameters
+    ----------
+    partition: str : The split inputs directory of the day
+
+    result: str : The outputs directory of the day
+
+    join: str : "interval" or "hour", see `pipeline.join_polling_orders`
+         (Default value = "interval")
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The aggregations to run
+         (Default value = AGGREGATIONS)
+
+    output: OutputConfig : The format and input dump of the written files
+         (Default value = DEFAULT_OUTPUT, csv)
+
+    Returns
+    -------
+    A dictionary of the orders, output rows and seconds of the day
+    """
+    start = time.perf_counter()
+    orders = prepare_orders(read_data(partition + "/"))
+    polling = prepare_polling(read_partition(partition, "polling.csv"))
+    connectivity = prepare_connectivity(
+        read_partition(partition, "connectivity_status.csv")
+    )
+    joined = join_polling_orders(polling, orders, join, windows=windows)
+    joined = add_datetime_dimension_to_df(joined)
+    connectivity_features = compute_connectivity_features(
+        connectivity, orders[["device_id", "order_id", "order_creation_time"]], windows
+    )
+    main_data = compute_features(
+        joined,
+        orders[["order_id"]],
+        windows,
+        aggregations,
+        connectivity_features=connectivity_features,
+    )
+    os.makedirs(result, exist_ok=True)
+    input_dump = select_input_dump(joined, output)
+    if input_dump is not None:
+        write_frame(input_dump, os.path.join(result, "input_data"), output)
+    write_frame(main_data, os.path.join(result, "output_data"), output)
+    return {
+        "orders": len(orders),
+        "rows": len(main_data),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def run_backfill(
+    path: str = "appEventProcessingDataset/dataset/",
+    config: BackfillConfig = BackfillConfig(),
+    windows: List[Window] = WINDOWS,
+    aggregations: List[Aggregation] = AGGREGATIONS,
+    output: OutputConfig = DEFAULT_OUTPUT,
+    restart: bool = False,
+) -> dict:
+    """
+    Backfills the features of every day of orders. The inputs are split by
+    day once, the days then run in a process pool and every finished day
+    is recorded in the manifest, so a rerun after a crash skips the split
+    and the finished days. A manifest of other inputs or settings, or
+    `restart`, starts over
+
+    Parameters
+    ----------
+    path: str : The dataset directory
+         (Default value = "appEventProcessingDataset/dataset/")
+
+    config: BackfillConfig : The directory, workers, split chunk size and
+        join of the backfill
+         (Default value = BackfillConfig())
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The aggregations to run
+         (Default value = AGGREGATIONS)
+
+    output: OutputConfig : The format and input dump of the written files,
+        partition_by is not supported, the days are the partitions
+         (Default value = DEFAULT_OUTPUT, csv)
+
+    restart: bool : Ignore the manifest and start over
+         (Default value = False)
+
+    Returns
+    -------
+    The manifest. A RuntimeError naming the failed days is raised after
+    every other day finished and was recorded
+    """
+    require_pyarrow(output)
+    if output.partition_by is not None:
+        raise ValueError("a backfill is partitioned by day, partition_by is unused")
+    directory = config.directory
+    os.makedirs(directory, exist_ok=True)
+    key = backfill_key(path, config.join, windows, aggregations)
+    manifest = read_manifest(directory)
+    if restart or manifest.get("key") != key:
+        if manifest:
+            logging.info("The inputs or settings changed, starting the backfill over")
+        shutil.rmtree(os.path.join(directory, "output"), ignore_errors=True)
+        manifest = {"key": key, "format": output.format, "days": None, "done": {}}
+        write_manifest(directory, manifest)
+
+    if manifest["days"] is None:
+        manifest["days"] = split_inputs(path, directory, config.chunksize, windows)
+        write_manifest(directory, manifest)
+    pending = [day for day in manifest["days"] if day not in manifest["done"]]
+    logging.info(
+        f"{len(manifest['done'])} of {len(manifest['days'])} days done, "
+        f"running {len(pending)}"
+    )
+
+    with ProcessPoolExecutor(max_workers=config.workers) as executor:
+        futures = {
+            executor.submit(
+                run_partition,
+                partition_directory(directory, day),
+                result_directory(directory, day),
+                config.join,
+                windows,
+                aggregations,
+                output._replace(background=False),
+            ): day
+            for day in pending
+        }
+        # a failed day does not stop the others, every finished day is kept
+        failed = {}
+        for future in as_completed(futures):
+            day = futures[future]
+            try:
+                manifest["done"][day] = future.result()
+            except Exception as error:
+                failed[day] = error
+                logging.error(f"Day {day} failed: {error!r}")
+                continue
+            write_manifest(directory, manifest)
+            logging.info(f"Day {day} done: {manifest['done'][day]}")
+    if failed:
+        days = sorted(failed)
+        raise RuntimeError(
+            f"{len(days)} of {len(pending)} days failed: {', '.join(days)}, "
+            "rerun to retry them"
+        ) from failed[days[0]]
+    return manifest
+
+
+def combine_outputs(
+    directory: str = DEFAULT_BACKFILL_DIR,
+    name: str = "output_data",
+    output: OutputConfig = DEFAULT_OUTPUT,
+) -> str:
+    """
+    Concatenates an output of every finished day, in day order, into one
+    `name` file next to the manifest. Csv files are appended byte for byte
+    without their repeated headers, other formats become one part file
+    per day of a directory
+
+    Parameters
+    ----------
+    directory: str : The backfill directory
+         (Default value = DEFAULT_BACKFILL_DIR)
+
+    name: str : "output_data" or "input_data"
+         (Default value = "output_data")
+
+    output: OutputConfig : The format the days were written in
+         (Default value = DEFAULT_OUTPUT, csv)
+
+    Returns
+    -------
+    The path of the combined output
+    """
+    manifest = read_manifest(directory)
+    days = [day for day in manifest.get("days") or [] if day in manifest["done"]]
+    target = os.path.join(directory, output_path(name, output))
+    files = [
+        os.path.join(result_directory(directory, day), output_path(name, output))
+        for day in days
+    ]
+    files = [file for file in files if os.path.exists(file)]
+    if output.format != "csv":
+        shutil.rmtree(target, ignore_errors=True)
+        os.makedirs(target)
+        for position, file in enumerate(files):
+            shutil.copyfile(
+                file, os.path.join(target, f"part-{position:05d}.{output.format}")
+            )
+    else:
+        if output.compression is not None:
+            raise ValueError("compressed csv days are combined by decompressing them")
+        header = None
+        with open(target, "wb") as combined:
+            for file in files:
+                with open(file, "rb") as f:
+                    first = f.readline()
+                    if header is None:
+                        header = first
+                        combined.write(first)
+                    elif first != header:
+                        raise ValueError(f"{file} has other columns than {files[0]}")
+                    shutil.copyfileobj(f, combined)
+    logging.info(f"Combined {len(files)} days into {target}")
+    return target
+
+
+def parse_args():
+    """Parses the command line options of the backfill"""
+    parser = argparse.ArgumentParser(
+        description="Backfill the polling features one day partition at a time"
+    )
+    parser.add_argument("--path", default="appEventProcessingDataset/dataset/")
+    parser.add_argument("--directory", default=DEFAULT_BACKFILL_DIR)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="processes running day partitions, one per cpu by default",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=1000000,
+        help="rows of polling and connectivity read at a time by the split",
+    )
+    parser.add_argument("--join", choices=["interval", "hour"], default="interval")
+    parser.add_argument("--writer", choices=list(FORMATS), default="csv")
+    parser.add_argument("--compression", default=None)
+    parser.add_argument(
+        "--input-dump",
+        choices=["full", "skip"],
+        default="full",
+        help="write the joined input of every day to input_data",
+    )
+    parser.add_argument(
+        "--top-codes",
+        type=int,
+        default=None,
+        help="keep the counts of the K most frequent codes of every order and "
+        f"window and lump the others into {OTHER_CODE}",
+    )
+    parser.add_argument(
+        "--top-codes-error",
+        type=float,
+        default=None,
+        help="like --top-codes, with the smallest K whose counts are at most "
+        "this fraction of the window's events low, e.g. 0.1",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="ignore the manifest and backfill every day again",
+    )
+    parser.add_argument(
+        "--combine",
+        action="store_true",
+        help="concatenate the day outputs into one output_data afterwards",
+    )
+    args = parser.parse_args()
+    if args.top_codes_error is not None:
+        if args.top_codes is not None:
+            parser.error("give either --top-codes or --top-codes-error")
+        try:
+            args.top_codes = get_top_k(args.top_codes_error)
+        except ValueError as error:
+            parser.error(f"--top-codes-error: {error}")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    instrumentation.configure_logging()
+    output = OutputConfig(
+        format=args.writer, compression=args.compression, input_dump=args.input_dump
+    )
+    manifest = run_backfill(
+        args.path,
+        BackfillConfig(args.directory, args.workers, args.chunksize, args.join),
+        aggregations=sketch_aggregations(AGGREGATIONS, args.top_codes),
+        output=output,
+        restart=args.restart,
+    )
+    if args.combine:
+        combine_outputs(args.directory, "output_data", output)
+    print(f"{len(manifest['done'])} of {len(manifest['days'])} days backfilled")
@@ -0,0 +1,165 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate_data import generate_dataset
+from instrumentation import configure_logging
+
+HISTORY_PATH = "benchmark_history.json"
+DATA_DIR = "benchmark_data"
+# main.py reads its inputs from here, relative to the directory it runs in
+DATASET_DIR = os.path.join("appEventProcessingDataset", "dataset")
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+SIZES = [10**4, 10**5, 10**6, 10**7, 10**8]
+
+
+def prepare_dataset(polling_rows: int, devices: int, seed: int) -> str:
+    """Generates, once, a dataset with about `polling_rows` polling events
+    and returns its directory"""
+    hours = max(polling_rows // (devices * 60), 1)
+    polling_rate = polling_rows / (devices * hours)
+    path = os.path.join(DATA_DIR, f"{polling_rows}_{devices}_{seed}") + os.sep
+    if not os.path.exists(path + "orders.csv"):
+        generate_dataset(
+            path, devices=devices, hours=hours, polling_rate=polling_rate, seed=seed
+        )
+    return os.path.abspath(path) + os.sep
+
+
+def run_main(path: str, options: list = None) -> dict:
+    """
+    Runs main.py with `--metrics` on the dataset in `path`, in a fresh
+    process and a scratch directory for its outputs, and returns its wall
+    time and the stages recorded by `instrumentation`
+
+    Parameters
+    ----------
+    path: str : The dataset directory
+
+    options: list : Extra command line options of main.py
+         (Default value = None, the default run)
+
+    Returns
+    -------
+    A dictionary with the wall time, the peak RSS and the stages
+    """
+    with tempfile.TemporaryDirectory() as scratch:
+        os.makedirs(os.path.join(scratch, os.path.dirname(DATASET_DIR)))
+        os.symlink(path, os.path.join(scratch, DATASET_DIR))
+        metrics = os.path.join(scratch, "metrics.json")
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, MAIN_PATH, "--metrics", metrics] + list(options or []),
+            cwd=scratch,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        seconds = time.perf_counter() - start
+        with open(metrics) as f:
+            stages = json.load(f)["stages"]
+    return {
+        "seconds": round(seconds, 3),
+        "peak_rss_mb": max((stage["peak_rss_mb"] for stage in stages), default=None),
+        "stages": stages,
+    }
+
+
+def run_benchmark(
+    sizes: list = SIZES,
+    devices: int = 1000,
+    seed: int = 0,
+    history_path: str = HISTORY_PATH,
+    options: list = None,
+) -> list:
+    """
+    Times every stage of main.py on synthetic datasets of growing polling
+    size. Each size runs in its own process so that the peak RSS is not
+    inherited from a previous size, the stages are the ones main.py
+    records with `--metrics`, and every run is appended to a JSON history
+    file
+
+    Parameters
+    ----------
+    sizes: list : The polling row counts to benchmark
+         (Default value = SIZES)
+
+    devices: int : The number of devices of the synthetic data
+         (Default value = 1000)
+
+    seed: int : The random seed of the synthetic data
+         (Default value = 0)
+
+    history_path: str : The JSON history file
+         (Default value = HISTORY_PATH)
+
+    options: list : Extra command line options of main.py, e.g.
+        ["--join", "hour"]
+         (Default value = None, the default run)
+
+    Returns
+    -------
+    A list with one record per size
+    """
+    history = []
+    if os.path.exists(history_path):
+        with open(history_path) as f:
+            history = json.load(f)
+    commit = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+    ).stdout.strip()
+    records = []
+    for polling_rows in sizes:
+        path = prepare_dataset(polling_rows, devices, seed)
+        record = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": commit,
+            "polling_rows": polling_rows,
+            "devices": devices,
+            "options": list(options or []),
+            **run_main(path, options),
+        }
+        logging.info(
+            f"{polling_rows} polling rows: {record['seconds']:.2f}s, peak RSS "
+            f"{record['peak_rss_mb']} MB"
+        )
+        records.append(record)
+        history.append(record)
+        with open(history_path, "w") as f:
+            json.dump(history, f, indent=2)
+    return records
+
+
+def parse_args():
+    """Parses the command line options of the benchmark"""
+    parser = argparse.ArgumentParser(description="Benchmark the ETL stages")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=SIZES,
+        help="polling row counts to benchmark",
+    )
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--history", default=HISTORY_PATH)
+    parser.add_argument(
+        "options",
+        nargs=argparse.REMAINDER,
+        help="options of main.py after --, e.g. -- --join hour",
+    )
+    args = parser.parse_args()
+    if args.options[:1] == ["--"]:
+        args.options = args.options[1:]
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    configure_logging()
+    run_benchmark(args.sizes, args.devices, args.seed, args.history, args.options)
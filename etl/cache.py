@@ -0,0 +1,232 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+DEFAULT_CACHE_DIR = ".etl_cache"
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024**3
+
+
+def save_columns(df: DataFrame, directory: str) -> int:
+    """
+    Writes every column of a dataframe as a typed NumPy array into
+    `directory`, object columns are stored as integer codes plus a JSON
+    list of their distinct values
+
+    Parameters
+    ----------
+    df: DataFrame : The dataframe to store
+
+    directory: str : An existing, empty directory
+
+    Returns
+    -------
+    The number of bytes written
+    """
+    schema = []
+    for position, column in enumerate(df.columns):
+        series = df[column]
+        entry = {"name": column, "file": f"{position}.npy"}
+        if isinstance(series.dtype, pd.api.extensions.ExtensionDtype) and not (
+            isinstance(series.dtype, pd.DatetimeTZDtype)
+        ):
+            if pd.api.types.is_integer_dtype(series.dtype):
+                entry["kind"] = "masked"
+                np.save(
+                    os.path.join(directory, f"{position}.mask.npy"),
+                    series.isna().to_numpy(),
+                )
+                values = series.fillna(0).to_numpy(dtype=series.dtype.numpy_dtype)
+            else:
+                entry["kind"] = "coded"
+                values = series.astype(object)
+        elif series.dtype == object:
+            entry["kind"] = "coded"
+            values = series
+        else:
+            entry["kind"] = "plain"
+            values = series.to_numpy()
+        if entry["kind"] == "coded":
+            codes, uniques = pd.factorize(values)
+            categories = uniques.tolist()
+            # calendar dates, e.g. the `date` field, are stored as iso strings
+            if categories and all(type(value) is datetime.date for value in categories):
+                entry["categories_type"] = "date"
+                categories = [value.isoformat() for value in categories]
+            entry["categories"] = categories
+            values = codes.astype("int32")
+        np.save(os.path.join(directory, entry["file"]), values)
+        schema.append(entry)
+    with open(os.path.join(directory, "schema.json"), "w") as f:
+        json.dump({"columns": schema}, f)
+    return sum(
+        os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+    )
+
+
+def load_columns(directory: str, mmap: bool = True) -> DataFrame:
+    """
+    Reads a dataframe written by `save_columns`, numeric and datetime
+    columns are memory mapped instead of read
+
+    Parameters
+    ----------
+    directory: str : The directory written by `save_columns`
+
+    mmap: bool : Memory map the arrays
+         (Default value = True)
+
+    Returns
+    -------
+    A dataframe
+    """
+    mmap_mode = "r" if mmap else None
+    with open(os.path.join(directory, "schema.json")) as f:
+        schema = json.load(f)["columns"]
+    columns = {}
+    for entry in schema:
+        values = np.load(os.path.join(directory, entry["file"]), mmap_mode=mmap_mode)
+        if entry["kind"] == "coded":
+            categories = entry["categories"]
+            if entry.get("categories_type") == "date":
+                categories = [datetime.date.fromisoformat(v) for v in categories]
+            categories = np.array(categories + [np.nan], dtype=object)
+            # code -1 marks a missing value and picks the trailing NaN
+            columns[entry["name"]] = categories[values]
+        elif entry["kind"] == "masked":
+            mask = np.load(os.path.join(directory, entry["file"][:-4] + ".mask.npy"))
+            columns[entry["name"]] = pd.arrays.IntegerArray(np.asarray(values), mask)
+        else:
+            columns[entry["name"]] = values
+    return pd.DataFrame(columns, copy=False)
+
+
+def cache_key(path: str, **params) -> str:
+    """Returns the cache key of a file, built from its absolute path, size,
+    modification time and the parameters used to parse it"""
+    stat = os.stat(path)
+    description = json.dumps(
+        [os.path.abspath(path), stat.st_size, stat.st_mtime_ns, params],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def read_cached(
+    path: str,
+    reader,
+    cache_dir: str = DEFAULT_CACHE_DIR,
+    max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+    **params,
+) -> DataFrame:
+    """
+    Returns the columnar copy of a parsed file when it is cached, otherwise
+    parses it with `reader`, stores the columnar copy and evicts the least
+    recently used entries above `max_bytes`
+
+    Parameters
+    ----------
+    path: str : The raw file
+
+    reader : A callable returning the parsed dataframe
+
+    cache_dir: str : The cache location
+         (Default value = DEFAULT_CACHE_DIR)
+
+    max_bytes: int : The size limit of the cache
+         (Default value = DEFAULT_CACHE_MAX_BYTES)
+
+    **params : The parse parameters, part of the cache key
+
+    Returns
+    -------
+    A dataframe
+    """
+    entry = os.path.join(cache_dir, cache_key(path, **params))
+    if os.path.exists(os.path.join(entry, "schema.json")):
+        os.utime(entry)
+        logging.info(f"Loaded {path} from the columnar cache")
+        return load_columns(entry)
+
+    df = reader()
+    os.makedirs(cache_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=cache_dir, prefix=".staging-")
+    try:
+        size = save_columns(df, staging)
+        with open(os.path.join(staging, "source.txt"), "w") as f:
+            f.write(os.path.abspath(path))
+    except (TypeError, ValueError) as error:
+        shutil.rmtree(staging, ignore_errors=True)
+        logging.warning(f"{path} was not cached: {error}")
+        return df
+    if size > max_bytes:
+        shutil.rmtree(staging, ignore_errors=True)
+        logging.warning(f"{path} was not cached: {size} bytes is above the limit")
+        return df
+    try:
+        os.rename(staging, entry)
+    except OSError:
+        # another run cached the same file meanwhile
+        shutil.rmtree(staging, ignore_errors=True)
+    logging.info(f"Cached {path} ({size} bytes)")
+    evict_cache(cache_dir, max_bytes)
+    return df
+
+
+def get_cache_entries(cache_dir: str = DEFAULT_CACHE_DIR) -> list:
+    """Returns (last access time, size, path) of every cache entry,
+    least recently used first"""
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if name.startswith(".") or not os.path.isdir(entry):
+            continue
+        size = sum(
+            os.path.getsize(os.path.join(entry, file)) for file in os.listdir(entry)
+        )
+        entries.append((os.path.getmtime(entry), size, entry))
+    return sorted(entries)
+
+
+def evict_cache(
+    cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_MAX_BYTES
+) -> int:
+    """Removes the least recently used entries until the cache fits in
+    `max_bytes`, returns the number of removed entries"""
+    entries = get_cache_entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, entry in entries:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        removed += 1
+    if removed:
+        logging.info(f"Evicted {removed} entries from the columnar cache")
+    return removed
+
+
+def invalidate_cache(cache_dir: str = DEFAULT_CACHE_DIR, path: str = None) -> None:
+    """Removes the cache entries of one raw file, or the whole cache when
+    `path` is not given"""
+    if path is None:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        logging.info(f"Removed the columnar cache at {cache_dir}")
+        return
+    source = os.path.abspath(path)
+    for _, _, entry in get_cache_entries(cache_dir):
+        with open(os.path.join(entry, "source.txt")) as f:
+            if f.read() == source:
+                shutil.rmtree(entry, ignore_errors=True)
+    logging.info(f"Removed the cached copies of {path}")
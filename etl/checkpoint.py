@@ -0,0 +1,247 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+from cache import evict_cache, load_columns, save_columns
+
+DEFAULT_CHECKPOINT_DIR = ".etl_checkpoints"
+DEFAULT_CHECKPOINT_MAX_BYTES = 4 * 1024**3
+
+
+def code_names(code) -> set:
+    """Returns the global and attribute names a code object and the
+    functions nested in it refer to"""
+    names = set(code.co_names)
+    for constant in code.co_consts:
+        if inspect.iscode(constant):
+            names |= code_names(constant)
+    return names
+
+
+def is_local(value, directory: str) -> bool:
+    """Returns whether a function, class or module is defined in a file of
+    `directory`"""
+    module = value if inspect.ismodule(value) else inspect.getmodule(value)
+    path = getattr(module, "__file__", None)
+    return path is not None and os.path.dirname(os.path.abspath(path)) == directory
+
+
+def called_code(function) -> list:
+    """
+    Returns the source of a function and, transitively, of the functions
+    and classes of its directory it refers to, by name or as an attribute
+    of a local module, plus the repr of the other global values they read,
+    e.g. a schema constant. Code of the same modules that the stage never
+    refers to is left out
+
+    Parameters
+    ----------
+    function : A function defined in a file
+
+    Returns
+    -------
+    A list of (qualified name, source or repr) sorted by name
+    """
+    directory = os.path.dirname(os.path.abspath(inspect.getfile(function)))
+    found = {}
+    pending = [function]
+    while pending:
+        current = inspect.unwrap(pending.pop())
+        name = f"{current.__module__}.{current.__qualname__}"
+        if name in found:
+            continue
+        found[name] = inspect.getsource(current)
+        members = [current]
+        if inspect.isclass(current):
+            members = [
+                member
+                for member in vars(current).values()
+                if inspect.isfunction(member) and is_local(member, directory)
+            ]
+        for member in members:
+            names = code_names(member.__code__)
+            scopes = [(member.__module__, member.__globals__)]
+            for used in [member.__globals__.get(n) for n in names]:
+                if inspect.ismodule(used) and is_local(used, directory):
+                    scopes.append((used.__name__, vars(used)))
+            for module, scope in scopes:
+                for used_name in sorted(names & set(scope)):
+                    used = scope[used_name]
+                    if inspect.isfunction(used) or inspect.isclass(used):
+                        if is_local(used, directory):
+                            pending.append(used)
+                    elif not (inspect.ismodule(used) or callable(used)):
+                        value = repr(used)
+                        if " at 0x" not in value:
+                            found.setdefault(f"{module}.{used_name}", value)
+    return sorted(found.items())
+
+
+def function_fingerprint(function) -> str:
+    """Returns a hash of a function name and of the source of the local
+    functions it calls and constants it reads, so that editing a stage or a
+    helper it calls invalidates its checkpoints, while editing code it does
+    not run leaves them valid"""
+    name = f"{function.__module__}.{function.__qualname__}"
+    try:
+        code = called_code(function)
+    except (OSError, TypeError):
+        return hashlib.sha1(name.encode()).hexdigest()
+    digest = hashlib.sha1(name.encode())
+    for used, source in code:
+        digest.update(used.encode() + b"\x1f" + source.encode() + b"\x1e")
+    return digest.hexdigest()
+
+
+def file_fingerprint(path: str) -> str:
+    """Returns a hash of a file path, size and modification time"""
+    stat = os.stat(path)
+    description = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def value_fingerprint(value) -> str:
+    """Returns a hash of the columns, dtypes, index and values of a
+    dataframe or series, or the repr of any other plain value"""
+    if not isinstance(value, (DataFrame, pd.Series)):
+        return repr(value)
+    digest = hashlib.sha1(type(value).__name__.encode())
+    if isinstance(value, DataFrame):
+        digest.update(repr(list(value.columns)).encode())
+        digest.update(repr(value.dtypes.tolist()).encode())
+    else:
+        digest.update(repr((value.name, value.dtype)).encode())
+    digest.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    return digest.hexdigest()
+
+
+def make_key(parts: list) -> str:
+    """Returns the checkpoint key of a list of key parts"""
+    return hashlib.sha1("\x1f".join(parts).encode()).hexdigest()
+
+
+class Stage:
+    """A lazily evaluated pipeline stage whose output is stored under a key
+    derived from its function, its parameters and the keys of its inputs.
+    The output is only computed, or loaded, when `value` is called, and
+    upstream stages are only touched when there is no checkpoint"""
+
+    def __init__(self, store, name, function, inputs, params, key):
+        self.store = store
+        self.name = name
+        self.function = function
+        self.inputs = inputs
+        self.params = params
+        self.key = key
+        self.result = None
+
+    def value(self) -> DataFrame:
+        """Returns the stage output, from the checkpoint store when present"""
+        if self.result is not None:
+            return self.result
+        self.result = self.store.load(self.key)
+        if self.result is not None:
+            logging.info(f"Stage {self.name} loaded from checkpoint {self.key[:12]}")
+            return self.result
+        args = [
+            upstream.value() if isinstance(upstream, Stage) else upstream
+            for upstream in self.inputs
+        ]
+        self.result = self.function(*args, **self.params)
+        self.store.save(self.key, self.result)
+        logging.info(f"Stage {self.name} computed and saved as {self.key[:12]}")
+        return self.result
+
+
+class CheckpointStore:
+    """
+    Content addressed store of stage outputs, written as memory mapped
+    column files and capped in size with least recently used eviction
+
+    Parameters
+    ----------
+    directory: str : The store location
+         (Default value = DEFAULT_CHECKPOINT_DIR)
+
+    max_bytes: int : The size limit of the store
+         (Default value = DEFAULT_CHECKPOINT_MAX_BYTES)
+    """
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_CHECKPOINT_DIR,
+        max_bytes: int = DEFAULT_CHECKPOINT_MAX_BYTES,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def stage(self, name: str, function, *inputs, **params) -> Stage:
+        """
+        Declares a stage. Its key hashes the stage name, the source of
+        `function` and of the local modules it uses (`function_fingerprint`),
+        `params` and, for every input, the key of an upstream stage or the
+        fingerprint of a plain value, the content of a dataframe
+
+        Parameters
+        ----------
+        name: str : The stage name
+
+        function : Computes the stage output from the inputs
+
+        *inputs : Upstream stages or plain values
+
+        **params : Keyword parameters of `function`
+
+        Returns
+        -------
+        A Stage
+        """
+        parts = [name, function_fingerprint(function)]
+        for upstream in inputs:
+            if isinstance(upstream, Stage):
+                parts.append(upstream.key)
+            else:
+                parts.append(value_fingerprint(upstream))
+        parts.append(json.dumps(params, sort_keys=True, default=repr))
+        return Stage(self, name, function, inputs, params, make_key(parts))
+
+    def source(self, name: str, raw_path: str, reader, **params) -> Stage:
+        """Declares a stage reading the raw file `raw_path` with
+        `reader(**params)`, keyed on the file fingerprint instead of its
+        content"""
+        parts = [
+            name,
+            function_fingerprint(reader),
+            file_fingerprint(raw_path),
+            json.dumps(params, sort_keys=True, default=repr),
+        ]
+        return Stage(self, name, reader, (), params, make_key(parts))
+
+    def load(self, key: str):
+        """Returns a stored output, or None"""
+        entry = os.path.join(self.directory, key)
+        if not os.path.exists(os.path.join(entry, "schema.json")):
+            return None
+        os.utime(entry)
+        return load_columns(entry)
+
+    def save(self, key: str, df: DataFrame) -> None:
+        """Stores an output and evicts the least recently used entries above
+        the size limit"""
+        os.makedirs(self.directory, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=self.directory, prefix=".staging-")
+        try:
+            save_columns(df, staging)
+            os.rename(staging, os.path.join(self.directory, key))
+        except (OSError, TypeError, ValueError) as error:
+            logging.warning(f"Checkpoint {key[:12]} was not saved: {error}")
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        evict_cache(self.directory, self.max_bytes)
@@ -0,0 +1,300 @@
+import argparse
+import logging
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+from instrumentation import configure_logging, instrument
+from writers import DEFAULT_OUTPUT, OutputConfig, write_frame
+
+MESSAGE_COLUMNS = ["sender_app_type", "order_id", "order_stage", "message_sent_time"]
+SENDERS = ["Courier", "Customer"]
+CONVERSATION_COLUMNS = [
+    "order_id",
+    "city_code",
+    "first_courier_messsage",
+    "first_customer_messsage",
+    "num_messages_courier",
+    "num_messages_customer",
+    "first_message_by",
+    "conversation_started_at",
+    "first_responsetime_delay_seconds",
+    "last_message_time",
+    "last_message_order_stage",
+]
+# int64 nanoseconds that lose every min, or every max, comparison
+NO_FIRST = np.iinfo(np.int64).max
+NO_LAST = np.iinfo(np.int64).min
+
+
+def read_messages(path: str, chunksize: int = 1_000_000) -> Iterator[DataFrame]:
+    """Streams the chat message columns the conversations need from a csv
+    or, for a .jsonl/.json path, a json lines file"""
+    if path.endswith((".jsonl", ".json")):
+        for chunk in pd.read_json(path, lines=True, chunksize=chunksize):
+            yield chunk[MESSAGE_COLUMNS]
+        return
+    yield from pd.read_csv(path, usecols=MESSAGE_COLUMNS, chunksize=chunksize)
+
+
+def encode(values: pd.Series, vocabulary: dict) -> np.ndarray:
+    """Returns int32 codes of a text column, adding unseen values to a
+    vocabulary shared by every chunk"""
+    codes, uniques = pd.factorize(values)
+    for value in uniques:
+        vocabulary.setdefault(value, len(vocabulary))
+    # missing values have code -1, which picks the trailing -1
+    mapping = np.array([vocabulary[value] for value in uniques] + [-1], np.int32)
+    return mapping[codes]
+
+
+@instrument
+def aggregate_messages(chunk: DataFrame, offset: int, stages: dict) -> dict:
+    """
+    Reduces a chunk of chat messages to one state row per order: first and
+    last message (time, position, sender, order stage), first message and
+    message count per sender. Rows are sorted once by (order_id, time,
+    position) and every field is a slice or a `reduceat` of the runs
+
+    Parameters
+    ----------
+    chunk: DataFrame : Chat messages with `MESSAGE_COLUMNS` and a default
+        range index
+
+    offset: int : The position of the first row of the chunk in the input,
+        positions break ties between messages sent at the same time
+
+    stages: dict : The vocabulary of order stages, updated in place
+
+    Returns
+    -------
+    A dictionary of arrays sorted by order_id
+    """
+    chunk = chunk[chunk["order_id"].notna() & chunk["message_sent_time"].notna()]
+    order = chunk["order_id"].to_numpy(dtype=np.int64)
+    sent = pd.to_datetime(chunk["message_sent_time"]).to_numpy().view(np.int64)
+    position = offset + chunk.index.to_numpy(dtype=np.int64)
+    sender = chunk["sender_app_type"].fillna("")
+    courier = sender.str.startswith("Courier").to_numpy()
+    customer = sender.str.startswith("Customer").to_numpy()
+    sender_code = np.where(courier, 0, np.where(customer, 1, -1)).astype(np.int8)
+    stage = encode(chunk["order_stage"], stages)
+
+    by_time = np.lexsort((position, sent, order))
+    order, sent, position = order[by_time], sent[by_time], position[by_time]
+    courier, customer = courier[by_time], customer[by_time]
+    sender_code, stage = sender_code[by_time], stage[by_time]
+    # every order is a run of rows, from starts to ends included
+    boundary = np.ones(len(order), dtype=bool)
+    boundary[1:] = order[1:] != order[:-1]
+    starts = np.flatnonzero(boundary)
+    ends = np.append(starts[1:], len(order)) - 1 if len(order) else starts
+
+    def reduce(function, values):
+        return function.reduceat(values, starts) if len(order) else values[:0]
+
+    return {
+        "order_id": order[starts],
+        "first_time": sent[starts],
+        "first_position": position[starts],
+        "first_sender": sender_code[starts],
+        "last_time": sent[ends],
+        "last_position": position[ends],
+        "last_stage": stage[ends],
+        "first_courier": reduce(np.minimum, np.where(courier, sent, NO_FIRST)),
+        "first_customer": reduce(np.minimum, np.where(customer, sent, NO_FIRST)),
+        "num_courier": reduce(np.add, courier.astype(np.int64)),
+        "num_customer": reduce(np.add, customer.astype(np.int64)),
+    }
+
+
+def merge_conversation_state(state: dict, update: dict) -> dict:
+    """
+    Merges the per order state of a new chunk into the running state. Both
+    are sorted by order_id, the union of their orders is aligned with
+    `searchsorted` and every field is combined with vectorised min, max,
+    sum or a (time, position) comparison
+
+    Parameters
+    ----------
+    state: dict : The running state, or None before the first chunk
+
+    update: dict : The state of a chunk, from `aggregate_messages`
+
+    Returns
+    -------
+    A dictionary of arrays sorted by order_id
+    """
+    if state is None:
+        return update
+    order_id = np.union1d(state["order_id"], update["order_id"])
+    old = np.searchsorted(order_id, state["order_id"])
+    new = np.searchsorted(order_id, update["order_id"])
+
+    def aligned(field, default):
+        values = np.full(len(order_id), default, dtype=state[field].dtype)
+        values[old] = state[field]
+        return values
+
+    merged = {"order_id": order_id}
+    merged["first_time"] = aligned("first_time", NO_FIRST)
+    merged["first_position"] = aligned("first_position", NO_FIRST)
+    merged["first_sender"] = aligned("first_sender", -1)
+    first = merged["first_time"][new], merged["first_position"][new]
+    earlier = (update["first_time"] < first[0]) | (
+        (update["first_time"] == first[0]) & (update["first_position"] < first[1])
+    )
+    for field in ["first_time", "first_position", "first_sender"]:
+        merged[field][new] = np.where(earlier, update[field], merged[field][new])
+
+    merged["last_time"] = aligned("last_time", NO_LAST)
+    merged["last_position"] = aligned("last_position", NO_LAST)
+    merged["last_stage"] = aligned("last_stage", -1)
+    last = merged["last_time"][new], merged["last_position"][new]
+    later = (update["last_time"] > last[0]) | (
+        (update["last_time"] == last[0]) & (update["last_position"] > last[1])
+    )
+    for field in ["last_time", "last_position", "last_stage"]:
+        merged[field][new] = np.where(later, update[field], merged[field][new])
+
+    for field in ["first_courier", "first_customer"]:
+        merged[field] = aligned(field, NO_FIRST)
+        merged[field][new] = np.minimum(merged[field][new], update[field])
+    for field in ["num_courier", "num_customer"]:
+        merged[field] = aligned(field, 0)
+        merged[field][new] += update[field]
+    return merged
+
+
+def to_timestamps(values: np.ndarray, missing: int) -> pd.Series:
+    """Returns int64 nanoseconds as timestamps, with NaT for `missing`"""
+    return pd.Series(np.where(values == missing, NO_LAST, values)).astype(
+        "datetime64[ns]"
+    )
+
+
+@instrument
+def finish_conversations(
+    state: dict, stages: dict, orders: DataFrame = None
+) -> DataFrame:
+    """
+    Turns the running state into the customer_courier_conversations table
+
+    Parameters
+    ----------
+    state: dict : The running state, from `merge_conversation_state`
+
+    stages: dict : The vocabulary of order stages
+
+    orders: DataFrame : order_id and city_code of the orders
+         (Default value = None, no city_code)
+
+    Returns
+    -------
+    A dataframe with `CONVERSATION_COLUMNS`
+    """
+    first_courier = to_timestamps(state["first_courier"], NO_FIRST)
+    first_customer = to_timestamps(state["first_customer"], NO_FIRST)
+    stage_names = np.array(list(stages) + [None], dtype=object)
+    sender_names = np.array(SENDERS + [None], dtype=object)
+    df = pd.DataFrame(
+        {
+            "order_id": state["order_id"],
+            "first_courier_messsage": first_courier,
+            "first_customer_messsage": first_customer,
+            "num_messages_courier": state["num_courier"],
+            "num_messages_customer": state["num_customer"],
+            "first_message_by": sender_names[state["first_sender"]],
+            "conversation_started_at": to_timestamps(state["first_time"], NO_FIRST),
+            "first_responsetime_delay_seconds": (
+                (first_courier - first_customer).dt.total_seconds().abs()
+            ),
+            "last_message_time": to_timestamps(state["last_time"], NO_LAST),
+            "last_message_order_stage": stage_names[state["last_stage"]],
+        }
+    )
+    if orders is not None:
+        df = df.merge(
+            orders[["order_id", "city_code"]].drop_duplicates("order_id"),
+            how="left",
+            on="order_id",
+        )
+    else:
+        df["city_code"] = None
+    return df[CONVERSATION_COLUMNS]
+
+
+def build_conversations(
+    messages_path: str,
+    orders_path: str = None,
+    chunksize: int = 1_000_000,
+    output: OutputConfig = DEFAULT_OUTPUT,
+) -> DataFrame:
+    """
+    Builds the customer_courier_conversations table from a chat message
+    file streamed in chunks, so memory is bounded by the chunk size plus
+    one state row per order, and writes it at current directory
+
+    Parameters
+    ----------
+    messages_path: str : A csv or json lines file of chat messages
+
+    orders_path: str : A csv file with order_id and city_code
+         (Default value = None, no city_code)
+
+    chunksize: int : Number of messages per chunk
+         (Default value = 1_000_000)
+
+    output: OutputConfig : How to write the table
+         (Default value = DEFAULT_OUTPUT, csv)
+
+    Returns
+    -------
+    A dataframe
+    """
+    # states are merged like a binary counter, two states of similar sizes
+    # at a time, so every order is merged O(log(chunks)) times in total
+    levels = []
+    stages = {}
+    offset = 0
+    for chunk in read_messages(messages_path, chunksize):
+        chunk = chunk.reset_index(drop=True)
+        levels.append(aggregate_messages(chunk, offset, stages))
+        while len(levels) > 1 and 2 * len(levels[-1]["order_id"]) >= len(
+            levels[-2]["order_id"]
+        ):
+            update = levels.pop()
+            levels[-1] = merge_conversation_state(levels[-1], update)
+        offset += len(chunk)
+        logging.info(f"{offset} messages read")
+    state = None
+    for level in levels:
+        state = merge_conversation_state(state, level)
+    if state is None:
+        state = aggregate_messages(pd.DataFrame(columns=MESSAGE_COLUMNS), 0, stages)
+    logging.info(f"{len(state['order_id'])} conversations from {offset} messages")
+    orders = None
+    if orders_path is not None:
+        orders = pd.read_csv(orders_path, usecols=["order_id", "city_code"])
+    conversations = finish_conversations(state, stages, orders)
+    write_frame(conversations, "customer_courier_conversations", output)
+    return conversations
+
+
+def parse_args():
+    """Parses the command line options of the conversation builder"""
+    parser = argparse.ArgumentParser(
+        description="Build customer_courier_conversations from chat messages"
+    )
+    parser.add_argument("messages", help="csv or json lines file of chat messages")
+    parser.add_argument("--orders", default=None, help="csv with the city_code")
+    parser.add_argument("--chunksize", type=int, default=1_000_000)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    configure_logging()
+    args = parse_args()
+    print(build_conversations(args.messages, args.orders, args.chunksize).head(10))
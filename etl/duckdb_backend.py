@@ -0,0 +1,392 @@
+import logging
+import os
+from typing import List, NamedTuple
+
+import numpy as np
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+from instrumentation import instrument
+from writers import (
+    DEFAULT_OUTPUT,
+    OutputConfig,
+    OutputWriter,
+    clear_output,
+    output_path,
+)
+from etl import (
+    WINDOWS,
+    AGGREGATIONS,
+    WINDOW_BOUNDS,
+    Aggregation,
+    Window,
+    assemble_features,
+    compute_connectivity_features,
+    derive_window_features,
+)
+from pipeline import get_lookback_lookahead
+
+# raw columns of every input and their engine types, both files are read
+# by name so that extra columns, e.g. the unnamed csv index, are ignored
+INPUT_TYPES = {
+    "orders": {
+        "order_id": "BIGINT",
+        "device_id": "VARCHAR",
+        "order_creation_time": "TIMESTAMP",
+    },
+    "polling": {
+        "device_id": "VARCHAR",
+        "creation_time": "TIMESTAMP",
+        "error_code": "VARCHAR",
+        "status_code": "BIGINT",
+    },
+    "connectivity_status": {
+        "device_id": "VARCHAR",
+        "creation_time": "TIMESTAMP",
+        "status": "VARCHAR",
+    },
+}
+
+# orders in file order, with device_id forward then backward filled like
+# `fix_missing_records`
+ORDERS_TABLE = """
+CREATE TABLE orders AS
+SELECT
+  rowid AS order_rank,
+  order_id,
+  coalesce(
+    last_value(device_id IGNORE NULLS) OVER (
+      ORDER BY rowid ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+    ),
+    first_value(device_id IGNORE NULLS) OVER (
+      ORDER BY rowid ROWS BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING
+    )
+  ) AS device_id,
+  order_creation_time,
+  hour(order_creation_time) AS hour,
+  CAST(order_creation_time AS DATE) AS date
+FROM raw_orders
+"""
+# time_rank orders the events of a device by time, then file order, like
+# the sort of `interval_join`
+POLLING_TABLE = """
+CREATE TABLE polling AS
+SELECT
+  rowid AS polling_rank,
+  row_number() OVER (
+    PARTITION BY device_id ORDER BY creation_time, rowid
+  ) AS time_rank,
+  device_id,
+  creation_time AS polling_creation_time,
+  error_code,
+  status_code,
+  hour(creation_time) AS hour,
+  CAST(creation_time AS DATE) AS date
+FROM raw_polling
+"""
+
+# joined rows with their `position` in the pandas joins: `interval_join`
+# walks the orders and, per order, the events of its device by time, the
+# hour merge keeps the polling order. The interval join also matches on
+# time buckets as long as the lookback plus lookahead, each order reaching
+# the two buckets its window overlaps, so the hash join on device_id does
+# not pair every order with every event of its device
+JOINS = {
+    "interval": """
+SELECT
+  p.* EXCLUDE (bucket),
+  o.order_id,
+  o.order_creation_time,
+  CAST(o.order_rank AS HUGEINT) * 18446744073709551616 + p.time_rank AS position
+FROM (
+  SELECT *, epoch_us(polling_creation_time) // {span} AS bucket FROM polling
+) AS p
+JOIN (
+  SELECT *, unnest(range(
+    (epoch_us(order_creation_time) - {lookback}) // {span},
+    (epoch_us(order_creation_time) + {lookahead}) // {span} + 1
+  )) AS bucket
+  FROM orders
+) AS o
+  ON p.device_id = o.device_id
+  AND p.bucket = o.bucket
+  AND p.polling_creation_time >= o.order_creation_time - to_microseconds({lookback})
+  AND p.polling_creation_time <= o.order_creation_time + to_microseconds({lookahead})
+""",
+    "hour": """
+SELECT
+  p.*,
+  o.order_id,
+  o.order_creation_time,
+  CAST(p.polling_rank AS HUGEINT) * 18446744073709551616 + o.order_rank AS position
+FROM polling AS p
+JOIN orders AS o USING (device_id, hour, date)
+""",
+}
+
+# one count per (window, order, status_code, error_code), ordered by the
+# position of its first membership like `groupby(sort=False)` finds them
+WINDOW_COUNTS = """
+SELECT "window", order_id, status_code, error_code, size
+FROM (
+  SELECT
+    w.window_id AS "window",
+    j.order_id,
+    j.status_code,
+    j.error_code,
+    count(*) AS size,
+    min(j.position) AS first_seen
+  FROM ({join}) AS j
+  JOIN (VALUES {windows}) AS w(window_id, before_us, after_us)
+    ON epoch_us(j.polling_creation_time) - epoch_us(j.order_creation_time)
+      BETWEEN -w.before_us AND w.after_us
+  GROUP BY ALL
+)
+ORDER BY "window", first_seen
+"""
+
+
+class DuckDBConfig(NamedTuple):
+    """Settings of the embedded engine: the database file its tables live
+    in (":memory:" spills to temp_directory past memory_limit), the number
+    of threads (None for every core) and the memory limit, e.g. "4GB" """
+
+    database: str = ":memory:"
+    threads: int = None
+    memory_limit: str = None
+    temp_directory: str = ".duckdb_tmp"
+
+
+DEFAULT_DUCKDB = DuckDBConfig()
+
+
+def require_duckdb():
+    """Returns the duckdb module, raises an ImportError when it is missing"""
+    try:
+        import duckdb
+    except ImportError as error:
+        raise ImportError(
+            "the duckdb backend needs duckdb, run `pip install duckdb` "
+            "or use the pandas backend"
+        ) from error
+    return duckdb
+
+
+def input_file(path: str, name: str) -> str:
+    """Returns the parquet file of an input when present, else the csv"""
+    parquet = os.path.join(path, name + ".parquet")
+    return parquet if os.path.exists(parquet) else os.path.join(path, name + ".csv")
+
+
+def read_input(connection, path: str, name: str, table: str) -> None:
+    """Loads the declared columns of a csv or parquet input into a table,
+    in file order"""
+    filename = input_file(path, name)
+    types = INPUT_TYPES[name]
+    columns = ", ".join(f"CAST({c} AS {t}) AS {c}" for c, t in types.items())
+    if filename.endswith(".parquet"):
+        source = f"read_parquet('{filename}')"
+    else:
+        declared = ", ".join(f"'{c}': '{t}'" for c, t in types.items())
+        source = f"read_csv('{filename}', header = true, types = {{{declared}}})"
+    connection.execute(f"CREATE TABLE {table} AS SELECT {columns} FROM {source}")
+    logging.info(f"Data read successfully from {filename} into {table}")
+
+
+def match_pandas_types(connection, table: str, column: str) -> None:
+    """Casts an integer column with missing values to DOUBLE, the float64
+    that `pd.read_csv` infers for it, so that the fetched frames and the
+    dumped csv write 200.0 like the pandas backend"""
+    missing = connection.execute(
+        f"SELECT count(*) FROM {table} WHERE {column} IS NULL"
+    ).fetchone()[0]
+    if missing:
+        connection.execute(f"ALTER TABLE {table} ALTER {column} TYPE DOUBLE")
+
+
+def connect(config: DuckDBConfig = DEFAULT_DUCKDB):
+    """Opens the embedded database with the threads and memory settings"""
+    duckdb = require_duckdb()
+    connection = duckdb.connect(config.database)
+    connection.execute(f"SET temp_directory = '{config.temp_directory}'")
+    if config.threads:
+        connection.execute(f"SET threads = {int(config.threads)}")
+    if config.memory_limit:
+        connection.execute(f"SET memory_limit = '{config.memory_limit}'")
+    return connection
+
+
+def fetch(connection, query: str) -> DataFrame:
+    """Runs a query and returns its result with nanosecond timestamps, the
+    resolution every pandas step expects"""
+    df = connection.execute(query).df()
+    for column in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = df[column].astype("datetime64[ns]")
+    return df
+
+
+def get_join(join: str, windows: List[Window] = WINDOWS) -> str:
+    """Returns the join query of polling and orders"""
+    if join not in JOINS:
+        raise ValueError(f"Unknown join {join}, expected one of {list(JOINS)}")
+    lookback, lookahead = get_lookback_lookahead(windows)
+    lookback, lookahead = lookback.value // 1000, lookahead.value // 1000
+    return JOINS[join].format(
+        lookback=lookback, lookahead=lookahead, span=max(lookback + lookahead, 1)
+    )
+
+
+@instrument
+def compute_window_counts(
+    connection, join: str = "interval", windows: List[Window] = WINDOWS
+) -> pd.Series:
+    """
+    Runs the join and the window memberships in the engine and returns the
+    membership counts that `derive_window_features` takes, in the order
+    the pandas groupby finds them
+
+    Parameters
+    ----------
+    connection : A connection holding the orders and polling tables
+
+    join: str : "interval" or "hour", see `join_polling_orders`
+         (Default value = "interval")
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    Returns
+    -------
+    A series indexed by window, order_id, status_code and error_code
+    """
+    values = ", ".join(
+        f"({window_id}, {window.before.value // 1000}, {window.after.value // 1000})"
+        for window_id, window in enumerate(windows)
+    )
+    counts = fetch(
+        connection, WINDOW_COUNTS.format(join=get_join(join, windows), windows=values)
+    )
+    counts["window"] = counts["window"].astype("int16")
+    # missing error codes are NaN in the pandas path, not None
+    counts["error_code"] = counts["error_code"].astype(object)
+    counts.loc[counts["error_code"].isna(), "error_code"] = np.nan
+    index = pd.MultiIndex.from_frame(
+        counts[["window", "order_id", "status_code", "error_code"]]
+    )
+    logging.info(f"{len(counts)} window counts computed by the engine")
+    return pd.Series(counts["size"].to_numpy(), index=index)
+
+
+def write_input_dump(connection, join: str, windows: List[Window], output) -> None:
+    """Writes the joined input, as `get_all_feature` dumps it, straight from
+    the engine with COPY"""
+    if output.input_dump == "skip":
+        return
+    if output.format not in ("csv", "parquet"):
+        raise ValueError("the duckdb backend dumps input_data as csv or parquet")
+    bounds = ", ".join(
+        f"order_creation_time + to_microseconds({offset.value // 1000}) AS {column}"
+        for column, offset in WINDOW_BOUNDS.items()
+    )
+    sample = ""
+    if output.input_dump == "sample":
+        sample = f"USING SAMPLE {output.input_sample * 100} PERCENT (bernoulli)"
+    options = ["FORMAT csv, HEADER" if output.format == "csv" else "FORMAT parquet"]
+    if output.compression:
+        options.append(f"COMPRESSION {output.compression}")
+    if output.partition_by:
+        options.append(f"PARTITION_BY ({output.partition_by})")
+    path = output_path("input_data", output)
+    clear_output("input_data", output)
+    connection.execute(f"""
+COPY (
+  SELECT * EXCLUDE (polling_rank, time_rank, position), {bounds}
+  FROM ({get_join(join, windows)}) {sample}
+  ORDER BY position
+) TO '{path}' ({", ".join(options)})
+""")
+    logging.info(f"Data written successfully to {path}")
+
+
+def run_duckdb(
+    path: str = "appEventProcessingDataset/dataset/",
+    join: str = "interval",
+    windows: List[Window] = WINDOWS,
+    aggregations: List[Aggregation] = AGGREGATIONS,
+    output: OutputConfig = DEFAULT_OUTPUT,
+    config: DuckDBConfig = DEFAULT_DUCKDB,
+) -> DataFrame:
+    """
+    Runs the pipeline on the embedded DuckDB engine: the inputs are read
+    from their csv or parquet files, the join and every window membership
+    count run as one multithreaded query that spills to disk past the
+    memory limit, and only the per order counts come back to pandas. The
+    features are then derived as `get_all_feature` does, so output_data is
+    the same as with the pandas backend
+
+    Parameters
+    ----------
+    path: str : The directory of orders, polling and connectivity_status
+        (.parquet when present, else .csv)
+         (Default value = "appEventProcessingDataset/dataset/")
+
+    join: str : "interval" or "hour", see `join_polling_orders`
+         (Default value = "interval")
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The aggregations to run, their
+        columns must be status_code and error_code
+         (Default value = AGGREGATIONS)
+
+    output: OutputConfig : The format, partitioning and input dump of the
+        written files
+         (Default value = DEFAULT_OUTPUT, csv)
+
+    config: DuckDBConfig : The engine settings
+         (Default value = DEFAULT_DUCKDB)
+
+    Returns
+    -------
+    A dataframe
+    """
+    columns = {a.column for a in aggregations if a.column}
+    if not columns <= {"status_code", "error_code"}:
+        raise ValueError("the duckdb backend aggregates status_code and error_code")
+    connection = connect(config)
+    try:
+        read_input(connection, path, "orders", "raw_orders")
+        read_input(connection, path, "polling", "raw_polling")
+        match_pandas_types(connection, "raw_polling", "status_code")
+        connection.execute(ORDERS_TABLE)
+        connection.execute(POLLING_TABLE)
+        with OutputWriter(output) as writer:
+            write_input_dump(connection, join, windows, output)
+            counts = compute_window_counts(connection, join, windows)
+            features = derive_window_features(counts, windows, aggregations)
+            orders = fetch(
+                connection,
+                "SELECT order_id, device_id, order_creation_time "
+                "FROM orders ORDER BY order_rank",
+            )
+            main_data = assemble_features(
+                features, orders[["order_id"]], windows, aggregations
+            )
+            # status changes are few, their prefix sums run in pandas
+            read_input(connection, path, "connectivity_status", "connectivity")
+            connectivity = fetch(
+                connection,
+                "SELECT device_id, creation_time AS connectivity_creation_time, "
+                "status FROM connectivity ORDER BY rowid",
+            )
+            main_data = main_data.merge(
+                compute_connectivity_features(connectivity, orders, windows),
+                how="left",
+                on="order_id",
+            )
+            writer.write(main_data, "output_data")
+    finally:
+        connection.close()
+    return main_data
@@ -3,17 +3,33 @@ import pandas as pd
 import logging
 import numpy as np
 from pandas.core.frame import DataFrame
+from typing import Dict, List, NamedTuple, Optional, Tuple
 import warnings
-from helpers import rename_field
+from helpers import rename_field, segmented_searchsorted
+from instrumentation import instrument
+from writers import DEFAULT_OUTPUT, OutputConfig, OutputWriter, select_input_dump
 
 warnings.filterwarnings("ignore")
-logging.basicConfig(
-    format="%(asctime)s %(levelname)s - ETL code - %(message)s", level=logging.INFO
-)
-logging.getLogger().setLevel(logging.INFO)
 
 
-def add_datetime_dimension_to_df(df: DataFrame):
+# offsets from order_creation_time of the window bound columns
+WINDOW_BOUNDS = {
+    "three_minutes_b4_order_creation_time": -pd.to_timedelta(3, unit="m"),
+    "three_minutes_after_order_creation_time": pd.to_timedelta(3, unit="m"),
+    "one_hour_before_order_creation_time": -pd.to_timedelta(1, unit="hr"),
+}
+
+
+def get_window_bound(df: DataFrame, column: str) -> pd.Series:
+    """Returns a window bound column of `WINDOW_BOUNDS`, computed from
+    order_creation_time when it was not materialized on the dataframe"""
+    if column in df.columns:
+        return df[column]
+    return df["order_creation_time"] + WINDOW_BOUNDS[column]
+
+
+@instrument
+def add_datetime_dimension_to_df(df: DataFrame, compact: bool = False):
     """
     Takes a dataframe, adds three new columns to it by calculating
     the value across timestamp
@@ -22,19 +38,20 @@ def add_datetime_dimension_to_df(df: DataFrame):
     ----------
     df: pd.DataFrame : A dataframe
 
+    compact: bool : Leaves the dataframe as is, the window bounds are then
+        computed on the fly by `get_window_bound`, which saves three
+        datetime64 columns per joined row
+         (Default value = False)
+
     Returns
     -------
     A dataframe
     """
-    df["three_minutes_b4_order_creation_time"] = df[
-        "order_creation_time"
-    ] - pd.to_timedelta(3, unit="m")
-    df["three_minutes_after_order_creation_time"] = df[
-        "order_creation_time"
-    ] + pd.to_timedelta(3, unit="m")
-    df["one_hour_before_order_creation_time"] = df[
-        "order_creation_time"
-    ] - pd.to_timedelta(1, unit="hr")
+    if compact:
+        logging.info("Window bounds are computed on the fly, no column added")
+        return df
+    for column, offset in WINDOW_BOUNDS.items():
+        df[column] = df["order_creation_time"] + offset
     logging.info(
         f"3 date dimension column added to dataframe: which are:: {df.columns[-3:]}"
     )
@@ -59,7 +76,7 @@ def get_3min_b4_order_creation_time_data(df: DataFrame) -> DataFrame:
             (df["order_creation_time"] >= df["polling_creation_time"])
             & (
                 df["polling_creation_time"]
-                >= df["three_minutes_b4_order_creation_time"]
+                >= get_window_bound(df, "three_minutes_b4_order_creation_time")
             )
         )
     ]
@@ -84,7 +101,7 @@ def get_3min_after_order_creation_time_data(df: DataFrame) -> DataFrame:
             (df["order_creation_time"] <= df["polling_creation_time"])
             & (
                 df["polling_creation_time"]
-                <= df["three_minutes_after_order_creation_time"]
+                <= get_window_bound(df, "three_minutes_after_order_creation_time")
             )
         )
     ]
@@ -107,7 +124,10 @@ def get_1hr_b4_order_creation_time_data(df: DataFrame) -> DataFrame:
     one_hr_b4_order_creation_time = df[
         (
             (df["order_creation_time"] >= df["polling_creation_time"])
-            & (df["polling_creation_time"] >= df["one_hour_before_order_creation_time"])
+            & (
+                df["polling_creation_time"]
+                >= get_window_bound(df, "one_hour_before_order_creation_time")
+            )
         )
     ]
     return one_hr_b4_order_creation_time
@@ -116,6 +136,7 @@ def get_1hr_b4_order_creation_time_data(df: DataFrame) -> DataFrame:
 # get polling events counts
 
 
+@instrument
 def get_total_count_polling_event_3min_b4_order_creation_time(
     df: DataFrame,
 ) -> DataFrame:
@@ -143,6 +164,7 @@ def get_total_count_polling_event_3min_b4_order_creation_time(
     return three_minute_b4_order_creation_time
 
 
+@instrument
 def get_total_count_polling_event_3min_after_order_creation_time(
     df: DataFrame,
 ) -> DataFrame:
@@ -170,6 +192,7 @@ def get_total_count_polling_event_3min_after_order_creation_time(
     return three_minute_after_order_creation_time
 
 
+@instrument
 def get_total_count_polling_event_1hr_b4_order_creation_time(
     df: DataFrame,
 ) -> DataFrame:
@@ -200,6 +223,7 @@ def get_total_count_polling_event_1hr_b4_order_creation_time(
 # the count of each type of polling status code
 
 
+@instrument
 def get_total_count_polling_status_code_3min_b4_order_creation_time(
     df: DataFrame,
 ) -> DataFrame:
@@ -227,6 +251,7 @@ def get_total_count_polling_status_code_3min_b4_order_creation_time(
     return polling_status_code_count
 
 
+@instrument
 def get_total_count_polling_status_code_3min_after_order_creation_time(
     df: DataFrame,
 ) -> DataFrame:
@@ -256,6 +281,7 @@ def get_total_count_polling_status_code_3min_after_order_creation_time(
     return polling_status_code_count
 
 
+@instrument
 def get_total_count_polling_status_code_1hr_before_order_creation_time(
     df: DataFrame,
 ) -> DataFrame:
@@ -286,6 +312,7 @@ def get_total_count_polling_status_code_1hr_before_order_creation_time(
 # count of each type of error_code and count of responses without error codes
 
 
+@instrument
 def get_count_error_code_3min_b4_order_creation_time(df: DataFrame) -> DataFrame:
     """Takes a dataframe, filter the data by selecting polling events 3 minutes
     less than the order time, performs a groupby selecting each order
@@ -311,6 +338,7 @@ def get_count_error_code_3min_b4_order_creation_time(df: DataFrame) -> DataFrame
     return error_code_count
 
 
+@instrument
 def get_count_error_code_3min_after_order_creation_time(df: DataFrame) -> DataFrame:
     """Takes a dataframe, filter the data by selecting polling events 3 minutes
     after the order time, performs a groupby selecting each order
@@ -336,6 +364,7 @@ def get_count_error_code_3min_after_order_creation_time(df: DataFrame) -> DataFr
     return error_code_count
 
 
+@instrument
 def get_count_error_code_1hr_b4_order_creation_time(df: DataFrame) -> DataFrame:
     """Takes a dataframe, filter the data by selecting polling events 1 hour
     before the order time, performs a groupby selecting each order
@@ -384,6 +413,7 @@ def get_no_error_code_data(df: DataFrame) -> DataFrame:
     return no_error_codes
 
 
+@instrument
 def get_count_response_no_error_code_3min_b4_order_creation_time(
     df: DataFrame,
 ) -> DataFrame:
@@ -410,6 +440,7 @@ def get_count_response_no_error_code_3min_b4_order_creation_time(
     return no_error_code_3min_b4
 
 
+@instrument
 def get_count_response_no_error_code_3min_after_order_creation_time(
     df: DataFrame,
 ) -> DataFrame:
@@ -436,6 +467,7 @@ def get_count_response_no_error_code_3min_after_order_creation_time(
     return no_error_code_3min_after
 
 
+@instrument
 def get_count_response_no_error_code_1hr_b4_order_creation_time(
     df: DataFrame,
 ) -> DataFrame:
@@ -460,85 +492,818 @@ def get_count_response_no_error_code_1hr_b4_order_creation_time(
     return no_error_code_1hr
 
 
-# implement all function defined here
+# single pass feature engine
+
+
+class Window(NamedTuple):
+    """A polling window around the order creation time, both ends inclusive"""
+
+    name: str
+    before: pd.Timedelta
+    after: pd.Timedelta
+
 
+class Aggregation(NamedTuple):
+    """An aggregation run over the polling events of every window.
+
+    kind is one of "count" (number of events), "value_counts" (number of
+    events per value of `column`), "null_count" (number of events where
+    `column` is missing) or "top_k" (the value counts of the `top_k` most
+    frequent values of every order and window, see `sketch_value_counts`)
+    """
+
+    name: str
+    kind: str
+    column: Optional[str] = None
+    top_k: Optional[int] = None
+
+
+WINDOWS = [
+    Window("3min_b4", pd.Timedelta(minutes=3), pd.Timedelta(0)),
+    Window("3min_after", pd.Timedelta(0), pd.Timedelta(minutes=3)),
+    Window("1hr_b4", pd.Timedelta(hours=1), pd.Timedelta(0)),
+]
+
+AGGREGATIONS = [
+    Aggregation("total_polling_event", "count"),
+    Aggregation("status_code_count", "value_counts", "status_code"),
+    Aggregation("error_code_count", "value_counts", "error_code"),
+    Aggregation("no_error_code_count", "null_count", "error_code"),
+]
+
+# value of the "top_k" rows lumping the codes outside the top k of an order
+OTHER_CODE = "OTHER"
+# rows of the merged dataframe summarised at a time by `sketch_value_counts`
+SKETCH_CHUNK_ROWS = 1000000
+
+# column names produced by the original per-window functions
+LEGACY_FEATURE_COLUMNS = {
+    ("total_polling_event", "3min_b4"): "total_polling_event_three_minute_b4",
+    ("total_polling_event", "3min_after"): "total_polling_event_three_minute_after",
+    ("total_polling_event", "1hr_b4"): "total_polling_event_one_hr_b4",
+    ("status_code_count", "3min_b4"): "status_code_count",
+    (
+        "status_code_count",
+        "3min_after",
+    ): "status_code_count_3min_after_order_creation_time",
+    ("status_code_count", "1hr_b4"): "status_code_count_one_hr_b4_order_creation_time",
+    ("error_code_count", "3min_b4"): "error_code_count_3min_b4_order_creation_time",
+    (
+        "error_code_count",
+        "3min_after",
+    ): "error_code_count_3min_after_order_creation_time",
+    ("error_code_count", "1hr_b4"): "error_code_count_1hr_b4_order_creation_time",
+    (
+        "no_error_code_count",
+        "3min_b4",
+    ): "no_error_code_count_3min_b4_order_creation_time",
+    (
+        "no_error_code_count",
+        "3min_after",
+    ): "no_error_code_count_3min_after_order_creation_time",
+    (
+        "no_error_code_count",
+        "1hr_b4",
+    ): "no_error_code_count_1hr_b4_order_creation_time",
+}
+
+
+def feature_column_name(aggregation: Aggregation, window: Window) -> str:
+    """Returns the output column name of an aggregation over a window"""
+    return LEGACY_FEATURE_COLUMNS.get(
+        (aggregation.name, window.name), f"{aggregation.name}_{window.name}"
+    )
 
-def get_all_feature(df: DataFrame, orders: DataFrame) -> DataFrame:
-    """Takes a dataframe and a series of order_id, implements all functions
-    on a higher abstraction level and saves a csv at current directory.
+
+def get_window_membership(
+    df: DataFrame, windows: List[Window] = WINDOWS, columns: List[str] = []
+) -> DataFrame:
+    """Takes the merged polling/orders dataframe, computes the offset of
+    every polling event from its order once and returns one row per
+    (window, polling event) membership
 
     Parameters
     ----------
-    df: DataFrame :
+    df: DataFrame : A dataframe with order_creation_time and
+        polling_creation_time
 
-    orders: DataFrame :
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    columns: List[str] : Extra polling columns to carry along
+         (Default value = [])
 
     Returns
     -------
-    A dataframe
+    A dataframe with window (position in `windows`), order_id and `columns`
     """
-    # total count of all polling events
-    total_count_polling_event_3min_b4 = (
-        get_total_count_polling_event_3min_b4_order_creation_time(df)
-    )
-    total_count_polling_event_3min_after = (
-        get_total_count_polling_event_3min_after_order_creation_time(df)
-    )
-    total_count_polling_event_1hr_b4 = (
-        get_total_count_polling_event_1hr_b4_order_creation_time(df)
-    )
-    # count of each type of polling status_code
-    total_count_polling_status_code_3min_b4 = (
-        get_total_count_polling_status_code_3min_b4_order_creation_time(df)
-    )
-    total_count_polling_status_code_3min_after = (
-        get_total_count_polling_status_code_3min_after_order_creation_time(df)
-    )
-    total_count_polling_status_code_1hr_b4 = (
-        get_total_count_polling_status_code_1hr_before_order_creation_time(df)
+    offset = (df["polling_creation_time"] - df["order_creation_time"]).values.view("i8")
+    rows, window_ids = [], []
+    for window_id, window in enumerate(windows):
+        in_window = np.flatnonzero(
+            (offset >= -window.before.value) & (offset <= window.after.value)
+        )
+        rows.append(in_window)
+        window_ids.append(np.full(len(in_window), window_id, dtype="int16"))
+    rows = np.concatenate(rows) if rows else np.array([], dtype="int64")
+    membership = {
+        "window": np.concatenate(window_ids) if window_ids else rows,
+        "order_id": df["order_id"].values[rows],
+    }
+    for column in columns:
+        membership[column] = df[column].values[rows]
+    return pd.DataFrame(membership)
+
+
+def get_top_k(error: float) -> int:
+    """Returns the counters per order and window of a "top_k" aggregation
+    whose counts are at most `error` times the events of the window low"""
+    if not 0 < error < 1:
+        raise ValueError("the error of a code count must be in (0, 1)")
+    return max(1, int(np.ceil(1 / error)) - 1)
+
+
+def sketch_aggregations(
+    aggregations: List[Aggregation] = AGGREGATIONS, top_k: int = None
+) -> List[Aggregation]:
+    """Returns the aggregations with every "value_counts" replaced by a
+    "top_k" aggregation of `top_k` counters, unchanged when it is None"""
+    if top_k is None:
+        return aggregations
+    return [
+        a._replace(kind="top_k", top_k=top_k) if a.kind == "value_counts" else a
+        for a in aggregations
+    ]
+
+
+def merge_summaries(summary: DataFrame, counts: DataFrame, k: int) -> DataFrame:
+    """Adds value counts to a Misra-Gries summary, None when empty, of at
+    most `k` counters per (window, order_id): counters of the same value are summed, then
+    the (k + 1)th largest counter of a group is subtracted from all of
+    them and only the positive ones are kept"""
+    keys = ["window", "order_id"]
+    value = counts.columns[2]
+    if summary is not None:
+        counts = pd.concat([summary, counts], ignore_index=True)
+    summary = counts.groupby(keys + [value], sort=False)["count"].sum().reset_index()
+    rank = summary.groupby(keys, sort=False)["count"].rank(
+        method="first", ascending=False
     )
-    # The count of each type of polling error_code
-    total_count_polling_error_code_3min_b4 = (
-        get_count_error_code_3min_b4_order_creation_time(df)
+    cut = (
+        summary["count"]
+        .where(rank == k + 1, 0)
+        .groupby([summary[key] for key in keys], sort=False)
+        .transform("max")
     )
-    total_count_polling_error_code_3min_after = (
-        get_count_error_code_3min_after_order_creation_time(df)
+    summary["count"] -= cut
+    return summary[summary["count"] > 0]
+
+
+def sketch_value_counts(
+    df: DataFrame,
+    windows: List[Window],
+    aggregation: Aggregation,
+    chunk_rows: int = SKETCH_CHUNK_ROWS,
+) -> Dict[Tuple[str, str], DataFrame]:
+    """
+    Counts the values of a "top_k" aggregation with a Misra-Gries heavy
+    hitter summary per order and window, merged chunk by chunk of `df`, so
+    an order never holds more than `aggregation.top_k` counters whatever
+    the number of distinct values. A value seen in more than 1 / (k + 1)
+    of the events of a window is always kept, and a kept count is at most
+    that fraction of the events below the exact count. The events of the
+    dropped values, and what the kept counts miss, are reported under
+    `OTHER_CODE`, so the counts of a window add up to its events
+
+    Parameters
+    ----------
+    df: DataFrame : A dataframe with order_id, order_creation_time,
+        polling_creation_time and the aggregated column
+
+    windows: List[Window] : The windows to compute
+
+    aggregation: Aggregation : A "top_k" aggregation
+
+    chunk_rows: int : Rows of `df` summarised at a time
+         (Default value = SKETCH_CHUNK_ROWS)
+
+    Returns
+    -------
+    A dictionary of long format dataframes keyed by
+    (aggregation name, window name)
+    """
+    column, k = aggregation.column, aggregation.top_k
+    keys = ["window", "order_id"]
+    summary = totals = None
+    for start in range(0, max(len(df), 1), chunk_rows):
+        membership = get_window_membership(
+            df.iloc[start : start + chunk_rows], windows, [column]
+        )
+        membership = membership[membership[column].notna()]
+        counts = membership.groupby(keys + [column], sort=False).size()
+        summary = merge_summaries(summary, counts.reset_index(name="count"), k)
+        events = counts.groupby(level=keys, sort=False).sum()
+        totals = events if totals is None else totals.add(events, fill_value=0)
+    kept = summary.groupby(keys, sort=False)["count"].sum()
+    other = (totals - kept.reindex(totals.index, fill_value=0)).rename("count")
+    other = other[other > 0].reset_index()
+    if len(other):
+        other[column] = OTHER_CODE
+        summary = pd.concat([summary, other[summary.columns]], ignore_index=True)
+    logging.info(
+        f"{aggregation.name} kept {len(summary)} counters for "
+        f"{len(totals)} order windows, at most {k} codes and {OTHER_CODE} each"
     )
-    total_count_polling_error_code_1hr_b4 = (
-        get_count_error_code_1hr_b4_order_creation_time(df)
+
+    features = {}
+    for window_id, window in enumerate(windows):
+        name = feature_column_name(aggregation, window)
+        feature = (
+            summary[summary["window"] == window_id]
+            .drop(columns="window")
+            .rename(columns={"count": name})
+            .astype({"order_id": df["order_id"].dtype, name: "int64"})
+            .sort_values(name, ascending=False)
+            .reset_index(drop=True)
+        )
+        features[(aggregation.name, window.name)] = feature
+    return features
+
+
+@instrument
+def compute_window_features(
+    df: DataFrame,
+    windows: List[Window] = WINDOWS,
+    aggregations: List[Aggregation] = AGGREGATIONS,
+) -> Dict[Tuple[str, str], DataFrame]:
+    """Takes the merged polling/orders dataframe, builds every window
+    membership in one pass and derives all aggregations from a single
+    groupby over (window, order_id, aggregated columns)
+
+    Parameters
+    ----------
+    df: DataFrame : A dataframe with order_id, order_creation_time,
+        polling_creation_time and the aggregated columns
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The aggregations to run
+         (Default value = AGGREGATIONS)
+
+    Returns
+    -------
+    A dictionary of long format dataframes keyed by
+    (aggregation name, window name)
+    """
+    sketched = [a for a in aggregations if a.kind == "top_k"]
+    aggregations = [a for a in aggregations if a.kind != "top_k"]
+    columns = list(dict.fromkeys(a.column for a in aggregations if a.column))
+    membership = get_window_membership(df, windows, columns)
+    counts = membership.groupby(
+        ["window", "order_id"] + columns, dropna=False, sort=False
+    ).size()
+    logging.info(
+        f"{len(windows)} windows and {len(aggregations)} aggregations "
+        f"computed from {len(membership)} window memberships"
     )
-    # The count of response without error code
-    total_count_polling_no_error_code_3min_b4 = (
-        get_count_response_no_error_code_3min_b4_order_creation_time(df)
+    features = derive_window_features(counts, windows, aggregations)
+    for aggregation in sketched:
+        features.update(sketch_value_counts(df, windows, aggregation))
+    return features
+
+
+def derive_window_features(
+    counts: pd.Series,
+    windows: List[Window] = WINDOWS,
+    aggregations: List[Aggregation] = AGGREGATIONS,
+) -> Dict[Tuple[str, str], DataFrame]:
+    """Takes the number of window memberships per (window, order_id,
+    aggregated columns), in order of first appearance, and derives every
+    aggregation from it
+
+    Parameters
+    ----------
+    counts: pd.Series : Membership counts indexed by window (position in
+        `windows`), order_id and the aggregated columns
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The aggregations to run
+         (Default value = AGGREGATIONS)
+
+    Returns
+    -------
+    A dictionary of long format dataframes keyed by
+    (aggregation name, window name)
+    """
+    features = {}
+    for window_id, window in enumerate(windows):
+        if window_id in counts.index.get_level_values("window"):
+            window_counts = counts.xs(window_id, level="window")
+        else:
+            window_counts = counts.iloc[:0].droplevel("window")
+        for aggregation in aggregations:
+            name = feature_column_name(aggregation, window)
+            if aggregation.kind == "count":
+                group = ["order_id"]
+                subset = window_counts
+            elif aggregation.kind == "value_counts":
+                group = ["order_id", aggregation.column]
+                present = window_counts.index.get_level_values(aggregation.column)
+                subset = window_counts[~pd.isna(present)]
+            elif aggregation.kind == "null_count":
+                group = ["order_id"]
+                present = window_counts.index.get_level_values(aggregation.column)
+                subset = window_counts[pd.isna(present)]
+            else:
+                raise ValueError(f"Unknown aggregation kind {aggregation.kind}")
+            feature = (
+                subset.groupby(level=group, sort=False)
+                .sum()
+                .reset_index(name=name)
+                .sort_values(name, ascending=False)
+                .reset_index(drop=True)
+            )
+            if aggregation.kind == "null_count":
+                feature.insert(1, aggregation.column, "NOERRORRESPONSE")
+            features[(aggregation.name, window.name)] = feature
+    return features
+
+
+def combine_window_features(
+    batches: List[Dict[Tuple[str, str], DataFrame]],
+) -> Dict[Tuple[str, str], DataFrame]:
+    """Takes the features computed on disjoint batches of orders and
+    concatenates them into one set of features
+
+    Parameters
+    ----------
+    batches: List[Dict[Tuple[str, str], DataFrame]] : Outputs of
+        `compute_window_features`, one per batch of orders
+
+    Returns
+    -------
+    A dictionary of long format dataframes keyed by
+    (aggregation name, window name)
+    """
+    features = {}
+    for key in batches[0]:
+        feature = pd.concat([batch[key] for batch in batches], ignore_index=True)
+        value_column = feature.columns[-1]
+        features[key] = feature.sort_values(value_column, ascending=False).reset_index(
+            drop=True
+        )
+    return features
+
+
+@instrument
+def assemble_features(
+    features: Dict[Tuple[str, str], DataFrame],
+    orders: DataFrame,
+    windows: List[Window] = WINDOWS,
+    aggregations: List[Aggregation] = AGGREGATIONS,
+) -> DataFrame:
+    """Takes the output of `compute_window_features`, joins the windows of
+    every aggregation together and left joins them onto the orders. The
+    (aggregation, window) pairs missing from `features` are left out
+
+    Parameters
+    ----------
+    features: Dict[Tuple[str, str], DataFrame] : The computed features
+
+    orders: DataFrame : A dataframe of order_id
+
+    windows: List[Window] : The computed windows
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The computed aggregations
+         (Default value = AGGREGATIONS)
+
+    Returns
+    -------
+    A dataframe
+    """
+    main_data = orders
+    for aggregation in aggregations:
+        keys = ["order_id"] + ([aggregation.column] if aggregation.column else [])
+        computed = [w for w in windows if (aggregation.name, w.name) in features]
+        if not computed:
+            continue
+        combined = features[(aggregation.name, computed[0].name)]
+        for window in computed[1:]:
+            combined = combined.merge(
+                features[(aggregation.name, window.name)], on=keys
+            )
+        main_data = main_data.merge(combined, how="left", on="order_id")
+    main_data.replace(np.nan, 0, inplace=True)
+    main_data.sort_values("order_id", inplace=True)
+    return main_data
+
+
+@instrument
+def compute_wide_features(
+    df: DataFrame,
+    orders: DataFrame,
+    windows: List[Window] = WINDOWS,
+    aggregations: List[Aggregation] = AGGREGATIONS,
+) -> DataFrame:
+    """Takes the merged polling/orders dataframe and the orders, returns one
+    row per order with one column per (aggregation, window) and per
+    (window, status_code) / (window, error_code). Every aggregation is a
+    single bincount over integer encoded (window, value, order) keys
+
+    Parameters
+    ----------
+    df: DataFrame : A dataframe with order_id, order_creation_time,
+        polling_creation_time and the aggregated columns
+
+    orders: DataFrame : A dataframe of unique order_id
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The aggregations to run
+         (Default value = AGGREGATIONS)
+
+    Returns
+    -------
+    A dataframe
+    """
+    columns = list(dict.fromkeys(a.column for a in aggregations if a.column))
+    membership = get_window_membership(df, windows, columns)
+    order_ids = orders["order_id"].to_numpy()
+    n_orders, n_windows = len(order_ids), len(windows)
+    order_codes = pd.Index(order_ids).get_indexer(membership["order_id"])
+    known = order_codes >= 0
+    window_codes = membership["window"].to_numpy()[known].astype("int64")
+    order_codes = order_codes[known]
+
+    wide = {"order_id": order_ids}
+    for aggregation in aggregations:
+        if aggregation.kind == "value_counts":
+            value_codes, values = pd.factorize(
+                membership[aggregation.column].to_numpy()[known], sort=True
+            )
+            present = value_codes >= 0
+            counts = np.bincount(
+                (window_codes[present] * len(values) + value_codes[present]) * n_orders
+                + order_codes[present],
+                minlength=n_windows * len(values) * n_orders,
+            ).reshape(n_windows, len(values), n_orders)
+            for window_id, window in enumerate(windows):
+                for value_id, value in enumerate(values):
+                    name = f"{aggregation.column}_{value}_{window.name}"
+                    wide[name] = counts[window_id, value_id]
+            continue
+        if aggregation.kind == "count":
+            selected = np.ones(len(order_codes), dtype=bool)
+        elif aggregation.kind == "null_count":
+            selected = pd.isna(membership[aggregation.column].to_numpy()[known])
+        else:
+            raise ValueError(f"Unknown aggregation kind {aggregation.kind}")
+        counts = np.bincount(
+            window_codes[selected] * n_orders + order_codes[selected],
+            minlength=n_windows * n_orders,
+        ).reshape(n_windows, n_orders)
+        for window_id, window in enumerate(windows):
+            wide[f"{aggregation.name}_{window.name}"] = counts[window_id]
+    main_data = pd.DataFrame(wide)
+    main_data.sort_values("order_id", inplace=True)
+    return main_data
+
+
+# connectivity status features
+
+ONLINE_STATUS = "ONLINE"
+# per window columns of `compute_connectivity_features`
+CONNECTIVITY_METRICS = ["seconds_online", "seconds_offline", "status_transitions"]
+
+
+@instrument
+def compute_connectivity_features(
+    connectivity: DataFrame, orders: DataFrame, windows: List[Window] = WINDOWS
+) -> DataFrame:
+    """Takes the connectivity status changes and the orders, returns one row
+    per order with the seconds spent online and offline and the number of
+    status transitions inside every window.
+
+    The status of a device holds from one status change to the next. The
+    changes are sorted per device once, prefix sums of online time and of
+    transitions are taken over them and every window bound is located with
+    a binary search, so no order is crossed with the status changes
+
+    Parameters
+    ----------
+    connectivity: DataFrame : A dataframe with device_id,
+        connectivity_creation_time and status
+
+    orders: DataFrame : A dataframe with device_id, order_id and
+        order_creation_time
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    Returns
+    -------
+    A dataframe
+    """
+    codes, _ = pd.factorize(
+        pd.concat([connectivity["device_id"], orders["device_id"]], ignore_index=True)
     )
-    total_count_polling_no_error_code_3min_after = (
-        get_count_response_no_error_code_3min_after_order_creation_time(df)
+    event_codes = codes[: len(connectivity)]
+    order_codes = codes[len(connectivity) :]
+    times = connectivity["connectivity_creation_time"].values.view("i8")
+    sort = np.lexsort((times, event_codes))
+    sort = sort[event_codes[sort] >= 0]
+    event_codes, times = event_codes[sort], times[sort]
+    status = connectivity["status"].to_numpy()[sort]
+    online = (pd.Series(status).str.upper() == ONLINE_STATUS).to_numpy()
+
+    # time to the next change of the same device, and whether a change flips
+    same_device = event_codes[1:] == event_codes[:-1]
+    duration = np.where(same_device, np.diff(times), 0)
+    online_before = np.concatenate([[0], np.cumsum(duration * online[:-1])])
+    flips = np.concatenate([[0], same_device & (status[1:] != status[:-1])])
+    transitions = np.cumsum(flips)
+
+    features = {"order_id": orders["order_id"].to_numpy()}
+    order_times = orders["order_creation_time"].values.view("i8")
+    segment_start = np.searchsorted(event_codes, order_codes, side="left")
+    segment_stop = np.searchsorted(event_codes, order_codes, side="right")
+    has_events = (order_codes >= 0) & (segment_start < segment_stop)
+    # orders of devices without status changes point at a dummy position
+    segment_start = np.where(has_events, segment_start, 0)
+    if not len(times):
+        times = online = online_before = transitions = np.zeros(1, dtype="int64")
+
+    def last_change(bound, side):
+        """Position of the last change at or before (side="right") or
+        strictly before (side="left") `bound`, clamped to the first change"""
+        position = segmented_searchsorted(
+            event_codes, times, order_codes, bound, side=side
+        )
+        return np.maximum(position - 1, segment_start)
+
+    def online_until(bound):
+        """Online and known nanoseconds from the first change to `bound`"""
+        bound = np.maximum(bound, times[segment_start])
+        position = last_change(bound, "right")
+        online_time = online_before[position] + (bound - times[position]) * (
+            online[position]
+        )
+        return online_time, bound - times[segment_start]
+
+    for window in windows:
+        start = order_times - window.before.value
+        stop = order_times + window.after.value
+        online_start, known_start = online_until(start)
+        online_stop, known_stop = online_until(stop)
+        online_time = np.where(has_events, online_stop - online_start, 0) / 1e9
+        known_time = np.where(has_events, known_stop - known_start, 0) / 1e9
+        flipped = (
+            transitions[last_change(stop, "right")]
+            - transitions[last_change(start, "left")]
+        )
+        # keep in sync with CONNECTIVITY_METRICS
+        features[f"seconds_online_{window.name}"] = online_time
+        features[f"seconds_offline_{window.name}"] = known_time - online_time
+        features[f"status_transitions_{window.name}"] = np.where(has_events, flipped, 0)
+    logging.info(f"Connectivity features computed for {len(orders)} orders")
+    return pd.DataFrame(features)
+
+
+class FeatureSelection(NamedTuple):
+    """The features of a partial run, see `select_features`"""
+
+    windows: List[Window]
+    aggregations: List[Aggregation]
+    pairs: List[Tuple[str, str]]
+    connectivity_windows: List[Window]
+    connectivity_columns: List[str]
+
+
+def get_feature_catalogue(
+    windows: List[Window] = WINDOWS, aggregations: List[Aggregation] = AGGREGATIONS
+) -> Dict[str, List[Tuple[str, str]]]:
+    """Returns every feature name `select_features` accepts, with the
+    (aggregation or connectivity metric, window name) pairs it stands for"""
+    catalogue = {}
+    for aggregation in aggregations:
+        catalogue[aggregation.name] = [(aggregation.name, w.name) for w in windows]
+        for window in windows:
+            pair = [(aggregation.name, window.name)]
+            catalogue[f"{aggregation.name}_{window.name}"] = pair
+            catalogue.setdefault(feature_column_name(aggregation, window), pair)
+    for metric in CONNECTIVITY_METRICS:
+        catalogue[metric] = [(metric, w.name) for w in windows]
+        for window in windows:
+            catalogue[f"{metric}_{window.name}"] = [(metric, window.name)]
+    catalogue["connectivity"] = [
+        (metric, w.name) for metric in CONNECTIVITY_METRICS for w in windows
+    ]
+    return catalogue
+
+
+def select_features(
+    names: List[str],
+    windows: List[Window] = WINDOWS,
+    aggregations: List[Aggregation] = AGGREGATIONS,
+) -> FeatureSelection:
+    """
+    Resolves feature names into the windows, aggregations and connectivity
+    windows a partial run has to compute. A name is an aggregation
+    (every window of it), an aggregation and a window, e.g.
+    "status_code_count_1hr_b4", an output column of the full run, a
+    connectivity metric with or without a window, or "connectivity"
+
+    Parameters
+    ----------
+    names: List[str] : The requested features
+
+    windows: List[Window] : The windows to choose from
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The aggregations to choose from
+         (Default value = AGGREGATIONS)
+
+    Returns
+    -------
+    A FeatureSelection, in the order of `windows` and `aggregations`
+    """
+    catalogue = get_feature_catalogue(windows, aggregations)
+    unknown = [name for name in names if name not in catalogue]
+    if unknown:
+        raise ValueError(f"Unknown features {unknown}, choose from {sorted(catalogue)}")
+    requested = {pair for name in names for pair in catalogue[name]}
+    pairs = [
+        (a.name, w.name)
+        for a in aggregations
+        for w in windows
+        if (a.name, w.name) in requested
+    ]
+    connectivity_pairs = [
+        (metric, w.name)
+        for w in windows
+        for metric in CONNECTIVITY_METRICS
+        if (metric, w.name) in requested
+    ]
+    window_names = {window for _, window in pairs}
+    connectivity_window_names = {window for _, window in connectivity_pairs}
+    selection = FeatureSelection(
+        windows=[w for w in windows if w.name in window_names],
+        aggregations=[a for a in aggregations if a.name in {n for n, _ in pairs}],
+        pairs=pairs,
+        connectivity_windows=[
+            w for w in windows if w.name in connectivity_window_names
+        ],
+        connectivity_columns=[f"{m}_{w}" for m, w in connectivity_pairs],
     )
-    total_count_polling_no_error_code_1hr_b4 = (
-        get_count_response_no_error_code_1hr_b4_order_creation_time(df)
+    logging.info(
+        f"Selected {len(pairs)} polling features over "
+        f"{[w.name for w in selection.windows]} and "
+        f"{len(connectivity_pairs)} connectivity features"
     )
+    return selection
 
-    polling_events = total_count_polling_event_3min_b4.merge(
-        total_count_polling_event_3min_after, on="order_id"
-    ).merge(total_count_polling_event_1hr_b4, on="order_id")
-    status_code_count = total_count_polling_status_code_3min_b4.merge(
-        total_count_polling_status_code_3min_after, on=["order_id", "status_code"]
-    ).merge(total_count_polling_status_code_1hr_b4, on=["order_id", "status_code"])
-    error_code_count = total_count_polling_error_code_3min_b4.merge(
-        total_count_polling_error_code_3min_after, on=["order_id", "error_code"]
-    ).merge(total_count_polling_error_code_1hr_b4, on=["order_id", "error_code"])
-    no_error_code_count = total_count_polling_no_error_code_3min_b4.merge(
-        total_count_polling_no_error_code_3min_after, on=["order_id", "error_code"]
-    ).merge(total_count_polling_no_error_code_1hr_b4, on=["order_id", "error_code"])
-
-    main_data = (
-        orders.merge(polling_events, how="left", on="order_id")
-        .merge(status_code_count, how="left", on="order_id")
-        .merge(error_code_count, how="left", on="order_id")
-        .merge(no_error_code_count, how='left', on='order_id')
-    )
-    main_data.replace(np.nan, 0, inplace=True)
-    main_data.sort_values("order_id", inplace=True)
-    df.to_csv("input_data.csv", index=False)
-    main_data.to_csv("output_data.csv", index=False)
+
+def compute_features(
+    df: DataFrame,
+    orders: DataFrame,
+    windows: List[Window] = WINDOWS,
+    aggregations: List[Aggregation] = AGGREGATIONS,
+    output_format: str = "long",
+    connectivity_features: DataFrame = None,
+    selection: FeatureSelection = None,
+) -> DataFrame:
+    """Takes the merged polling/orders dataframe and the orders, returns the
+    features of `get_all_feature` without writing them
+
+    Parameters
+    ----------
+    df: DataFrame : A dataframe with order_id, order_creation_time,
+        polling_creation_time and the aggregated columns
+
+    orders: DataFrame : A dataframe of order_id
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The aggregations to run
+         (Default value = AGGREGATIONS)
+
+    output_format: str : "long" or "wide", see `get_all_feature`
+         (Default value = "long")
+
+    connectivity_features: DataFrame : Per order features joined onto the
+        output
+         (Default value = None)
+
+    selection: FeatureSelection : Only compute these features, it replaces
+        `windows` and `aggregations`, `df` may be None when it has no
+        polling features
+         (Default value = None, every window and aggregation)
+
+    Returns
+    -------
+    A dataframe
+    """
+    if selection is not None:
+        windows, aggregations = selection.windows, selection.aggregations
+    if output_format == "wide":
+        orders = orders.drop_duplicates("order_id")
+        if selection is None:
+            main_data = compute_wide_features(df, orders, windows, aggregations)
+        else:
+            main_data = orders.sort_values("order_id")
+            # aggregations over the same windows share one membership pass
+            groups = {}
+            for aggregation in aggregations:
+                names = tuple(w for a, w in selection.pairs if a == aggregation.name)
+                groups.setdefault(names, []).append(aggregation)
+            for names, group in groups.items():
+                wide = compute_wide_features(
+                    df, orders, [w for w in windows if w.name in names], group
+                )
+                main_data = main_data.merge(wide, on="order_id", sort=False)
+    else:
+        if aggregations:
+            features = compute_window_features(df, windows, aggregations)
+        else:
+            features = {}
+        if selection is not None:
+            features = {pair: features[pair] for pair in selection.pairs}
+        main_data = assemble_features(features, orders, windows, aggregations)
+    if connectivity_features is not None:
+        main_data = main_data.merge(connectivity_features, how="left", on="order_id")
+    return main_data
+
+
+# implement all function defined here
+
+
+@instrument
+def get_all_feature(
+    df: DataFrame,
+    orders: DataFrame,
+    windows: List[Window] = WINDOWS,
+    aggregations: List[Aggregation] = AGGREGATIONS,
+    output_format: str = "long",
+    connectivity_features: DataFrame = None,
+    output: OutputConfig = DEFAULT_OUTPUT,
+    selection: FeatureSelection = None,
+) -> DataFrame:
+    """Takes a dataframe and a series of order_id, computes every window
+    and aggregation with the single pass engine and saves the input and
+    output data at current directory.
+
+    Parameters
+    ----------
+    df: DataFrame :
+
+    orders: DataFrame :
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The aggregations to run
+         (Default value = AGGREGATIONS)
+
+    output_format: str : "long" keeps one row per order and status_code /
+        error_code combination, "wide" returns one row per order with a
+        column per window and code
+         (Default value = "long")
+
+    connectivity_features: DataFrame : Per order features joined onto the
+        output, e.g. from `compute_connectivity_features`
+         (Default value = None)
+
+    output: OutputConfig : The format, partitioning and input dump of the
+        written files
+         (Default value = DEFAULT_OUTPUT, csv)
+
+    selection: FeatureSelection : Only compute these features, see
+        `select_features`, `df` is None when it has no polling features
+         (Default value = None, every window and aggregation)
+
+    Returns
+    -------
+    A dataframe
+    """
+    with OutputWriter(output) as writer:
+        # the input dump is serialised while the features are computed
+        input_dump = None if df is None else select_input_dump(df, output)
+        if input_dump is not None:
+            writer.write(input_dump, "input_data")
+        main_data = compute_features(
+            df,
+            orders,
+            windows,
+            aggregations,
+            output_format,
+            connectivity_features,
+            selection,
+        )
+        writer.write(main_data, "output_data")
     return main_data
@@ -0,0 +1,463 @@
+import argparse
+import logging
+from typing import List
+
+import numpy as np
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+from instrumentation import configure_logging, instrument
+from helpers import read_data, rename_field
+from etl import WINDOWS, AGGREGATIONS, Aggregation, Window
+
+# polling columns with one prefix count per value, and one for missing values
+INDEX_COLUMNS = ["status_code", "error_code"]
+
+
+def count_dtype(rows: int) -> np.dtype:
+    """Returns the smallest unsigned type holding a count of `rows`"""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if rows <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+class DeviceEvents:
+    """The events of one device: sorted int64 timestamps, the index slots
+    the device has seen in `slots` (global slot ids, sorted) and, for
+    every one of them, the number of events of that slot among the first
+    i events in row i of `prefix`. Arrays keep spare capacity past `size`
+    so that appends in time order are amortised"""
+
+    __slots__ = ("times", "slots", "prefix", "size")
+
+    def __init__(self, times: np.ndarray, codes: np.ndarray):
+        self.times = times
+        self.slots = np.unique(codes)
+        dtype = count_dtype(len(times))
+        self.prefix = np.zeros((len(times) + 1, len(self.slots)), dtype)
+        np.cumsum(self.local_hits(codes, dtype), axis=0, out=self.prefix[1:])
+        self.size = len(times)
+
+    def local_hits(self, codes: np.ndarray, dtype: np.dtype) -> np.ndarray:
+        """Returns the 0/1 indicators of the device slots of events given by
+        their global slot codes, one row per event"""
+        hits = np.zeros((len(codes), len(self.slots)), dtype=dtype)
+        rows = np.repeat(np.arange(len(codes)), codes.shape[1])
+        hits[rows, np.searchsorted(self.slots, codes.ravel())] = 1
+        return hits
+
+    def codes(self) -> np.ndarray:
+        """Returns the global slot codes of every event back from the prefix
+        counts, one row per event in slot order"""
+        hits = np.diff(self.prefix[: self.size + 1], axis=0)
+        rows, columns = np.nonzero(hits)
+        return self.slots[columns].reshape(self.size, -1)
+
+    def extend(self, times: np.ndarray, codes: np.ndarray) -> None:
+        """Appends events at or after the last timestamp of the device"""
+        size = self.size + len(times)
+        slots = np.union1d(self.slots, codes)
+        if (
+            size > len(self.times)
+            or len(slots) > len(self.slots)
+            or size > np.iinfo(self.prefix.dtype).max
+        ):
+            capacity = len(self.times)
+            if size > capacity:
+                capacity = max(size, 2 * capacity)
+            grown_times = np.empty(capacity, dtype=np.int64)
+            grown_times[: self.size] = self.times[: self.size]
+            grown = np.zeros((capacity + 1, len(slots)), count_dtype(capacity))
+            grown[: self.size + 1, np.searchsorted(slots, self.slots)] = self.prefix[
+                : self.size + 1
+            ]
+            self.times, self.slots, self.prefix = grown_times, slots, grown
+        self.times[self.size : size] = times
+        self.prefix[self.size + 1 : size + 1] = self.prefix[self.size] + np.cumsum(
+            self.local_hits(codes, self.prefix.dtype), axis=0, dtype=self.prefix.dtype
+        )
+        self.size = size
+
+    def window(self, start: int, stop: int) -> tuple:
+        """Returns the positions bounding the events in [start, stop], two
+        binary searches"""
+        times = self.times[: self.size]
+        return (
+            np.searchsorted(times, start, side="left"),
+            np.searchsorted(times, stop, side="right"),
+        )
+
+    def local_slot(self, slot: int):
+        """Returns the column of a global slot in `prefix`, None when the
+        device has not seen it"""
+        position = int(np.searchsorted(self.slots, slot))
+        if position < len(self.slots) and self.slots[position] == slot:
+            return position
+        return None
+
+    def nbytes(self) -> int:
+        """Returns the memory held by the arrays, spare capacity included"""
+        return self.times.nbytes + self.slots.nbytes + self.prefix.nbytes
+
+
+class DeviceEventIndex:
+    """
+    In-memory index of the polling events of every device, for online
+    lookups of the polling features of one order. Every status_code /
+    error_code value (and missing value) is a global slot. Per device,
+    timestamps are sorted and every slot the device has seen has a prefix
+    count array, so the count of any value in any window is a difference
+    of two rows found with two binary searches. Devices only store the
+    slots they have seen, with a map from their columns to the global
+    slots, and counts use the smallest unsigned type of the device size
+
+    Parameters
+    ----------
+    columns: List[str] : The columns with per value counts
+         (Default value = INDEX_COLUMNS)
+
+    time_column: str : The event timestamp column
+         (Default value = "polling_creation_time")
+    """
+
+    def __init__(
+        self,
+        columns: List[str] = INDEX_COLUMNS,
+        time_column: str = "polling_creation_time",
+    ):
+        self.columns = list(columns)
+        self.time_column = time_column
+        # (column, value) of every prefix count slot, value None for missing
+        self.slots = []
+        self.slot_ids = {}
+        self.devices = {}
+        for column in self.columns:
+            self.slot(column, None)
+
+    @classmethod
+    def from_frame(
+        cls,
+        df: DataFrame,
+        columns: List[str] = INDEX_COLUMNS,
+        time_column: str = "polling_creation_time",
+    ) -> "DeviceEventIndex":
+        """Builds the index of a polling dataframe with device_id,
+        `time_column` and `columns`"""
+        index = cls(columns, time_column)
+        index.append(df)
+        return index
+
+    def slot(self, column: str, value) -> int:
+        """Returns the slot of a value of a column, adding unseen values"""
+        key = (column, None if pd.isna(value) else value)
+        if key not in self.slot_ids:
+            self.slot_ids[key] = len(self.slots)
+            self.slots.append(key)
+        return self.slot_ids[key]
+
+    def encode(self, df: DataFrame) -> np.ndarray:
+        """Returns the slot of every column of every event, one row per
+        event and one column per indexed column"""
+        codes = []
+        for column in self.columns:
+            value_codes, values = pd.factorize(df[column])
+            mapping = np.array(
+                [self.slot(column, value) for value in values]
+                + [self.slot(column, None)],
+                dtype=np.int64,
+            )
+            # missing values have code -1, which picks the trailing slot
+            codes.append(mapping[value_codes])
+        return np.stack(codes, axis=1)
+
+    @instrument
+    def append(self, events: DataFrame) -> int:
+        """
+        Adds polling events to the index. Events at or after the last event
+        of their device are appended to its arrays, a device receiving late
+        events has its arrays rebuilt in time order
+
+        Parameters
+        ----------
+        events: DataFrame : Polling events with device_id, `time_column`
+            and `columns`
+
+        Returns
+        -------
+        The number of events added, events without device_id are skipped
+        """
+        events = events[events["device_id"].notna()]
+        if not len(events):
+            return 0
+        codes = self.encode(events)
+        device_codes, device_ids = pd.factorize(events["device_id"])
+        times = events[self.time_column].values.view("i8")
+        order = np.lexsort((times, device_codes))
+        device_codes, times, codes = device_codes[order], times[order], codes[order]
+        starts = np.flatnonzero(np.diff(device_codes, prepend=-1))
+        stops = np.append(starts[1:], len(device_codes))
+        late = 0
+        for start, stop in zip(starts, stops):
+            device_id = device_ids[device_codes[start]]
+            device = self.devices.get(device_id)
+            if device is None:
+                self.devices[device_id] = DeviceEvents(
+                    times[start:stop].copy(), codes[start:stop]
+                )
+            elif device.size == 0 or times[start] >= device.times[device.size - 1]:
+                device.extend(times[start:stop], codes[start:stop])
+            else:
+                late += 1
+                merged_times = np.concatenate(
+                    [device.times[: device.size], times[start:stop]]
+                )
+                merged_codes = np.concatenate([device.codes(), codes[start:stop]])
+                by_time = np.argsort(merged_times, kind="stable")
+                self.devices[device_id] = DeviceEvents(
+                    merged_times[by_time], merged_codes[by_time]
+                )
+        logging.info(
+            f"{len(events)} events indexed for {len(starts)} devices, "
+            f"{late} devices rebuilt for late events"
+        )
+        return len(events)
+
+    def trim(self, before) -> int:
+        """Drops the events older than `before`, e.g. the order time of the
+        oldest pending order minus the largest lookback, returns the number
+        of events dropped"""
+        bound = pd.Timestamp(before).value
+        dropped = 0
+        for device_id, device in list(self.devices.items()):
+            keep = np.searchsorted(device.times[: device.size], bound, side="left")
+            if keep == 0:
+                continue
+            dropped += keep
+            if keep == device.size:
+                del self.devices[device_id]
+                continue
+            self.devices[device_id] = DeviceEvents(
+                device.times[keep : device.size].copy(), device.codes()[keep:]
+            )
+        return dropped
+
+    def count(
+        self,
+        device_id,
+        order_time,
+        window: Window,
+        column: str = None,
+        value=None,
+    ) -> int:
+        """
+        Returns the number of events of a device inside a window around an
+        order time
+
+        Parameters
+        ----------
+        device_id : The device
+
+        order_time : The order creation time, anything `pd.Timestamp` takes
+
+        window: Window : The window, both ends inclusive
+
+        column: str : Only count the events where `column` is `value`
+             (Default value = None, every event)
+
+        value : The value of `column` to count, None for missing values
+             (Default value = None)
+
+        Returns
+        -------
+        An int
+        """
+        device = self.devices.get(device_id)
+        if device is None:
+            return 0
+        time = pd.Timestamp(order_time).value
+        start, stop = device.window(
+            time - window.before.value, time + window.after.value
+        )
+        if column is None:
+            return int(stop - start)
+        slot = self.slot_ids.get((column, None if pd.isna(value) else value))
+        slot = None if slot is None else device.local_slot(slot)
+        if slot is None:
+            return 0
+        return int(device.prefix[stop, slot]) - int(device.prefix[start, slot])
+
+    def window_counts(self, device_id, order_time, window: Window) -> tuple:
+        """Returns the event count and the int64 count of every slot of a
+        device inside a window around an order time"""
+        counts = np.zeros(len(self.slots), dtype=np.int64)
+        device = self.devices.get(device_id)
+        if device is None:
+            return 0, counts
+        time = pd.Timestamp(order_time).value
+        start, stop = device.window(
+            time - window.before.value, time + window.after.value
+        )
+        counts[device.slots] = device.prefix[stop].astype(np.int64) - device.prefix[
+            start
+        ].astype(np.int64)
+        return int(stop - start), counts
+
+    def feature_slots(self, aggregations: List[Aggregation] = AGGREGATIONS) -> list:
+        """Returns (name prefix, slot) of every wide feature column, slot
+        None for the event count, in the column order of
+        `compute_wide_features`"""
+        features = []
+        for aggregation in aggregations:
+            if aggregation.kind == "count":
+                features.append((aggregation.name, None))
+            elif aggregation.kind == "null_count":
+                features.append((aggregation.name, self.slot(aggregation.column, None)))
+            elif aggregation.kind == "value_counts":
+                values = sorted(
+                    value
+                    for column, value in self.slots
+                    if column == aggregation.column and value is not None
+                )
+                for value in values:
+                    features.append(
+                        (
+                            f"{aggregation.column}_{value}",
+                            self.slot_ids[(aggregation.column, value)],
+                        )
+                    )
+            else:
+                raise ValueError(f"Unknown aggregation kind {aggregation.kind}")
+        return features
+
+    def features(
+        self,
+        device_id,
+        order_time,
+        windows: List[Window] = WINDOWS,
+        aggregations: List[Aggregation] = AGGREGATIONS,
+    ) -> dict:
+        """
+        Returns the polling features of one order, named like the columns
+        of `compute_wide_features`, e.g. `status_code_200_1hr_b4`
+
+        Parameters
+        ----------
+        device_id : The device the order is dispatched to
+
+        order_time : The order creation time, anything `pd.Timestamp` takes
+
+        windows: List[Window] : The windows to compute
+             (Default value = WINDOWS)
+
+        aggregations: List[Aggregation] : The aggregations to run
+             (Default value = AGGREGATIONS)
+
+        Returns
+        -------
+        A dictionary of feature name to count
+        """
+        by_window = [
+            self.window_counts(device_id, order_time, window) for window in windows
+        ]
+        features = {}
+        for name, slot in self.feature_slots(aggregations):
+            for window, (total, counts) in zip(windows, by_window):
+                features[f"{name}_{window.name}"] = (
+                    total if slot is None else int(counts[slot])
+                )
+        return features
+
+    @instrument
+    def lookup(
+        self,
+        orders: DataFrame,
+        windows: List[Window] = WINDOWS,
+        aggregations: List[Aggregation] = AGGREGATIONS,
+    ) -> DataFrame:
+        """
+        Returns the polling features of a batch of orders, one row per
+        order in the layout of `compute_wide_features`. The orders of a
+        device are located with one vectorised binary search per window
+        bound
+
+        Parameters
+        ----------
+        orders: DataFrame : A dataframe with order_id, device_id and
+            order_creation_time
+
+        windows: List[Window] : The windows to compute
+             (Default value = WINDOWS)
+
+        aggregations: List[Aggregation] : The aggregations to run
+             (Default value = AGGREGATIONS)
+
+        Returns
+        -------
+        A dataframe
+        """
+        n_orders, n_slots = len(orders), len(self.slots)
+        totals = np.zeros((len(windows), n_orders), dtype=np.int64)
+        counts = np.zeros((len(windows), n_slots, n_orders), dtype=np.int64)
+        order_times = orders["order_creation_time"].values.view("i8")
+        device_codes, device_ids = pd.factorize(orders["device_id"])
+        for code, device_id in enumerate(device_ids):
+            device = self.devices.get(device_id)
+            if device is None:
+                continue
+            rows = np.flatnonzero(device_codes == code)
+            for window_id, window in enumerate(windows):
+                start, stop = device.window(
+                    order_times[rows] - window.before.value,
+                    order_times[rows] + window.after.value,
+                )
+                totals[window_id, rows] = stop - start
+                counts[window_id][np.ix_(device.slots, rows)] = (
+                    device.prefix[stop].astype(np.int64)
+                    - device.prefix[start].astype(np.int64)
+                ).T
+
+        wide = {"order_id": orders["order_id"].to_numpy()}
+        for aggregation in aggregations:
+            slots = self.feature_slots([aggregation])
+            for window_id, window in enumerate(windows):
+                for name, slot in slots:
+                    wide[f"{name}_{window.name}"] = (
+                        totals[window_id] if slot is None else counts[window_id, slot]
+                    )
+        main_data = pd.DataFrame(wide)
+        main_data.sort_values("order_id", inplace=True)
+        return main_data
+
+    def nbytes(self) -> int:
+        """Returns the memory held by the arrays of every device"""
+        return sum(device.nbytes() for device in self.devices.values())
+
+
+def parse_args():
+    """Parses the command line options of the event index"""
+    parser = argparse.ArgumentParser(
+        description="Index polling events per device and look up the "
+        "polling features of one order"
+    )
+    parser.add_argument("--path", default="appEventProcessingDataset/dataset/")
+    parser.add_argument("--device", required=True, help="device_id of the order")
+    parser.add_argument("--time", required=True, help="order creation time")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    configure_logging()
+    args = parse_args()
+    polling = rename_field(
+        read_data(args.path, "polling.csv", "creation_time"),
+        "polling_creation_time",
+    )
+    index = DeviceEventIndex.from_frame(polling)
+    logging.info(
+        f"Index of {len(index.devices)} devices holds {index.nbytes() / 1024**2:.1f}"
+        f" MB, the polling frame "
+        f"{polling.memory_usage(deep=True).sum() / 1024**2:.1f} MB"
+    )
+    for name, value in index.features(args.device, args.time).items():
+        print(f"{name}: {value}")
@@ -0,0 +1,199 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import configure_logging
+
+STATUS_CODES = [200, 204, 304, 400, 401, 404, 429, 500, 502, 503, 504]
+ERROR_CODES = [
+    "ECONNRESET",
+    "ETIMEDOUT",
+    "ECONNREFUSED",
+    "EHOSTUNREACH",
+    "ENETUNREACH",
+    "EAI_AGAIN",
+    "EPIPE",
+    "SSL_ERROR",
+]
+START_TIME = pd.Timestamp("2021-03-01")
+
+
+def zipf_weights(n: int, skew: float) -> np.ndarray:
+    """Returns normalised weights proportional to 1 / rank ** skew"""
+    weights = 1.0 / np.arange(1, n + 1) ** skew
+    return weights / weights.sum()
+
+
+def write_csv(df: pd.DataFrame, path: str, first: bool, offset: int) -> None:
+    """Appends a block to a csv file, with the index column the raw exports
+    carry as `Unnamed: 0`"""
+    df.index = np.arange(offset, offset + len(df))
+    df.to_csv(
+        path,
+        mode="w" if first else "a",
+        header=first,
+        date_format="%Y-%m-%d %H:%M:%S",
+    )
+
+
+def generate_dataset(
+    path: str = "appEventProcessingDataset/dataset/",
+    devices: int = 1000,
+    hours: int = 24,
+    polling_rate: float = 60.0,
+    order_rate: float = 1.0,
+    connectivity_rate: float = 2.0,
+    code_skew: float = 1.2,
+    error_codes: int = 50,
+    error_rate: float = 0.3,
+    missing_device_rate: float = 0.01,
+    seed: int = 0,
+) -> dict:
+    """
+    Writes synthetic orders.csv, polling.csv and connectivity_status.csv
+    with the layout of the raw exports. Events are generated one hour at a
+    time and written in time order, so any size fits in memory
+
+    Parameters
+    ----------
+    path: str : The output directory
+         (Default value = "appEventProcessingDataset/dataset/")
+
+    devices: int : The number of devices
+         (Default value = 1000)
+
+    hours: int : The time span in hours
+         (Default value = 24)
+
+    polling_rate: float : Polling events per device per hour
+         (Default value = 60.0)
+
+    order_rate: float : Orders per device per hour
+         (Default value = 1.0)
+
+    connectivity_rate: float : Connectivity status changes per device per hour
+         (Default value = 2.0)
+
+    code_skew: float : Zipf exponent of the status_code and error_code
+        frequencies, 0 is uniform
+         (Default value = 1.2)
+
+    error_codes: int : The number of distinct error codes, the long tail
+        past the common ones is named E<n>
+         (Default value = 50)
+
+    error_rate: float : Share of polling events with an error_code
+         (Default value = 0.3)
+
+    missing_device_rate: float : Share of orders without a device_id
+         (Default value = 0.01)
+
+    seed: int : The random seed
+         (Default value = 0)
+
+    Returns
+    -------
+    A dictionary with the number of rows written per file
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(path, exist_ok=True)
+    device_ids = np.array([f"{i:08x}" for i in rng.permutation(devices * 16)[:devices]])
+    # busy devices poll more often, with the same skew as the codes
+    device_weights = zipf_weights(devices, code_skew / 2)
+    status_weights = zipf_weights(len(STATUS_CODES), code_skew)
+    error_names = np.array(
+        ERROR_CODES[:error_codes]
+        + [f"E{n}" for n in range(max(error_codes - len(ERROR_CODES), 0))]
+    )
+    error_weights = zipf_weights(len(error_names), code_skew)
+    online = rng.random(devices) < 0.8
+
+    rows = {"orders.csv": 0, "polling.csv": 0, "connectivity_status.csv": 0}
+    order_id = 1
+    for hour in range(hours):
+        first = hour == 0
+        hour_start = START_TIME + pd.Timedelta(hours=hour)
+
+        def timestamps(n):
+            seconds = np.sort(rng.integers(0, 3600, n))
+            return hour_start + pd.to_timedelta(seconds, unit="s")
+
+        n_polling = rng.poisson(polling_rate * devices)
+        polling = pd.DataFrame(
+            {
+                "device_id": rng.choice(device_ids, n_polling, p=device_weights),
+                "creation_time": timestamps(n_polling),
+                "error_code": np.where(
+                    rng.random(n_polling) < error_rate,
+                    rng.choice(error_names, n_polling, p=error_weights),
+                    None,
+                ),
+                "status_code": rng.choice(STATUS_CODES, n_polling, p=status_weights),
+            }
+        )
+        write_csv(polling, path + "polling.csv", first, rows["polling.csv"])
+        rows["polling.csv"] += n_polling
+
+        n_orders = rng.poisson(order_rate * devices)
+        orders = pd.DataFrame(
+            {
+                "order_id": np.arange(order_id, order_id + n_orders),
+                "device_id": rng.choice(device_ids, n_orders, p=device_weights),
+                "order_creation_time": timestamps(n_orders),
+            }
+        )
+        orders.loc[rng.random(n_orders) < missing_device_rate, "device_id"] = None
+        write_csv(orders, path + "orders.csv", first, rows["orders.csv"])
+        rows["orders.csv"] += n_orders
+        order_id += n_orders
+
+        n_changes = rng.poisson(connectivity_rate * devices)
+        changed = rng.integers(0, devices, n_changes)
+        # every change flips the status of its device
+        flip_number = pd.Series(changed).groupby(changed).cumcount().to_numpy() + 1
+        statuses = np.where(
+            online[changed] ^ (flip_number % 2 == 1), "ONLINE", "OFFLINE"
+        )
+        online ^= np.bincount(changed, minlength=devices) % 2 == 1
+        connectivity = pd.DataFrame(
+            {
+                "device_id": device_ids[changed],
+                "creation_time": timestamps(n_changes),
+                "status": statuses,
+            }
+        )
+        write_csv(
+            connectivity,
+            path + "connectivity_status.csv",
+            first,
+            rows["connectivity_status.csv"],
+        )
+        rows["connectivity_status.csv"] += n_changes
+    logging.info(f"Synthetic dataset written to {path}: {rows}")
+    return rows
+
+
+def parse_args():
+    """Parses the command line options of the generator"""
+    parser = argparse.ArgumentParser(description="Generate a synthetic dataset")
+    parser.add_argument("--path", default="appEventProcessingDataset/dataset/")
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--hours", type=int, default=24)
+    parser.add_argument("--polling-rate", type=float, default=60.0)
+    parser.add_argument("--order-rate", type=float, default=1.0)
+    parser.add_argument("--connectivity-rate", type=float, default=2.0)
+    parser.add_argument("--code-skew", type=float, default=1.2)
+    parser.add_argument("--error-codes", type=int, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.3)
+    parser.add_argument("--missing-device-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    configure_logging()
+    args = parse_args()
+    generate_dataset(**vars(args))
@@ -1,22 +1,99 @@
 import pandas as pd
+import numpy as np
 import logging
 from pandas.core.frame import DataFrame
 import warnings
+from typing import Iterator, List, NamedTuple, Tuple
+
+from cache import DEFAULT_CACHE_MAX_BYTES, read_cached
+from instrumentation import instrument
 
 warnings.filterwarnings("ignore")
-logging.basicConfig(
-    format="%(asctime)s %(levelname)s - ETL code - %(message)s", level=logging.INFO
-)
-logging.getLogger().setLevel(logging.INFO)
 
 
+# declared column types of the raw inputs, used by the streaming reader.
+# status_code is left to inference like the whole file read: int64, or
+# float64 (200.0) in a chunk with missing codes, so a file with missing
+# codes has float64 features and output_data matches the in-memory run
+SCHEMAS = {
+    "orders.csv": {"order_id": "int64", "device_id": "object"},
+    "polling.csv": {"device_id": "object", "error_code": "object"},
+    "connectivity_status.csv": {"device_id": "object", "status": "object"},
+}
+
+# hour bucket join keys of the legacy merge, the compact mode replaces the
+# hour and date columns with one int64 count of hours since the epoch
+HOUR_KEY = "hour_key"
+COMPACT_MERGE_COLUMNS = ["device_id", HOUR_KEY]
+MERGE_COLUMNS = ["device_id", "hour", "date"]
+# parsers of `read_data`
+READ_ENGINES = ["c", "pyarrow"]
+# rows sampled to measure the bytes per row of a merge estimate
+MERGE_SAMPLE_ROWS = 10000
+
+
+def read_csv_arrow(
+    path: str, date_column: str, usecols: list = None, dtype: dict = None
+) -> DataFrame:
+    """
+    Parses a csv file with pyarrow, which splits it in blocks parsed on
+    its own threads without holding the GIL, and returns the frame
+    `pd.read_csv` would: nanosecond timestamps for `date_column`, NaN for
+    missing text and without the unnamed index column
+
+    Parameters
+    ----------
+    path: str : The csv file
+
+    date_column: str : The datetime column name
+
+    usecols: list : Only parse these columns
+         (Default value = None, every column)
+
+    dtype: dict : Column types applied after parsing
+         (Default value = None)
+
+    Returns
+    -------
+    A dataframe
+    """
+    try:
+        from pyarrow import csv
+    except ImportError as error:
+        raise ImportError(
+            "the pyarrow reader needs pyarrow, run `pip install pyarrow` or "
+            "read with the c engine"
+        ) from error
+    if usecols is not None:
+        # pyarrow returns the columns in the order asked, pandas in file order
+        header = pd.read_csv(path, nrows=0).columns
+        usecols = [column for column in header if column in usecols]
+    convert = csv.ConvertOptions(include_columns=usecols, strings_can_be_null=True)
+    df = csv.read_csv(path, convert_options=convert).to_pandas()
+    df = df.drop(columns=["", "Unnamed: 0"], errors="ignore")
+    df[date_column] = pd.to_datetime(df[date_column]).astype("datetime64[ns]")
+    text = df.columns[df.dtypes == object]
+    df[text] = df[text].fillna(np.nan)
+    if dtype is not None:
+        df = df.astype({k: v for k, v in dtype.items() if k in df.columns})
+    return df
+
+
+@instrument
 def read_data(
     path: str = "appEventProcessingDataset/dataset/",
     filename: str = "orders.csv",
     date_column: str = "order_creation_time",
-) -> DataFrame:
+    usecols: list = None,
+    chunksize: int = None,
+    dtype: dict = None,
+    cache_dir: str = None,
+    cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+    engine: str = "c",
+):
     """Takes in file path, converts time column to a datetime object
-        and returns a dataframe
+        and returns a dataframe, or an iterator of dataframes when
+        `chunksize` is set
 
     Parameters
     ----------
@@ -26,18 +103,72 @@ def read_data(
          (Default value = "orders.csv")
     date_column: str : The datetime column name
          (Default value = "order_creation_time")
+    usecols: list : Only parse these columns
+         (Default value = None, every column)
+    chunksize: int : Number of rows per chunk, streams the file
+         (Default value = None, reads the whole file)
+    dtype: dict : Column types, in streaming mode the declared
+        `SCHEMAS` entry of the file is used when not given
+         (Default value = None)
+    cache_dir: str : Keep a columnar copy of the parsed file here and
+        load it on later reads, ignored in streaming mode
+         (Default value = None, no cache)
+    cache_max_bytes: int : The size limit of the cache
+         (Default value = DEFAULT_CACHE_MAX_BYTES)
+    engine: str : "c" for the pandas parser, "pyarrow" for the
+        multithreaded pyarrow parser, which releases the GIL so that
+        files can be read concurrently from threads, see `read_csv_arrow`
+         (Default value = "c")
 
     Returns
     -------
-    A dataframe
+    A dataframe, or an iterator of dataframes
     """
-    df = pd.read_csv(path + filename, parse_dates=[date_column]).drop(
-        "Unnamed: 0", axis=1
-    )
-    logging.info("Data read successfully from")
+    if usecols is not None:
+        usecols = list(dict.fromkeys(list(usecols) + [date_column]))
+    if engine not in READ_ENGINES:
+        raise ValueError(f"engine must be one of {READ_ENGINES}")
+    if chunksize is not None and engine != "c":
+        raise ValueError("only the c engine streams a file in chunks")
+    if chunksize is not None:
+        if dtype is None:
+            dtype = SCHEMAS.get(filename)
+        if dtype is not None and usecols is not None:
+            dtype = {k: v for k, v in dtype.items() if k in usecols}
+        reader = pd.read_csv(
+            path + filename,
+            parse_dates=[date_column],
+            usecols=usecols,
+            dtype=dtype,
+            chunksize=chunksize,
+        )
+        logging.info(f"Streaming {filename} in chunks of {chunksize} rows")
+        return (chunk.drop("Unnamed: 0", axis=1, errors="ignore") for chunk in reader)
+
+    def parse():
+        if engine == "pyarrow":
+            return read_csv_arrow(path + filename, date_column, usecols, dtype)
+        return pd.read_csv(
+            path + filename, parse_dates=[date_column], usecols=usecols, dtype=dtype
+        ).drop("Unnamed: 0", axis=1, errors="ignore")
+
+    if cache_dir is not None:
+        df = read_cached(
+            path + filename,
+            parse,
+            cache_dir,
+            cache_max_bytes,
+            date_column=date_column,
+            usecols=usecols,
+            dtype=dtype,
+        )
+    else:
+        df = parse()
+    logging.info(f"Data read successfully from {path + filename}")
     return df
 
 
+@instrument
 def fix_missing_records(df: DataFrame, column: str = "device_id") -> DataFrame:
     """Accepts two arguments, impute missing records using
        forward fill and backward fill method
@@ -58,7 +189,10 @@ def fix_missing_records(df: DataFrame, column: str = "device_id") -> DataFrame:
     return df
 
 
-def add_hour_date_fields(df: pd.DataFrame, datetime_column: str) -> DataFrame:
+@instrument
+def add_hour_date_fields(
+    df: pd.DataFrame, datetime_column: str, compact: bool = False
+) -> DataFrame:
     """
     Extract date features (date, hour) from a dataframe
     and adds it as a new column to the dataframe
@@ -69,21 +203,246 @@ def add_hour_date_fields(df: pd.DataFrame, datetime_column: str) -> DataFrame:
 
     datetime_column: str : A Column timestamp column
 
+    compact: bool : Adds a single int64 `hour_key`, the number of hours
+        since the epoch, instead of an int hour and a python object date.
+        It identifies the same (date, hour) buckets with 8 bytes per row
+         (Default value = False)
+
     Returns
     -------
     A dataframe
     """
+    if compact:
+        df[HOUR_KEY] = (
+            df[datetime_column].to_numpy().astype("datetime64[h]").astype(np.int64)
+        )
+        logging.info("Added hour key to dataframe")
+        return df
     df["hour"] = df[datetime_column].dt.hour
     df["date"] = df[datetime_column].dt.date
     logging.info("Added date features to dataframe")
     return df
 
 
+class JoinEstimate(NamedTuple):
+    """Expected size of a merge, from the key histograms of both sides"""
+
+    rows: int
+    bytes: int
+    row_bytes: float
+
+
+def get_key_codes(
+    left_df: DataFrame, right_df: DataFrame, merge_columns: list
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Returns the key code of every left and right row, equal keys sharing
+    a code across both frames, and the number of distinct keys"""
+    keys = pd.concat(
+        [left_df[merge_columns], right_df[merge_columns]], ignore_index=True
+    )
+    codes = keys.groupby(merge_columns, sort=False, dropna=False).ngroup().to_numpy()
+    return codes[: len(left_df)], codes[len(left_df) :], int(codes.max(initial=-1)) + 1
+
+
+def get_row_bytes(df: DataFrame, columns: list, sample: int = MERGE_SAMPLE_ROWS):
+    """Returns the average in-memory bytes of `columns` per row, measured on
+    an evenly spaced sample of at most `sample` rows"""
+    if df.empty or not columns:
+        return 0.0
+    sampled = df[columns].iloc[:: max(1, len(df) // sample)]
+    return sampled.memory_usage(deep=True, index=False).sum() / len(sampled)
+
+
+def get_key_rows(
+    left_counts: np.ndarray, right_counts: np.ndarray, how: str = "inner"
+) -> np.ndarray:
+    """Returns the output rows of every key of a merge from the left and
+    right row counts of the keys"""
+    key_rows = left_counts * right_counts
+    if how in ("left", "outer"):
+        key_rows += np.where(right_counts == 0, left_counts, 0)
+    if how in ("right", "outer"):
+        key_rows += np.where(left_counts == 0, right_counts, 0)
+    return key_rows
+
+
+def estimate_merge(
+    left_df: DataFrame,
+    right_df: DataFrame,
+    merge_columns: list = MERGE_COLUMNS,
+    how: str = "inner",
+) -> Tuple[JoinEstimate, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Estimates the rows and bytes of a merge before running it. Both sides
+    are reduced to a histogram of their keys, a key matched on both sides
+    produces left count * right count rows, and unmatched keys one row per
+    row kept by `how`
+
+    Parameters
+    ----------
+    left_df: DataFrame : The first dataframe to merge to
+
+    right_df: DataFrame : The second dataframe to merge with
+
+    merge_columns: list : The columns to merge on
+         (Default value = MERGE_COLUMNS)
+
+    how: str : "inner", "left", "right" or "outer"
+         (Default value = "inner")
+
+    Returns
+    -------
+    The estimate, the left and right key codes, and the left and right row
+    counts of every key
+    """
+    left_codes, right_codes, keys = get_key_codes(left_df, right_df, merge_columns)
+    left_counts = np.bincount(left_codes, minlength=keys)
+    right_counts = np.bincount(right_codes, minlength=keys)
+    key_rows = get_key_rows(left_counts, right_counts, how)
+    right_columns = [c for c in right_df.columns if c not in merge_columns]
+    row_bytes = get_row_bytes(left_df, list(left_df.columns)) + get_row_bytes(
+        right_df, right_columns
+    )
+    rows = int(key_rows.sum())
+    estimate = JoinEstimate(rows, int(rows * row_bytes), row_bytes)
+    logging.info(
+        f"Estimated merge on {merge_columns}: {rows} rows, "
+        f"{estimate.bytes / 2**20:.1f} MB ({row_bytes:.0f} bytes per row, "
+        f"{keys} keys, largest key {int(key_rows.max(initial=0))} rows)"
+    )
+    return estimate, left_codes, right_codes, left_counts, right_counts
+
+
+def plan_merge_partitions(
+    left_codes: np.ndarray,
+    right_codes: np.ndarray,
+    left_counts: np.ndarray,
+    right_counts: np.ndarray,
+    key_rows: np.ndarray,
+    max_rows: int,
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Splits a merge into partitions of at most `max_rows` output rows.
+    Consecutive keys are packed together, and a hot key whose output alone
+    is larger than half the budget gets its right rows split in chunks,
+    each merged with every left row of the key. A right row therefore
+    lands in exactly one partition, with all of its matches
+
+    Parameters
+    ----------
+    left_codes: np.ndarray : The key code of every left row
+
+    right_codes: np.ndarray : The key code of every right row
+
+    left_counts: np.ndarray : The left rows of every key
+
+    right_counts: np.ndarray : The right rows of every key
+
+    key_rows: np.ndarray : The output rows of every key
+
+    max_rows: int : The output rows a partition may hold
+
+    Returns
+    -------
+    A list of (left positions, right positions), ascending in each
+    """
+    target = max(1, max_rows // 2)
+    hot = (key_rows > target) & (left_counts > 0) & (right_counts > 0)
+    # a packed partition holds less than target rows plus one key of at
+    # most target rows
+    packed = np.where(hot, 0, key_rows)
+    key_partition = (np.cumsum(packed) - packed) // target
+    key_partition[hot] = -1
+
+    partitions = []
+    left_part = key_partition[left_codes]
+    right_part = key_partition[right_codes]
+    left_order = np.argsort(left_part, kind="stable")
+    right_order = np.argsort(right_part, kind="stable")
+    for part in np.unique(key_partition[key_partition >= 0]):
+        left_lo, left_hi = np.searchsorted(left_part[left_order], [part, part + 1])
+        right_lo, right_hi = np.searchsorted(right_part[right_order], [part, part + 1])
+        partitions.append((left_order[left_lo:left_hi], right_order[right_lo:right_hi]))
+    for key in np.flatnonzero(hot):
+        left_positions = np.flatnonzero(left_codes == key)
+        right_positions = np.flatnonzero(right_codes == key)
+        chunk = max(1, target // len(left_positions))
+        if len(left_positions) > target:
+            logging.warning(
+                f"One right row of a hot key matches {len(left_positions)} "
+                "left rows, more than the budget allows"
+            )
+        for start in range(0, len(right_positions), chunk):
+            partitions.append((left_positions, right_positions[start : start + chunk]))
+    return partitions
+
+
+def iter_merge(
+    left_df: DataFrame,
+    right_df: DataFrame,
+    merge_columns: list = MERGE_COLUMNS,
+    how: str = "inner",
+    memory_budget: int = None,
+) -> Iterator[DataFrame]:
+    """
+    Merges two dataframes and yields the result in partitions whose
+    estimated size fits `memory_budget`. The size is estimated first with
+    `estimate_merge`, a merge that fits is yielded in one piece, and the
+    estimate and the chosen strategy are logged
+
+    Parameters
+    ----------
+    left_df: DataFrame : The first dataframe to merge to
+
+    right_df: DataFrame : The second dataframe to merge with
+
+    merge_columns: list : The columns to merge on
+         (Default value = MERGE_COLUMNS)
+
+    how: str : "inner", "left", "right" or "outer"
+         (Default value = "inner")
+
+    memory_budget: int : The bytes a merged partition may take
+         (Default value = None, no limit)
+
+    Returns
+    -------
+    An iterator of dataframes
+    """
+    estimate, left_codes, right_codes, left_counts, right_counts = estimate_merge(
+        left_df, right_df, merge_columns, how
+    )
+    if memory_budget is None or estimate.bytes <= memory_budget:
+        logging.info("Merge strategy: single merge")
+        yield left_df.merge(right_df, on=merge_columns, how=how)
+        return
+
+    max_rows = max(1, int(memory_budget // max(estimate.row_bytes, 1)))
+    partitions = plan_merge_partitions(
+        left_codes,
+        right_codes,
+        left_counts,
+        right_counts,
+        get_key_rows(left_counts, right_counts, how),
+        max_rows,
+    )
+    logging.info(
+        f"Merge strategy: {len(partitions)} partitions of at most {max_rows} "
+        f"rows, the estimate exceeds the {memory_budget / 2**20:.1f} MB budget"
+    )
+    for left_positions, right_positions in partitions:
+        yield left_df.iloc[left_positions].merge(
+            right_df.iloc[right_positions], on=merge_columns, how=how
+        )
+
+
+@instrument
 def merge_dataframe(
     left_df: DataFrame,
     right_df: DataFrame,
-    merge_columns: list = ["device_id", "hour", "date"],
+    merge_columns: list = MERGE_COLUMNS,
     how="inner",
+    memory_budget: int = None,
 ) -> DataFrame:
     """
     Takes two dataframe, returns the merged dataframe
@@ -96,24 +455,159 @@ def merge_dataframe(
     right_df: DataFrame : The second dataframe to merge with
 
     merge_columns: list : The columns to merge on
-         (Default value = ["device_id")
-    "hour" : A column to join on
-
-    "date"] : A column to join on
+         (Default value = MERGE_COLUMNS, device_id, hour and date)
 
     how : Specifies how the dataframes is to be joined
          (Default value = "inner")
 
+    memory_budget: int : Bytes of the merge past which it runs partition
+        by partition, see `iter_merge`. The partitions are concatenated,
+        callers that can consume them one at a time should use `iter_merge`
+         (Default value = None, no limit)
+
     Returns
     -------
     A dataframe
     """
     logging.info("Merged two dataframe")
-    df = left_df.merge(right_df, on=merge_columns, how=how)
+    parts = list(iter_merge(left_df, right_df, merge_columns, how, memory_budget))
+    df = parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True)
     logging.info(f"New shape = {df.shape}")
     return df
 
 
+def segmented_searchsorted(
+    keys: np.ndarray,
+    values: np.ndarray,
+    query_keys: np.ndarray,
+    query_values: np.ndarray,
+    side: str = "left",
+) -> np.ndarray:
+    """
+    Vectorised binary search over an array sorted by (keys, values).
+    For every query, returns the insertion point of `query_values`
+    inside the run of rows whose key equals the query key
+
+    Parameters
+    ----------
+    keys: np.ndarray : Integer group codes, sorted ascending
+
+    values: np.ndarray : Values sorted ascending within each key
+
+    query_keys: np.ndarray : The group code of every query
+
+    query_values: np.ndarray : The value to locate for every query
+
+    side: str : "left" or "right", as in `np.searchsorted`
+         (Default value = "left")
+
+    Returns
+    -------
+    An array of positions into `values`
+    """
+    lo = np.searchsorted(keys, query_keys, side="left")
+    hi = np.searchsorted(keys, query_keys, side="right")
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        probe = values[np.minimum(mid, len(values) - 1)]
+        if side == "left":
+            go_right = probe < query_values
+        else:
+            go_right = probe <= query_values
+        lo = np.where(active & go_right, mid + 1, lo)
+        hi = np.where(active & ~go_right, mid, hi)
+        active = lo < hi
+    return lo
+
+
+@instrument
+def interval_join(
+    left_df: DataFrame,
+    right_df: DataFrame,
+    left_time_column: str = "polling_creation_time",
+    right_time_column: str = "order_creation_time",
+    max_lookback: pd.Timedelta = pd.Timedelta(hours=1),
+    max_lookahead: pd.Timedelta = pd.Timedelta(minutes=3),
+    on: str = "device_id",
+) -> DataFrame:
+    """
+    Takes two dataframe, returns every pair of rows that share the `on`
+    key and where the left timestamp falls inside
+    [right_time - max_lookback, right_time + max_lookahead].
+    Left rows are sorted per key and located with a binary search, so
+    memory grows with the number of matching pairs only
+
+    Parameters
+    ----------
+    left_df: DataFrame : The event dataframe (e.g polling)
+
+    right_df: DataFrame : The anchor dataframe (e.g orders)
+
+    left_time_column: str : The event timestamp column
+         (Default value = "polling_creation_time")
+
+    right_time_column: str : The anchor timestamp column
+         (Default value = "order_creation_time")
+
+    max_lookback: pd.Timedelta : How far before the anchor to look
+         (Default value = pd.Timedelta(hours=1))
+
+    max_lookahead: pd.Timedelta : How far after the anchor to look
+         (Default value = pd.Timedelta(minutes=3))
+
+    on: str : The column to join on
+         (Default value = "device_id")
+
+    Returns
+    -------
+    A dataframe
+    """
+    codes, _ = pd.factorize(pd.concat([left_df[on], right_df[on]], ignore_index=True))
+    left_codes = codes[: len(left_df)]
+    right_codes = codes[len(left_df) :]
+
+    # rows without a key never match, push them out of every search
+    left_order = np.lexsort((left_df[left_time_column].values.view("i8"), left_codes))
+    left_order = left_order[left_codes[left_order] >= 0]
+    sorted_codes = left_codes[left_order]
+    sorted_times = left_df[left_time_column].values.view("i8")[left_order]
+
+    right_times = right_df[right_time_column].values.view("i8")
+    start = segmented_searchsorted(
+        sorted_codes,
+        sorted_times,
+        right_codes,
+        right_times - max_lookback.value,
+        side="left",
+    )
+    stop = segmented_searchsorted(
+        sorted_codes,
+        sorted_times,
+        right_codes,
+        right_times + max_lookahead.value,
+        side="right",
+    )
+    counts = np.where(right_codes >= 0, stop - start, 0)
+
+    # expand each anchor into its run of matching events
+    right_index = np.repeat(np.arange(len(right_df)), counts)
+    run_offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    left_index = left_order[np.repeat(start, counts) + run_offset]
+
+    right_columns = [c for c in right_df.columns if c != on]
+    left_part = left_df.iloc[left_index].reset_index(drop=True)
+    right_part = right_df[right_columns].iloc[right_index].reset_index(drop=True)
+    # overlapping column names are suffixed the way `DataFrame.merge` does
+    overlap = left_part.columns.intersection(right_part.columns)
+    left_part = left_part.rename(columns={c: f"{c}_x" for c in overlap})
+    right_part = right_part.rename(columns={c: f"{c}_y" for c in overlap})
+    df = pd.concat([left_part, right_part], axis=1)
+    logging.info(f"Interval joined two dataframe, new shape = {df.shape}")
+    return df
+
+
+@instrument
 def rename_field(
     df: DataFrame,
     new_column_name: str,
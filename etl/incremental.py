@@ -0,0 +1,435 @@
+import hashlib
+import io
+import logging
+import os
+import sqlite3
+from typing import List
+
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+from helpers import SCHEMAS, interval_join
+from etl import (
+    WINDOWS,
+    AGGREGATIONS,
+    Aggregation,
+    Window,
+    assemble_features,
+    compute_connectivity_features,
+    compute_window_features,
+)
+from pipeline import (
+    get_lookback_lookahead,
+    prepare_connectivity,
+    prepare_orders,
+    prepare_polling,
+)
+
+DEFAULT_STATE_PATH = "feature_state.db"
+# bytes before a read offset hashed to detect a rewritten file
+CHECKSUM_BYTES = 4096
+
+
+def get_watermark(connection: sqlite3.Connection, name: str):
+    """Returns a persisted watermark as a timestamp, or None"""
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS watermarks (name TEXT PRIMARY KEY, value TEXT)"
+    )
+    row = connection.execute(
+        "SELECT value FROM watermarks WHERE name = ?", (name,)
+    ).fetchone()
+    return pd.Timestamp(row[0]) if row else None
+
+
+def set_watermark(connection: sqlite3.Connection, name: str, value) -> None:
+    """Persists a watermark"""
+    connection.execute(
+        "INSERT OR REPLACE INTO watermarks (name, value) VALUES (?, ?)",
+        (name, str(value)),
+    )
+
+
+def table_exists(connection: sqlite3.Connection, table: str) -> bool:
+    """Checks whether a table exists in the state database"""
+    return (
+        connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        is not None
+    )
+
+
+def read_state_table(
+    connection: sqlite3.Connection, table: str, date_column: str
+) -> DataFrame:
+    """Returns a persisted state table, or None when it does not exist yet"""
+    if not table_exists(connection, table):
+        return None
+    return pd.read_sql(f"SELECT * FROM {table}", connection, parse_dates=[date_column])
+
+
+def get_affected_orders(
+    orders: DataFrame,
+    new_events: DataFrame,
+    lookback: pd.Timedelta,
+    lookahead: pd.Timedelta,
+    time_column: str = "polling_creation_time",
+) -> DataFrame:
+    """
+    Takes the known orders and the new events, returns the orders whose
+    [order time - lookback, order time + lookahead] window overlaps the new
+    events of their device. A `lookback` of None keeps every later order,
+    for status changes that hold until the next one
+
+    Parameters
+    ----------
+    orders: DataFrame : Orders with device_id and order_creation_time
+
+    new_events: DataFrame : New polling events or status changes
+
+    lookback: pd.Timedelta : The largest lookback of the windows, or None
+
+    lookahead: pd.Timedelta : The largest lookahead of the windows
+
+    time_column: str : The event time column
+         (Default value = "polling_creation_time")
+
+    Returns
+    -------
+    A dataframe
+    """
+    span = new_events.groupby("device_id")[time_column].agg(["min", "max"])
+    first_new = orders["device_id"].map(span["min"])
+    touched = orders["order_creation_time"] + lookahead >= first_new
+    if lookback is not None:
+        last_new = orders["device_id"].map(span["max"])
+        touched &= orders["order_creation_time"] - lookback <= last_new
+    return orders[touched]
+
+
+def keep_status_tail(connectivity: DataFrame, horizon: pd.Timestamp) -> DataFrame:
+    """Returns the status changes from `horizon` on plus the last change of
+    every device before it, which holds at the horizon"""
+    times = connectivity["connectivity_creation_time"]
+    before = connectivity[times < horizon].sort_values("connectivity_creation_time")
+    last = before.drop_duplicates("device_id", keep="last")
+    return pd.concat([last, connectivity[times >= horizon]], ignore_index=True)
+
+
+def read_offset(connection: sqlite3.Connection, filename: str):
+    """Returns the persisted read offset, checksum and last device_id of a
+    file, or None"""
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS read_offsets "
+        "(filename TEXT PRIMARY KEY, offset INTEGER, checksum TEXT, device_id TEXT)"
+    )
+    return connection.execute(
+        "SELECT offset, checksum, device_id FROM read_offsets WHERE filename = ?",
+        (filename,),
+    ).fetchone()
+
+
+def set_read_offset(
+    connection: sqlite3.Connection,
+    filename: str,
+    offset: int,
+    checksum: str,
+    device_id: str = None,
+) -> None:
+    """Persists the read offset of a file"""
+    connection.execute(
+        "INSERT OR REPLACE INTO read_offsets (filename, offset, checksum, device_id) "
+        "VALUES (?, ?, ?, ?)",
+        (filename, offset, checksum, device_id),
+    )
+
+
+def offset_checksum(path: str, offset: int) -> str:
+    """Returns a hash of the bytes just before an offset, which change when
+    the file is rewritten instead of appended to"""
+    with open(path, "rb") as f:
+        f.seek(max(offset - CHECKSUM_BYTES, 0))
+        return hashlib.sha1(f.read(offset - f.tell())).hexdigest()
+
+
+def read_new_rows(
+    connection: sqlite3.Connection, path: str, filename: str, date_column: str
+):
+    """
+    Parses only the rows appended to a csv file since the last run, from
+    the persisted byte offset. A partly written last line is left for the
+    next run. The whole file is read when there is no offset yet or the
+    bytes before it changed, i.e. the file was rewritten
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection : The state database
+
+    path: str : The dataset directory
+
+    filename: str : The file name
+
+    date_column: str : The datetime column name
+
+    Returns
+    -------
+    The new rows, the offset after them, whether the read resumed from the
+    persisted offset and the persisted last device_id
+    """
+    state = read_offset(connection, filename)
+    resumed = False
+    with open(path + filename, "rb") as f:
+        header = f.readline()
+        start = len(header)
+        if state is not None:
+            resumed = state[0] <= os.fstat(f.fileno()).st_size and (
+                offset_checksum(path + filename, state[0]) == state[1]
+            )
+            if resumed:
+                start = state[0]
+            else:
+                logging.warning(f"{filename} was rewritten, reading it whole")
+        f.seek(start)
+        data = f.read()
+    data = data[: data.rfind(b"\n") + 1]
+    df = pd.read_csv(io.BytesIO(header + data), dtype=SCHEMAS.get(filename))
+    df = df.drop("Unnamed: 0", axis=1, errors="ignore")
+    # an empty read has no dates to parse, the column still has to be datetime
+    df[date_column] = pd.to_datetime(df[date_column])
+    logging.info(f"Read {len(df)} new rows of {filename} from byte {start}")
+    return df, start + len(data), resumed, state[2] if state else None
+
+
+def run_incremental(
+    path: str = "appEventProcessingDataset/dataset/",
+    state_path: str = DEFAULT_STATE_PATH,
+    windows: List[Window] = WINDOWS,
+    aggregations: List[Aggregation] = AGGREGATIONS,
+) -> DataFrame:
+    """
+    Processes only the polling events, status changes and orders appended
+    to the input files since the last run, recomputes the new orders and
+    the known orders whose windows touch the new events, with their window
+    and connectivity features, and upserts their rows into the `features`
+    table of the state database.
+
+    Rows are read from the persisted byte offsets, so a run only parses
+    what was appended. A polling event older than the polling watermark
+    is still applied when the kept state reaches it, up to one lookback
+    plus lookahead before the watermark. Older events are dropped, status
+    changes that old only update the kept orders, and orders whose
+    lookback starts before the kept polling tail are computed on a
+    truncated window; all are counted and logged
+
+    Parameters
+    ----------
+    path: str : The dataset directory
+         (Default value = "appEventProcessingDataset/dataset/")
+
+    state_path: str : The SQLite database holding the read offsets, the
+        watermarks, the per-device polling and status tails, the pending
+        orders and the features
+         (Default value = DEFAULT_STATE_PATH)
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The aggregations to run
+         (Default value = AGGREGATIONS)
+
+    Returns
+    -------
+    A dataframe of the upserted rows
+    """
+    lookback, lookahead = get_lookback_lookahead(windows)
+    # how late a polling event may be and still reach the orders it touches
+    reach = lookback + lookahead
+    order_columns = ["device_id", "order_id", "order_creation_time"]
+    with sqlite3.connect(state_path) as connection:
+        polling_watermark = get_watermark(connection, "polling")
+        status_watermark = get_watermark(connection, "connectivity")
+        orders_watermark = get_watermark(connection, "orders")
+        polling_df, polling_offset, polling_resumed, _ = read_new_rows(
+            connection, path, "polling.csv", "creation_time"
+        )
+        status_df, status_offset, status_resumed, _ = read_new_rows(
+            connection, path, "connectivity_status.csv", "creation_time"
+        )
+        orders_df, orders_offset, orders_resumed, last_device = read_new_rows(
+            connection, path, "orders.csv", "order_creation_time"
+        )
+        # missing device_id are forward filled across runs, like in one file
+        if orders_resumed and last_device is not None:
+            orders_df["device_id"] = (
+                orders_df["device_id"].fillna(method="ffill").fillna(last_device)
+            )
+        known_devices = orders_df["device_id"].dropna()
+        if not known_devices.empty:
+            last_device = known_devices.iloc[-1]
+        polling_df = prepare_polling(polling_df)
+        status_df = prepare_connectivity(status_df)[
+            ["device_id", "connectivity_creation_time", "status"]
+        ]
+        orders_df = prepare_orders(orders_df)
+
+        # a whole file read has the rows before the watermarks processed already
+        if polling_watermark is not None and not polling_resumed:
+            polling_df = polling_df[
+                polling_df["polling_creation_time"] > polling_watermark
+            ]
+        if status_watermark is not None and not status_resumed:
+            status_df = status_df[
+                status_df["connectivity_creation_time"] > status_watermark
+            ]
+        if orders_watermark is not None and not orders_resumed:
+            orders_df = orders_df[orders_df["order_creation_time"] > orders_watermark]
+        late_events = late_changes = late_orders = 0
+        if polling_watermark is not None:
+            late = polling_df["polling_creation_time"] < polling_watermark - reach
+            late_events = int(late.sum())
+            polling_df = polling_df[~late]
+            # a status change holds until the next one and is always kept,
+            # but the orders it reaches before the kept ones are not updated
+            late_changes = int(
+                (
+                    status_df["connectivity_creation_time"] < polling_watermark - reach
+                ).sum()
+            )
+            late_orders = int(
+                (
+                    orders_df["order_creation_time"] - lookback
+                    < polling_watermark - 2 * reach
+                ).sum()
+            )
+        if late_events or late_changes or late_orders:
+            logging.warning(
+                f"{late_events} late polling events dropped, {late_changes} late "
+                f"status changes applied to the kept orders only, {late_orders} "
+                "late orders computed on truncated windows"
+            )
+        new_orders = orders_df[order_columns]
+        set_read_offset(
+            connection,
+            "polling.csv",
+            polling_offset,
+            offset_checksum(path + "polling.csv", polling_offset),
+        )
+        set_read_offset(
+            connection,
+            "connectivity_status.csv",
+            status_offset,
+            offset_checksum(path + "connectivity_status.csv", status_offset),
+        )
+        set_read_offset(
+            connection,
+            "orders.csv",
+            orders_offset,
+            offset_checksum(path + "orders.csv", orders_offset),
+            last_device,
+        )
+        if polling_df.empty and status_df.empty and new_orders.empty:
+            logging.info(
+                "No new polling events, status changes or orders since the last run"
+            )
+            return pd.DataFrame()
+
+        tail = read_state_table(connection, "polling_tail", "polling_creation_time")
+        status_tail = read_state_table(
+            connection, "status_tail", "connectivity_creation_time"
+        )
+        pending = read_state_table(connection, "pending_orders", "order_creation_time")
+        polling = polling_df if tail is None else pd.concat([tail, polling_df])
+        polling = polling.reset_index(drop=True)
+        status = (
+            status_df if status_tail is None else pd.concat([status_tail, status_df])
+        )
+        status = status.reset_index(drop=True)
+
+        affected = new_orders
+        if pending is not None:
+            touched = get_affected_orders(pending, polling_df, lookback, lookahead)
+            # a status change holds until the next one, so every later order
+            # of its device may see it
+            touched_status = get_affected_orders(
+                pending, status_df, None, lookahead, "connectivity_creation_time"
+            )
+            affected = pd.concat([touched, touched_status, new_orders])
+            affected = affected.drop_duplicates("order_id")
+        logging.info(
+            f"{len(polling_df)} new polling events, {len(status_df)} new status "
+            f"changes, {len(new_orders)} new orders, "
+            f"{len(affected)} orders to recompute"
+        )
+
+        joined = interval_join(
+            polling, affected, max_lookback=lookback, max_lookahead=lookahead
+        )
+        features = compute_window_features(joined, windows, aggregations)
+        rows = assemble_features(
+            features, affected[["order_id"]], windows, aggregations
+        )
+        rows = rows.merge(
+            compute_connectivity_features(status, affected[order_columns], windows),
+            how="left",
+            on="order_id",
+        )
+
+        # upsert: replace every row of the recomputed orders, found by index
+        if table_exists(connection, "features"):
+            connection.executemany(
+                "DELETE FROM features WHERE order_id = ?",
+                ((int(order_id),) for order_id in affected["order_id"]),
+            )
+        rows.to_sql("features", connection, if_exists="append", index=False)
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS features_order_id ON features (order_id)"
+        )
+
+        # advance the watermarks and keep only the state later runs can reach
+        if not polling_df.empty:
+            latest = polling_df["polling_creation_time"].max()
+            polling_watermark = (
+                latest if polling_watermark is None else max(polling_watermark, latest)
+            )
+            set_watermark(connection, "polling", polling_watermark)
+        if not status_df.empty:
+            latest = status_df["connectivity_creation_time"].max()
+            status_watermark = (
+                latest if status_watermark is None else max(status_watermark, latest)
+            )
+            set_watermark(connection, "connectivity", status_watermark)
+        if not new_orders.empty:
+            latest = new_orders["order_creation_time"].max()
+            orders_watermark = (
+                latest if orders_watermark is None else max(orders_watermark, latest)
+            )
+            set_watermark(connection, "orders", orders_watermark)
+        if polling_watermark is not None:
+            # a late event touches orders up to a lookahead before it, and
+            # they need the polling of their lookback
+            horizon = polling_watermark - 2 * reach
+            polling = polling[polling["polling_creation_time"] >= horizon]
+            status = keep_status_tail(status, horizon)
+            pending = (
+                pd.concat([pending, new_orders]) if pending is not None else new_orders
+            )
+            pending = pending[
+                pending["order_creation_time"] + lookahead >= polling_watermark - reach
+            ]
+        else:
+            pending = new_orders
+        polling.to_sql("polling_tail", connection, if_exists="replace", index=False)
+        status.to_sql("status_tail", connection, if_exists="replace", index=False)
+        pending.to_sql("pending_orders", connection, if_exists="replace", index=False)
+    logging.info(f"Upserted {len(rows)} feature rows into {state_path}")
+    return rows
+
+
+def export_features(
+    state_path: str = DEFAULT_STATE_PATH, path: str = "output_data.csv"
+) -> DataFrame:
+    """Writes the features table of the state database to a csv file"""
+    with sqlite3.connect(state_path) as connection:
+        df = pd.read_sql("SELECT * FROM features ORDER BY order_id", connection)
+    df.to_csv(path, index=False)
+    return df
@@ -0,0 +1,149 @@
+import cProfile
+import functools
+import json
+import logging
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+from pandas.core.frame import DataFrame
+
+LOG_FORMAT = "%(asctime)s %(levelname)s - ETL code - %(message)s"
+
+# stage metrics are only collected between `enable` and `write_metrics`
+STATE = {"enabled": False, "records": [], "profiler": None}
+# stage nesting of every thread, stages may run on loader threads
+LOCAL = threading.local()
+
+
+def configure_logging(level: int = logging.INFO) -> None:
+    """Sets up the log format of the pipeline, once, from an entry point"""
+    logging.basicConfig(format=LOG_FORMAT, level=level)
+    logging.getLogger().setLevel(level)
+
+
+def peak_rss_mb() -> float:
+    """Returns the peak resident set size of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def frame_rows(value):
+    """Returns the number of rows of a dataframe, None for anything else"""
+    return len(value) if isinstance(value, DataFrame) else None
+
+
+def frame_mb(value):
+    """Returns the memory of a dataframe in MB, None for anything else"""
+    if not isinstance(value, DataFrame):
+        return None
+    return round(value.memory_usage(index=True, deep=False).sum() / 1024**2, 3)
+
+
+def enable(profile: bool = False) -> None:
+    """Starts collecting stage metrics, and a cProfile of every stage when
+    `profile` is set"""
+    STATE["enabled"] = True
+    STATE["records"] = []
+    STATE["profiler"] = cProfile.Profile() if profile else None
+
+
+def disable() -> None:
+    """Stops collecting stage metrics"""
+    STATE["enabled"] = False
+    STATE["profiler"] = None
+
+
+@contextmanager
+def stage(name: str, rows_in: int = None, result: dict = None):
+    """
+    Records the elapsed time, rows and memory of a block of code as one
+    stage. Does nothing unless `enable` was called
+
+    Parameters
+    ----------
+    name: str : The stage name
+
+    rows_in: int : The number of input rows
+         (Default value = None)
+
+    result: dict : Filled in by the block with an "output" entry to record
+        its rows and frame memory
+         (Default value = None)
+    """
+    if not STATE["enabled"]:
+        yield
+        return
+    # cProfile follows a single thread, the stages of the main thread
+    profiler = STATE["profiler"]
+    if threading.current_thread() is not threading.main_thread():
+        profiler = None
+    depth = getattr(LOCAL, "depth", 0)
+    if profiler is not None and depth == 0:
+        profiler.enable()
+    LOCAL.depth = depth + 1
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        LOCAL.depth = depth
+        if profiler is not None and depth == 0:
+            profiler.disable()
+        output = (result or {}).get("output")
+        peak = peak_rss_mb()
+        STATE["records"].append(
+            {
+                "stage": name,
+                "depth": depth,
+                "seconds": round(seconds, 6),
+                "rows_in": rows_in,
+                "rows_out": frame_rows(output),
+                "frame_mb": frame_mb(output),
+                "peak_rss_mb": round(peak, 1),
+                "peak_rss_growth_mb": round(peak - rss_before, 1),
+            }
+        )
+
+
+def instrument(function=None, name: str = None):
+    """
+    Decorator recording every call of a pipeline function as a stage, with
+    the rows of its first dataframe argument as input rows. When metrics
+    are disabled the only overhead is one dictionary lookup per call
+
+    Parameters
+    ----------
+    function : The decorated function
+
+    name: str : The stage name
+         (Default value = None, the function name)
+    """
+    if function is None:
+        return functools.partial(instrument, name=name)
+    stage_name = name or function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not STATE["enabled"]:
+            return function(*args, **kwargs)
+        rows_in = next((len(arg) for arg in args if isinstance(arg, DataFrame)), None)
+        result = {}
+        with stage(stage_name, rows_in, result):
+            result["output"] = function(*args, **kwargs)
+        return result["output"]
+
+    return wrapper
+
+
+def write_metrics(path: str = "metrics.json") -> list:
+    """Writes the recorded stages to a JSON file, and the cProfile stats next
+    to it when profiling, then returns the records"""
+    records = STATE["records"]
+    with open(path, "w") as f:
+        json.dump({"stages": records}, f, indent=2)
+    if STATE["profiler"] is not None:
+        STATE["profiler"].dump_stats(path.rsplit(".", 1)[0] + ".prof")
+    logging.info(f"Metrics of {len(records)} stages written to {path}")
+    return records
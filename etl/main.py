@@ -1,42 +1,422 @@
-from helpers import (
-    read_data,
-    fix_missing_records,
-    rename_field,
-    add_hour_date_fields,
-    merge_dataframe,
+import argparse
+
+import instrumentation
+
+from cache import DEFAULT_CACHE_DIR, invalidate_cache
+from checkpoint import DEFAULT_CHECKPOINT_DIR, CheckpointStore
+from duckdb_backend import DuckDBConfig, run_duckdb
+from helpers import READ_ENGINES
+from incremental import DEFAULT_STATE_PATH, run_incremental
+from parallel import run_parallel
+from etl import (
+    AGGREGATIONS,
+    OTHER_CODE,
+    sketch_aggregations,
+    get_all_feature,
+    get_top_k,
+    add_datetime_dimension_to_df,
+    get_feature_catalogue,
+    compute_connectivity_features,
+)
+from writers import (
+    CSV_COMPRESSION_SUFFIXES,
+    DEFAULT_OUTPUT,
+    FORMATS,
+    INPUT_DUMPS,
+    OutputConfig,
+)
+from pipeline import (
+    declare_checkpointed_stages,
+    join_polling_orders,
+    run_chunked,
+    run_partitioned_merge,
+    run_selected_features,
+    load_inputs,
 )
-from etl import get_all_feature, add_datetime_dimension_to_df
 
 
-if __name__ == "__main__":
-    connectivity_status_df = read_data(
-        filename="connectivity_status.csv", date_column="creation_time"
+def parse_args():
+    """Parses the command line options of the pipeline"""
+    parser = argparse.ArgumentParser(description="Generate the polling features")
+    parser.add_argument(
+        "--join",
+        choices=["interval", "hour"],
+        default="interval",
+        help="interval: per-device sorted window join (default), "
+        "hour: legacy merge on device_id, hour and date",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["pandas", "duckdb"],
+        default="pandas",
+        help="pandas: in-memory dataframes (default), duckdb: run the join and "
+        "the window counts on the embedded DuckDB engine, which uses every "
+        "core and spills to disk",
+    )
+    parser.add_argument(
+        "--duckdb-threads",
+        type=int,
+        default=None,
+        help="threads of the duckdb backend, every core by default",
+    )
+    parser.add_argument(
+        "--duckdb-memory-limit",
+        default=None,
+        help="memory limit of the duckdb backend before it spills, e.g. 4GB",
+    )
+    parser.add_argument(
+        "--features",
+        nargs="+",
+        default=None,
+        help="only compute these features, e.g. total_polling_event or "
+        "status_code_count_1hr_b4 or seconds_online_3min_b4, and only read "
+        "the files and columns they need",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=None,
+        help="megabytes the --join hour merge may take, past its estimate the "
+        "merge and the features run one key partition at a time",
+    )
+    parser.add_argument(
+        "--top-codes",
+        type=int,
+        default=None,
+        help="approximate the status_code and error_code counts: keep the K "
+        "most frequent codes of every order and window, with counts at most "
+        "1/(K+1) of the window's events low, and lump the others into "
+        f"{OTHER_CODE}",
+    )
+    parser.add_argument(
+        "--top-codes-error",
+        type=float,
+        default=None,
+        help="like --top-codes, with the smallest K whose counts are at most "
+        "this fraction of the window's events low, e.g. 0.1",
+    )
+    parser.add_argument(
+        "--compact-keys",
+        action="store_true",
+        help="use an int64 hour key instead of hour and date columns, and "
+        "compute the window bounds on the fly",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help="stream polling.csv in time ordered chunks of this many rows, "
+        "output_data has the in-memory columns and values in batch order",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only parse the rows appended since the last run and upsert the "
+        f"recomputed orders into {DEFAULT_STATE_PATH}",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="shard the work by device_id over this many processes",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=["long", "wide"],
+        default="long",
+        help="long: one row per order and code combination (default), "
+        "wide: one row per order with a column per window and code",
+    )
+    parser.add_argument(
+        "--writer",
+        choices=list(FORMATS),
+        default="csv",
+        help="file format of input_data and output_data, parquet and "
+        "feather need pyarrow",
+    )
+    parser.add_argument(
+        "--compression",
+        default=None,
+        help="compression of the written files, e.g. gzip for csv, "
+        "snappy or zstd for parquet",
+    )
+    parser.add_argument(
+        "--partition-by",
+        default=None,
+        help="write one directory per value of this column, e.g. date",
+    )
+    parser.add_argument(
+        "--csv-chunksize",
+        type=int,
+        default=None,
+        help="rows serialised at a time by the csv writer",
+    )
+    parser.add_argument(
+        "--input-dump",
+        choices=INPUT_DUMPS,
+        default="full",
+        help="full: write the joined input to input_data (default), "
+        "sample: write a fraction of its rows, skip: do not write it",
+    )
+    parser.add_argument(
+        "--input-sample",
+        type=float,
+        default=0.01,
+        help="fraction of the rows written by --input-dump sample",
+    )
+    parser.add_argument(
+        "--sync-writes",
+        action="store_true",
+        help="write the outputs from the main thread instead of a background thread",
     )
-    orders_df = read_data()
-    polling_df = read_data(filename="polling.csv", date_column="creation_time")
+    parser.add_argument(
+        "--checkpoints",
+        action="store_true",
+        help="reuse the outputs of unchanged preparation and join stages "
+        f"stored in {DEFAULT_CHECKPOINT_DIR}",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help="write the time, rows and memory of every stage to this JSON file",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="also write a cProfile of the stages next to the metrics file",
+    )
+    parser.add_argument(
+        "--readers",
+        type=int,
+        default=3,
+        help="threads reading and preparing the three inputs concurrently, "
+        "1 reads them one by one",
+    )
+    parser.add_argument(
+        "--csv-engine",
+        choices=READ_ENGINES,
+        default="c",
+        help="c: the pandas parser (default), pyarrow: the multithreaded "
+        "pyarrow parser, which releases the GIL while it parses",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help=f"keep a columnar copy of the parsed inputs in {DEFAULT_CACHE_DIR}",
+    )
+    parser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        help="remove the columnar copies of the inputs before reading them",
+    )
+    args = parser.parse_args()
+    if args.output_format == "wide" and (
+        args.chunksize or args.incremental or args.workers
+    ):
+        parser.error("--output-format wide is only supported by in-memory runs")
+    if args.backend == "duckdb" and (
+        args.chunksize
+        or args.incremental
+        or args.workers
+        or args.checkpoints
+        or args.output_format == "wide"
+    ):
+        parser.error("--backend duckdb only runs the default long output")
+    if args.memory_budget is not None and (
+        args.join != "hour"
+        or args.backend == "duckdb"
+        or args.chunksize
+        or args.incremental
+        or args.workers
+        or args.checkpoints
+        or args.output_format == "wide"
+    ):
+        parser.error("--memory-budget guards the in-memory --join hour merge")
+    if args.features and (
+        args.backend == "duckdb"
+        or args.chunksize
+        or args.incremental
+        or args.workers
+        or args.checkpoints
+        or args.memory_budget is not None
+    ):
+        parser.error("--features is only supported by in-memory runs")
+    unknown = [f for f in args.features or [] if f not in get_feature_catalogue()]
+    if unknown:
+        parser.error(
+            f"unknown --features {unknown}, choose from {sorted(get_feature_catalogue())}"
+        )
+    if args.top_codes_error is not None:
+        if args.top_codes is not None:
+            parser.error("give either --top-codes or --top-codes-error")
+        try:
+            args.top_codes = get_top_k(args.top_codes_error)
+        except ValueError as error:
+            parser.error(f"--top-codes-error: {error}")
+    if args.top_codes is not None and (
+        args.backend == "duckdb"
+        or args.incremental
+        or args.features
+        or args.memory_budget is not None
+        or args.output_format == "wide"
+    ):
+        parser.error(
+            "--top-codes is only supported by the long output of the "
+            "in-memory, chunked and parallel runs"
+        )
+    if args.top_codes is not None and args.top_codes < 1:
+        parser.error("--top-codes must be at least 1")
+    if args.checkpoints and (args.chunksize or args.incremental or args.workers):
+        parser.error("--checkpoints is only supported by in-memory runs")
+    if args.writer == "csv" and args.compression not in CSV_COMPRESSION_SUFFIXES:
+        parser.error(
+            f"--compression of csv must be one of "
+            f"{[c for c in CSV_COMPRESSION_SUFFIXES if c]}"
+        )
+    if not 0 < args.input_sample <= 1:
+        parser.error("--input-sample must be in (0, 1]")
+    if args.csv_engine != "c" and (
+        args.backend == "duckdb"
+        or args.chunksize
+        or args.incremental
+        or args.features
+        or args.checkpoints
+    ):
+        parser.error("--csv-engine applies to the reads of the in-memory run")
+    if args.readers < 1:
+        parser.error("--readers must be at least 1")
+    if args.incremental and output_config(args) != DEFAULT_OUTPUT:
+        parser.error("--incremental writes its features to SQLite, not files")
+    return args
 
-    # fix missing records
-    orders_df = fix_missing_records(orders_df)
 
-    # rename creationtime field
-    connectivity_status_df = rename_field(
-        connectivity_status_df, "connectivity_creation_time"
+def output_config(args) -> OutputConfig:
+    """Returns the output writer settings of the command line options"""
+    return OutputConfig(
+        format=args.writer,
+        compression=args.compression,
+        partition_by=args.partition_by,
+        csv_chunksize=args.csv_chunksize,
+        input_dump=args.input_dump,
+        input_sample=args.input_sample,
+        background=not args.sync_writes,
     )
-    polling_df = rename_field(polling_df, "polling_creation_time")
 
-    # add datetime feature
-    orders_df = add_hour_date_fields(orders_df, "order_creation_time")
-    polling_df = add_hour_date_fields(polling_df, "polling_creation_time")
-    connectivity_status_df = add_hour_date_fields(
-        connectivity_status_df, "connectivity_creation_time"
+
+def run(args):
+    """Runs the pipeline selected by the command line options"""
+    cache_dir = DEFAULT_CACHE_DIR if args.cache else None
+    aggregations = sketch_aggregations(AGGREGATIONS, args.top_codes)
+    if args.clear_cache:
+        invalidate_cache(DEFAULT_CACHE_DIR)
+
+    if args.backend == "duckdb":
+        return run_duckdb(
+            join=args.join,
+            output=output_config(args),
+            config=DuckDBConfig(
+                threads=args.duckdb_threads, memory_limit=args.duckdb_memory_limit
+            ),
+        )
+
+    if args.features:
+        return run_selected_features(
+            args.features,
+            join=args.join,
+            compact=args.compact_keys,
+            output_format=args.output_format,
+            output=output_config(args),
+            cache_dir=cache_dir,
+        )
+
+    if args.chunksize:
+        return run_chunked(
+            args.chunksize,
+            aggregations=aggregations,
+            cache_dir=cache_dir,
+            output=output_config(args),
+            compact=args.compact_keys,
+        )
+
+    if args.checkpoints:
+        stages = declare_checkpointed_stages(
+            CheckpointStore(), join=args.join, compact=args.compact_keys
+        )
+        orders_df = stages["orders"].value()
+        return get_all_feature(
+            stages["joined"].value(),
+            orders=orders_df[["order_id"]],
+            aggregations=aggregations,
+            output_format=args.output_format,
+            connectivity_features=compute_connectivity_features(
+                stages["connectivity"].value(),
+                orders_df[["device_id", "order_id", "order_creation_time"]],
+            ),
+            output=output_config(args),
+        )
+
+    if args.incremental:
+        return run_incremental()
+
+    # read the inputs concurrently, every frame is prepared as soon as it is read
+    orders_df, polling_df, connectivity_df, connectivity_features = load_inputs(
+        compact=args.compact_keys,
+        cache_dir=cache_dir,
+        engine=args.csv_engine,
+        readers=args.readers,
+        # the sharded run computes them per shard
+        connectivity_features=not args.workers,
     )
 
+    if args.workers:
+        return run_parallel(
+            polling_df,
+            orders_df,
+            connectivity_df,
+            workers=args.workers,
+            aggregations=aggregations,
+            output=output_config(args),
+            compact=args.compact_keys,
+        )
+
+    if args.memory_budget is not None:
+        return run_partitioned_merge(
+            polling_df,
+            orders_df,
+            args.memory_budget * 2**20,
+            args.compact_keys,
+            connectivity_features,
+            output_config(args),
+        )
+
     # merge dataframe - preparing data
-    polling_orders_df = merge_dataframe(polling_df, orders_df)
+    polling_orders_df = join_polling_orders(
+        polling_df, orders_df, args.join, args.compact_keys
+    )
 
     # add add_datetime_dimension_to_df
-    polling_orders_df = add_datetime_dimension_to_df(polling_orders_df)
+    polling_orders_df = add_datetime_dimension_to_df(
+        polling_orders_df, args.compact_keys
+    )
+
+    return get_all_feature(
+        polling_orders_df,
+        orders=orders_df[["order_id"]],
+        aggregations=aggregations,
+        output_format=args.output_format,
+        connectivity_features=connectivity_features,
+        output=output_config(args),
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    instrumentation.configure_logging()
+    if args.metrics:
+        instrumentation.enable(profile=args.profile)
 
-    df = get_all_feature(polling_orders_df, orders=orders_df[["order_id"]])
+    df = run(args)
 
+    if args.metrics:
+        instrumentation.write_metrics(args.metrics)
     print(df.head(10))
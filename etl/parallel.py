@@ -0,0 +1,317 @@
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import numpy as np
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+from cache import load_columns, save_columns
+from helpers import interval_join
+from etl import (
+    WINDOWS,
+    AGGREGATIONS,
+    Aggregation,
+    Window,
+    add_datetime_dimension_to_df,
+    assemble_features,
+    combine_window_features,
+    compute_connectivity_features,
+    compute_window_features,
+)
+from pipeline import get_lookback_lookahead
+from writers import (
+    DEFAULT_OUTPUT,
+    OutputConfig,
+    OutputWriter,
+    require_pyarrow,
+    select_input_dump,
+)
+
+# shards are written here when available so workers map them from memory
+SHARED_MEMORY_DIR = "/dev/shm"
+
+
+def plan_shards(
+    orders: DataFrame,
+    polling: DataFrame,
+    n_shards: int,
+    lookback: pd.Timedelta,
+    lookahead: pd.Timedelta,
+) -> list:
+    """
+    Hash partitions orders and polling by device_id into `n_shards`
+    shards. A device holding more rows than a shard should is split by
+    order time into several shards, each with the polling slice its
+    orders can reach, so a single busy device cannot stall the run
+
+    Parameters
+    ----------
+    orders: DataFrame : Orders with device_id and order_creation_time
+
+    polling: DataFrame : Polling events with device_id and
+        polling_creation_time
+
+    n_shards: int : The number of hash buckets
+
+    lookback: pd.Timedelta : The largest lookback of the windows
+
+    lookahead: pd.Timedelta : The largest lookahead of the windows
+
+    Returns
+    -------
+    A list of (order positions, polling positions) tuples, largest first
+    """
+    order_devices = orders["device_id"].to_numpy()
+    polling_devices = polling["device_id"].to_numpy()
+    cost = (
+        pd.concat(
+            [
+                pd.Series(order_devices).value_counts(),
+                pd.Series(polling_devices).value_counts(),
+            ],
+            axis=1,
+        )
+        .fillna(0)
+        .sum(axis=1)
+    )
+    target = max(cost.sum() / n_shards, 1)
+    hot = cost[cost > target]
+
+    order_hot = pd.Series(order_devices).isin(hot.index).to_numpy()
+    polling_hot = pd.Series(polling_devices).isin(hot.index).to_numpy()
+    order_bucket = pd.util.hash_array(order_devices.astype(object)) % n_shards
+    polling_bucket = pd.util.hash_array(polling_devices.astype(object)) % n_shards
+
+    shards = []
+    order_positions = np.flatnonzero(~order_hot)
+    polling_positions = np.flatnonzero(~polling_hot)
+    order_split = np.argsort(order_bucket[order_positions], kind="stable")
+    polling_split = np.argsort(polling_bucket[polling_positions], kind="stable")
+    order_bounds = np.searchsorted(
+        order_bucket[order_positions][order_split], np.arange(n_shards + 1)
+    )
+    polling_bounds = np.searchsorted(
+        polling_bucket[polling_positions][polling_split], np.arange(n_shards + 1)
+    )
+    for bucket in range(n_shards):
+        shard_orders = order_positions[
+            order_split[order_bounds[bucket] : order_bounds[bucket + 1]]
+        ]
+        shard_polling = polling_positions[
+            polling_split[polling_bounds[bucket] : polling_bounds[bucket + 1]]
+        ]
+        if len(shard_orders):
+            shards.append((shard_orders, shard_polling))
+
+    order_times = orders["order_creation_time"].to_numpy()
+    polling_times = polling["polling_creation_time"].to_numpy()
+    for device, device_cost in hot.items():
+        device_orders = np.flatnonzero(order_devices == device)
+        device_orders = device_orders[np.argsort(order_times[device_orders])]
+        device_polling = np.flatnonzero(polling_devices == device)
+        device_polling = device_polling[np.argsort(polling_times[device_polling])]
+        sorted_polling_times = polling_times[device_polling]
+        n_parts = min(int(np.ceil(device_cost / target)), max(len(device_orders), 1))
+        for part in np.array_split(device_orders, n_parts):
+            if not len(part):
+                continue
+            start = np.searchsorted(
+                sorted_polling_times,
+                order_times[part[0]] - lookback.to_timedelta64(),
+                side="left",
+            )
+            stop = np.searchsorted(
+                sorted_polling_times,
+                order_times[part[-1]] + lookahead.to_timedelta64(),
+                side="right",
+            )
+            shards.append((part, device_polling[start:stop]))
+        logging.info(f"Device {device} split into {n_parts} shards")
+    return sorted(shards, key=lambda shard: -(len(shard[0]) + len(shard[1])))
+
+
+def run_shard(
+    directory: str,
+    windows: List[Window],
+    aggregations: List[Aggregation],
+    output: OutputConfig = DEFAULT_OUTPUT,
+    compact: bool = False,
+):
+    """Worker entry point, loads the memory mapped shard in `directory`
+    and returns its window features and, when the shard has the status
+    changes of its devices, its connectivity features. The input dump of
+    the shard join is saved as column files in `directory`/input_data"""
+    orders = load_columns(os.path.join(directory, "orders"))
+    polling = load_columns(os.path.join(directory, "polling"))
+    lookback, lookahead = get_lookback_lookahead(windows)
+    joined = interval_join(
+        polling, orders, max_lookback=lookback, max_lookahead=lookahead
+    )
+    input_dump = select_input_dump(joined, output)
+    if input_dump is not None:
+        os.makedirs(os.path.join(directory, "input_data"))
+        save_columns(
+            add_datetime_dimension_to_df(input_dump.reset_index(drop=True), compact),
+            os.path.join(directory, "input_data"),
+        )
+    connectivity_features = None
+    if os.path.isdir(os.path.join(directory, "connectivity")):
+        connectivity = load_columns(os.path.join(directory, "connectivity"))
+        connectivity_features = compute_connectivity_features(
+            connectivity, orders, windows
+        )
+    return compute_window_features(joined, windows, aggregations), connectivity_features
+
+
+def run_parallel(
+    polling_df: DataFrame,
+    orders_df: DataFrame,
+    connectivity_df: DataFrame = None,
+    workers: int = None,
+    windows: List[Window] = WINDOWS,
+    aggregations: List[Aggregation] = AGGREGATIONS,
+    output: OutputConfig = DEFAULT_OUTPUT,
+    compact: bool = False,
+) -> DataFrame:
+    """
+    Shards orders and polling by device_id, runs the interval join and the
+    window features of every shard in a process pool and saves the
+    combined output at current directory. Shards are handed over as
+    memory mapped column files instead of pickled dataframes. Every shard
+    also gets the status changes of its devices and computes their
+    connectivity features. The join of every shard is written as a part
+    of input_data, in shard order
+
+    Parameters
+    ----------
+    polling_df: DataFrame : Prepared polling events
+
+    orders_df: DataFrame : Prepared orders
+
+    connectivity_df: DataFrame : Prepared connectivity status changes
+         (Default value = None, no connectivity features)
+
+    workers: int : The number of worker processes
+         (Default value = None, one per cpu)
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The aggregations to run
+         (Default value = AGGREGATIONS)
+
+    output: OutputConfig : The format, partitioning and input dump of the
+        written files
+         (Default value = DEFAULT_OUTPUT, csv)
+
+    compact: bool : The inputs have int64 hour keys, the input dump gets
+        no window bound columns
+         (Default value = False)
+
+    Returns
+    -------
+    A dataframe
+    """
+    require_pyarrow(output)
+    workers = workers or os.cpu_count() or 1
+    lookback, lookahead = get_lookback_lookahead(windows)
+    order_columns = ["device_id", "order_id", "order_creation_time"]
+    polling_columns = ["device_id", "polling_creation_time"] + list(
+        dict.fromkeys(a.column for a in aggregations if a.column)
+    )
+    if output.input_dump != "skip":
+        # the input dump has every polling column, like the in-memory join
+        polling_columns = list(polling_df.columns)
+    polling_df = polling_df.loc[polling_df["device_id"].notna(), polling_columns]
+    polling_df = polling_df.reset_index(drop=True)
+    orders = orders_df[order_columns].reset_index(drop=True)
+    if connectivity_df is not None:
+        connectivity_df = connectivity_df[
+            ["device_id", "connectivity_creation_time", "status"]
+        ].reset_index(drop=True)
+        # the status changes of a device, found once for every shard
+        device_changes = connectivity_df.groupby("device_id").indices
+
+    # a few shards per worker keeps the pool busy while the largest finish
+    shards = plan_shards(orders, polling_df, workers * 4, lookback, lookahead)
+    root = SHARED_MEMORY_DIR if os.path.isdir(SHARED_MEMORY_DIR) else None
+    staging = tempfile.mkdtemp(dir=root, prefix="etl-shards-")
+    with OutputWriter(output) as writer:
+        try:
+            directories = []
+            for position, (order_positions, polling_positions) in enumerate(shards):
+                directory = os.path.join(staging, str(position))
+                parts = [
+                    ("orders", orders, order_positions),
+                    ("polling", polling_df, polling_positions),
+                ]
+                if connectivity_df is not None:
+                    devices = (
+                        orders["device_id"].iloc[order_positions].dropna().unique()
+                    )
+                    changes = [
+                        device_changes[d] for d in devices if d in device_changes
+                    ]
+                    parts.append(
+                        (
+                            "connectivity",
+                            connectivity_df,
+                            np.sort(np.concatenate(changes or [np.empty(0, "int64")])),
+                        )
+                    )
+                for name, frame, positions in parts:
+                    os.makedirs(os.path.join(directory, name))
+                    save_columns(
+                        frame.iloc[positions].reset_index(drop=True),
+                        os.path.join(directory, name),
+                    )
+                directories.append(directory)
+            logging.info(f"Running {len(shards)} shards on {workers} workers")
+
+            results = []
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                shard_results = executor.map(
+                    run_shard,
+                    directories,
+                    [windows] * len(directories),
+                    [aggregations] * len(directories),
+                    [output] * len(directories),
+                    [compact] * len(directories),
+                )
+                for part, result in enumerate(shard_results):
+                    results.append(result)
+                    input_dump = os.path.join(directories[part], "input_data")
+                    if os.path.isdir(input_dump):
+                        writer.write(load_columns(input_dump), "input_data", part=part)
+            # the dumps are mapped from the staging directory
+            writer.wait()
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        batches = [batch for batch, _ in results]
+        if not batches:
+            joined = interval_join(polling_df, orders.iloc[:0])
+            batches = [compute_window_features(joined, windows, aggregations)]
+        features = combine_window_features(batches)
+        main_data = assemble_features(
+            features, orders_df[["order_id"]], windows, aggregations
+        )
+        if connectivity_df is not None:
+            connectivity_features = [c for _, c in results if c is not None]
+            if not connectivity_features:
+                connectivity_features = [
+                    compute_connectivity_features(
+                        connectivity_df, orders.iloc[:0], windows
+                    )
+                ]
+            main_data = main_data.merge(
+                pd.concat(connectivity_features, ignore_index=True),
+                how="left",
+                on="order_id",
+            )
+        writer.write(main_data, "output_data")
+    return main_data
@@ -0,0 +1,609 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, NamedTuple
+
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+from checkpoint import CheckpointStore
+from writers import DEFAULT_OUTPUT, OutputConfig, OutputWriter, select_input_dump
+from helpers import (
+    read_data,
+    fix_missing_records,
+    rename_field,
+    add_hour_date_fields,
+    interval_join,
+    iter_merge,
+    merge_dataframe,
+    COMPACT_MERGE_COLUMNS,
+    MERGE_COLUMNS,
+)
+from etl import (
+    WINDOWS,
+    AGGREGATIONS,
+    Aggregation,
+    Window,
+    FeatureSelection,
+    add_datetime_dimension_to_df,
+    assemble_features,
+    combine_window_features,
+    compute_connectivity_features,
+    compute_window_features,
+    get_all_feature,
+    select_features,
+)
+
+# polling columns the features need, everything else is left unparsed
+POLLING_COLUMNS = ["device_id", "creation_time", "status_code", "error_code"]
+ORDER_COLUMNS = ["order_id", "device_id", "order_creation_time"]
+CONNECTIVITY_COLUMNS = ["device_id", "creation_time", "status"]
+
+
+def get_lookback_lookahead(windows: List[Window] = WINDOWS):
+    """Returns the largest lookback and lookahead of a list of windows"""
+    lookback = max((window.before for window in windows), default=pd.Timedelta(0))
+    lookahead = max((window.after for window in windows), default=pd.Timedelta(0))
+    return lookback, lookahead
+
+
+def prepare_orders(df: DataFrame, compact: bool = False) -> DataFrame:
+    """Fixes missing device_id and adds the hour and date fields to orders,
+    or the int64 hour key when `compact` is set"""
+    df = fix_missing_records(df)
+    return add_hour_date_fields(df, "order_creation_time", compact)
+
+
+def prepare_polling(df: DataFrame, compact: bool = False) -> DataFrame:
+    """Renames the polling creation time and adds the hour and date fields,
+    or the int64 hour key when `compact` is set"""
+    df = rename_field(df, "polling_creation_time")
+    return add_hour_date_fields(df, "polling_creation_time", compact)
+
+
+def prepare_connectivity(df: DataFrame, compact: bool = False) -> DataFrame:
+    """Renames the connectivity creation time and adds the hour and date
+    fields, or the int64 hour key when `compact` is set"""
+    df = rename_field(df, "connectivity_creation_time")
+    return add_hour_date_fields(df, "connectivity_creation_time", compact)
+
+
+def join_polling_orders(
+    polling_df: DataFrame,
+    orders_df: DataFrame,
+    join: str = "interval",
+    compact: bool = False,
+    memory_budget: int = None,
+    windows: List[Window] = WINDOWS,
+) -> DataFrame:
+    """Joins prepared polling and orders with the per-device interval join
+    reaching as far as `windows`, or with the legacy device_id/hour/date
+    merge when `join` is "hour", on device_id/hour_key for frames prepared
+    with `compact`. The merge runs in partitions when its estimate exceeds
+    `memory_budget` bytes
+    """
+    if join == "interval":
+        lookback, lookahead = get_lookback_lookahead(windows)
+        return interval_join(
+            polling_df,
+            orders_df[["device_id", "order_id", "order_creation_time"]],
+            max_lookback=lookback,
+            max_lookahead=lookahead,
+        )
+    merge_columns = COMPACT_MERGE_COLUMNS if compact else MERGE_COLUMNS
+    return merge_dataframe(
+        polling_df, orders_df, merge_columns, memory_budget=memory_budget
+    )
+
+
+class PreparedInputs(NamedTuple):
+    """The prepared input frames of the in-memory run"""
+
+    orders: DataFrame
+    polling: DataFrame
+    connectivity: DataFrame
+    connectivity_features: DataFrame
+
+
+def load_inputs(
+    path: str = "appEventProcessingDataset/dataset/",
+    compact: bool = False,
+    cache_dir: str = None,
+    engine: str = "c",
+    readers: int = 3,
+    connectivity_features: bool = True,
+) -> PreparedInputs:
+    """
+    Reads and prepares orders, polling and connectivity concurrently on a
+    thread pool. Every frame is prepared on its reader thread as soon as
+    it is parsed, and the connectivity features are computed as soon as
+    the orders and connectivity are ready, while polling, the largest
+    file, is still being read, so the wait is the slowest of the paths
+
+    Parameters
+    ----------
+    path: str : The dataset directory
+         (Default value = "appEventProcessingDataset/dataset/")
+
+    compact: bool : Use int64 hour keys and on the fly window bounds
+         (Default value = False)
+
+    cache_dir: str : The columnar cache of the inputs
+         (Default value = None, no cache)
+
+    engine: str : The csv parser, "pyarrow" releases the GIL while it
+        parses, see `helpers.read_data`
+         (Default value = "c")
+
+    readers: int : Threads of the pool, 1 reads the files one by one
+         (Default value = 3)
+
+    connectivity_features: bool : Compute the connectivity features, the
+        field is None otherwise
+         (Default value = True)
+
+    Returns
+    -------
+    The prepared inputs
+    """
+
+    def load(filename, date_column, prepare):
+        df = read_data(path, filename, date_column, cache_dir=cache_dir, engine=engine)
+        return prepare(df, compact)
+
+    with ThreadPoolExecutor(max_workers=readers) as pool:
+        polling = pool.submit(load, "polling.csv", "creation_time", prepare_polling)
+        orders = pool.submit(load, "orders.csv", "order_creation_time", prepare_orders)
+        connectivity = pool.submit(
+            load, "connectivity_status.csv", "creation_time", prepare_connectivity
+        )
+        features = None
+        if connectivity_features:
+            features = pool.submit(
+                lambda: compute_connectivity_features(
+                    connectivity.result(), orders.result()[ORDER_COLUMNS]
+                )
+            )
+        return PreparedInputs(
+            orders.result(),
+            polling.result(),
+            connectivity.result(),
+            features.result() if features is not None else None,
+        )
+
+
+def declare_checkpointed_stages(
+    store: CheckpointStore,
+    path: str = "appEventProcessingDataset/dataset/",
+    join: str = "interval",
+    compact: bool = False,
+) -> dict:
+    """
+    Declares the read, preparation, join and window dimension stages of the
+    in-memory pipeline on a checkpoint store. Nothing runs until a stage
+    value is requested, and a stage whose inputs, parameters and code did
+    not change is loaded instead of recomputed
+
+    Parameters
+    ----------
+    store: CheckpointStore : The checkpoint store
+
+    path: str : The dataset directory
+         (Default value = "appEventProcessingDataset/dataset/")
+
+    join: str : "interval" or "hour", see `join_polling_orders`
+         (Default value = "interval")
+
+    compact: bool : Use int64 hour keys and on the fly window bounds
+         (Default value = False)
+
+    Returns
+    -------
+    A dictionary of stages: orders, polling, connectivity and joined
+    """
+    orders = store.source("read orders", path + "orders.csv", read_data, path=path)
+    polling = store.source(
+        "read polling",
+        path + "polling.csv",
+        read_data,
+        path=path,
+        filename="polling.csv",
+        date_column="creation_time",
+    )
+    connectivity = store.source(
+        "read connectivity",
+        path + "connectivity_status.csv",
+        read_data,
+        path=path,
+        filename="connectivity_status.csv",
+        date_column="creation_time",
+    )
+    orders = store.stage("prepare_orders", prepare_orders, orders, compact=compact)
+    polling = store.stage("prepare_polling", prepare_polling, polling, compact=compact)
+    connectivity = store.stage(
+        "prepare_connectivity", prepare_connectivity, connectivity, compact=compact
+    )
+    joined = store.stage(
+        "join_polling_orders",
+        join_polling_orders,
+        polling,
+        orders,
+        join=join,
+        compact=compact,
+    )
+    joined = store.stage(
+        "add_datetime_dimension_to_df",
+        add_datetime_dimension_to_df,
+        joined,
+        compact=compact,
+    )
+    return {
+        "orders": orders,
+        "polling": polling,
+        "connectivity": connectivity,
+        "joined": joined,
+    }
+
+
+def iter_interval_joins(
+    polling_chunks: Iterator[DataFrame],
+    orders: DataFrame,
+    windows: List[Window] = WINDOWS,
+) -> Iterator[DataFrame]:
+    """Takes time ordered polling chunks and the orders, yields the
+    interval join of every batch of orders whose windows are complete.
+
+    Only the polling tail that a pending order can still reach is carried
+    from one chunk to the next, so memory is bounded by the chunk size
+    plus the lookback and lookahead of the windows
+
+    Parameters
+    ----------
+    polling_chunks: Iterator[DataFrame] : Prepared polling chunks, sorted
+        by polling_creation_time across chunks
+
+    orders: DataFrame : Orders with device_id, order_id and
+        order_creation_time
+
+    windows: List[Window] : The windows the joins must cover
+         (Default value = WINDOWS)
+
+    Returns
+    -------
+    An iterator of dataframes
+    """
+    lookback, lookahead = get_lookback_lookahead(windows)
+    orders = orders.sort_values("order_creation_time", kind="mergesort")
+    order_times = orders["order_creation_time"]
+    tail = None
+    emitted = 0
+    last_time = None
+    for chunk in polling_chunks:
+        if chunk.empty:
+            continue
+        chunk_times = chunk["polling_creation_time"]
+        if not chunk_times.is_monotonic_increasing or (
+            last_time is not None and chunk_times.iloc[0] < last_time
+        ):
+            raise ValueError("polling chunks must be sorted by creation time")
+        buffer = chunk if tail is None else pd.concat([tail, chunk], ignore_index=True)
+        last_time = chunk_times.iloc[-1]
+
+        # later chunks start at or after last_time, so these windows are closed
+        ready = int(order_times.searchsorted(last_time - lookahead, side="left"))
+        if ready > emitted:
+            yield interval_join(
+                buffer,
+                orders.iloc[emitted:ready],
+                max_lookback=lookback,
+                max_lookahead=lookahead,
+            )
+            emitted = ready
+        tail = buffer[
+            buffer["polling_creation_time"] >= last_time - lookahead - lookback
+        ]
+        logging.info(f"Carrying {len(tail)} polling rows to the next chunk")
+    if tail is None:
+        tail = pd.DataFrame(
+            {
+                "device_id": pd.Series([], dtype="object"),
+                "polling_creation_time": pd.Series([], dtype="datetime64[ns]"),
+                "status_code": pd.Series([], dtype="int64"),
+                "error_code": pd.Series([], dtype="object"),
+            }
+        )
+    yield interval_join(
+        tail, orders.iloc[emitted:], max_lookback=lookback, max_lookahead=lookahead
+    )
+
+
+def run_chunked(
+    chunksize: int,
+    windows: List[Window] = WINDOWS,
+    aggregations: List[Aggregation] = AGGREGATIONS,
+    cache_dir: str = None,
+    output: OutputConfig = DEFAULT_OUTPUT,
+    compact: bool = False,
+) -> DataFrame:
+    """Runs the whole pipeline with polling streamed in time ordered chunks,
+    writes every joined batch as a part of input_data and saves output_data
+    with the connectivity features, like the in-memory run
+
+    Parameters
+    ----------
+    chunksize: int : Number of polling rows per chunk
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The aggregations to run
+         (Default value = AGGREGATIONS)
+
+    cache_dir: str : The columnar cache of the orders and connectivity
+         (Default value = None, no cache)
+
+    output: OutputConfig : The format, partitioning and input dump of the
+        written files
+         (Default value = DEFAULT_OUTPUT, csv)
+
+    compact: bool : Use int64 hour keys and on the fly window bounds
+         (Default value = False)
+
+    Returns
+    -------
+    A dataframe
+    """
+    orders_df = prepare_orders(read_data(cache_dir=cache_dir), compact)
+    connectivity_df = prepare_connectivity(
+        read_data(
+            filename="connectivity_status.csv",
+            date_column="creation_time",
+            usecols=CONNECTIVITY_COLUMNS,
+            cache_dir=cache_dir,
+        ),
+        compact,
+    )
+    connectivity_features = compute_connectivity_features(
+        connectivity_df, orders_df[ORDER_COLUMNS], windows
+    )
+    polling_chunks = (
+        prepare_polling(chunk, compact)
+        for chunk in read_data(
+            filename="polling.csv",
+            date_column="creation_time",
+            usecols=POLLING_COLUMNS,
+            chunksize=chunksize,
+        )
+    )
+
+    joins = iter_interval_joins(
+        polling_chunks,
+        orders_df[["device_id", "order_id", "order_creation_time"]],
+        windows,
+    )
+    return write_batched_features(
+        joins,
+        orders_df[["order_id"]],
+        windows,
+        aggregations,
+        output,
+        compact,
+        connectivity_features,
+    )
+
+
+def write_batched_features(
+    joins: Iterator[DataFrame],
+    orders: DataFrame,
+    windows: List[Window] = WINDOWS,
+    aggregations: List[Aggregation] = AGGREGATIONS,
+    output: OutputConfig = DEFAULT_OUTPUT,
+    compact: bool = False,
+    connectivity_features: DataFrame = None,
+) -> DataFrame:
+    """Computes the window features of joined batches of disjoint orders
+    one batch at a time, writes every batch as a part of input_data and
+    saves the combined output_data
+
+    Parameters
+    ----------
+    joins: Iterator[DataFrame] : Joined polling and orders, every order in
+        a single batch
+
+    orders: DataFrame : A dataframe of order_id
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The aggregations to run
+         (Default value = AGGREGATIONS)
+
+    output: OutputConfig : The format, partitioning and input dump of the
+        written files
+         (Default value = DEFAULT_OUTPUT, csv)
+
+    compact: bool : Use int64 hour keys and on the fly window bounds
+         (Default value = False)
+
+    connectivity_features: DataFrame : Per order features joined onto the
+        output
+         (Default value = None)
+
+    Returns
+    -------
+    A dataframe
+    """
+    batches = []
+    with OutputWriter(output) as writer:
+        for part, polling_orders_df in enumerate(joins):
+            polling_orders_df = add_datetime_dimension_to_df(polling_orders_df, compact)
+            batches.append(
+                compute_window_features(polling_orders_df, windows, aggregations)
+            )
+            input_dump = select_input_dump(polling_orders_df, output)
+            if input_dump is not None:
+                writer.write(input_dump, "input_data", part=part)
+
+        features = combine_window_features(batches)
+        main_data = assemble_features(features, orders, windows, aggregations)
+        if connectivity_features is not None:
+            main_data = main_data.merge(
+                connectivity_features, how="left", on="order_id"
+            )
+        writer.write(main_data, "output_data")
+    return main_data
+
+
+def run_partitioned_merge(
+    polling_df: DataFrame,
+    orders_df: DataFrame,
+    memory_budget: int,
+    compact: bool = False,
+    connectivity_features: DataFrame = None,
+    output: OutputConfig = DEFAULT_OUTPUT,
+) -> DataFrame:
+    """Runs the legacy hour merge of prepared polling and orders in
+    partitions of at most `memory_budget` estimated bytes, see
+    `helpers.iter_merge`, and computes the features of every partition
+    before the next one is merged, so the whole join is never in memory
+
+    Parameters
+    ----------
+    polling_df: DataFrame : Prepared polling
+
+    orders_df: DataFrame : Prepared orders
+
+    memory_budget: int : The bytes a merged partition may take
+
+    compact: bool : Merge on the int64 hour key
+         (Default value = False)
+
+    connectivity_features: DataFrame : Per order features joined onto the
+        output
+         (Default value = None)
+
+    output: OutputConfig : The format, partitioning and input dump of the
+        written files
+         (Default value = DEFAULT_OUTPUT, csv)
+
+    Returns
+    -------
+    A dataframe
+    """
+    merge_columns = COMPACT_MERGE_COLUMNS if compact else MERGE_COLUMNS
+    joins = iter_merge(
+        polling_df, orders_df, merge_columns, memory_budget=memory_budget
+    )
+    return write_batched_features(
+        joins,
+        orders_df[["order_id"]],
+        output=output,
+        compact=compact,
+        connectivity_features=connectivity_features,
+    )
+
+
+def get_input_columns(selection: FeatureSelection) -> dict:
+    """Returns the columns of every input file a feature selection reads,
+    the polling and connectivity files are left out when it has none of
+    their features"""
+    columns = {"orders.csv": ORDER_COLUMNS}
+    if selection.aggregations:
+        aggregated = [a.column for a in selection.aggregations if a.column]
+        columns["polling.csv"] = list(
+            dict.fromkeys(["device_id", "creation_time"] + aggregated)
+        )
+    if selection.connectivity_columns:
+        columns["connectivity_status.csv"] = CONNECTIVITY_COLUMNS
+    return columns
+
+
+def run_selected_features(
+    names: List[str],
+    path: str = "appEventProcessingDataset/dataset/",
+    join: str = "interval",
+    compact: bool = False,
+    output_format: str = "long",
+    output: OutputConfig = DEFAULT_OUTPUT,
+    cache_dir: str = None,
+) -> DataFrame:
+    """
+    Runs the in-memory pipeline for a subset of the features. Only the
+    input files and columns the selected features need are read, the
+    interval join only reaches as far as the selected windows and only
+    the selected windows and aggregations are computed
+
+    Parameters
+    ----------
+    names: List[str] : The requested features, see `etl.select_features`
+
+    path: str : The dataset directory
+         (Default value = "appEventProcessingDataset/dataset/")
+
+    join: str : "interval" or "hour", see `join_polling_orders`
+         (Default value = "interval")
+
+    compact: bool : Use int64 hour keys and on the fly window bounds
+         (Default value = False)
+
+    output_format: str : "long" or "wide", see `etl.get_all_feature`
+         (Default value = "long")
+
+    output: OutputConfig : The format, partitioning and input dump of the
+        written files
+         (Default value = DEFAULT_OUTPUT, csv)
+
+    cache_dir: str : The columnar cache of the inputs
+         (Default value = None, no cache)
+
+    Returns
+    -------
+    A dataframe
+    """
+    selection = select_features(names)
+    columns = get_input_columns(selection)
+    logging.info(f"Reading {columns}")
+    orders_df = prepare_orders(
+        read_data(path, usecols=columns["orders.csv"], cache_dir=cache_dir), compact
+    )
+
+    connectivity_features = None
+    if "connectivity_status.csv" in columns:
+        connectivity_df = read_data(
+            path,
+            "connectivity_status.csv",
+            "creation_time",
+            usecols=columns["connectivity_status.csv"],
+            cache_dir=cache_dir,
+        )
+        connectivity_features = compute_connectivity_features(
+            prepare_connectivity(connectivity_df, compact),
+            orders_df[ORDER_COLUMNS],
+            selection.connectivity_windows,
+        )[["order_id"] + selection.connectivity_columns]
+
+    polling_orders_df = None
+    if "polling.csv" in columns:
+        polling_df = read_data(
+            path,
+            "polling.csv",
+            "creation_time",
+            usecols=columns["polling.csv"],
+            cache_dir=cache_dir,
+        )
+        polling_orders_df = join_polling_orders(
+            prepare_polling(polling_df, compact),
+            orders_df,
+            join,
+            compact,
+            windows=selection.windows,
+        )
+        polling_orders_df = add_datetime_dimension_to_df(polling_orders_df, compact)
+
+    return get_all_feature(
+        polling_orders_df,
+        orders=orders_df[["order_id"]],
+        output_format=output_format,
+        connectivity_features=connectivity_features,
+        output=output,
+        selection=selection,
+    )
@@ -0,0 +1,561 @@
+import argparse
+import asyncio
+import heapq
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from typing import AsyncIterator, Callable, List, NamedTuple
+
+import numpy as np
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+from instrumentation import configure_logging
+from helpers import interval_join
+from etl import (
+    WINDOWS,
+    AGGREGATIONS,
+    OTHER_CODE,
+    Aggregation,
+    Window,
+    compute_connectivity_features,
+    compute_features,
+    get_top_k,
+    sketch_aggregations,
+)
+from pipeline import get_lookback_lookahead
+
+# time column of every event kind, in the layout of the raw csv files
+EVENT_KINDS = {
+    "orders": "order_creation_time",
+    "polling": "creation_time",
+    "connectivity_status": "creation_time",
+}
+POLLING_FIELDS = ["status_code", "error_code"]
+CONNECTIVITY_FIELDS = ["status"]
+# event time of a source that has not produced anything yet
+NO_MARK = -(2**63)
+# event time the horizon moves before the buffers are trimmed again
+TRIM_STEP = pd.Timedelta(minutes=1)
+
+
+class StreamConfig(NamedTuple):
+    """Settings of the streaming mode.
+
+    The watermark is the event time before which every source is complete,
+    later events of a source may share its latest time: the smallest latest
+    event time of the sources, minus allowed_lateness.
+    A source running more than max_skew ahead of the watermark is paused so
+    that it cannot fill the buffers, a source silent for idle_timeout
+    seconds stops holding the watermark back, and the orders whose windows
+    closed are emitted every flush_interval seconds, and every `TRIM_STEP`
+    of watermark progress while events are read"""
+
+    allowed_lateness: pd.Timedelta = pd.Timedelta(0)
+    max_skew: pd.Timedelta = pd.Timedelta(minutes=5)
+    idle_timeout: float = 5.0
+    flush_interval: float = 0.5
+    output_format: str = "long"
+
+
+DEFAULT_STREAM = StreamConfig()
+
+
+async def tail_jsonl(
+    path: str, follow: bool = True, poll_interval: float = 0.2
+) -> AsyncIterator[dict]:
+    """Yields the json objects of a json lines file and, when `follow` is
+    set, the lines appended to it afterwards, like `tail -f`"""
+    with open(path) as f:
+        pending = ""
+        lines = 0
+        while True:
+            line = f.readline()
+            if not line:
+                if not follow:
+                    break
+                await asyncio.sleep(poll_interval)
+                continue
+            pending += line
+            # a line without newline is still being written
+            if not pending.endswith("\n"):
+                continue
+            text, pending = pending.strip(), ""
+            if text:
+                yield json.loads(text)
+            lines += 1
+            if lines % 1000 == 0:
+                await asyncio.sleep(0)
+        if pending.strip():
+            yield json.loads(pending)
+
+
+async def replay_csv(
+    path: str, time_column: str, chunksize: int = 10000
+) -> AsyncIterator[dict]:
+    """Yields the rows of a raw csv file as events, in file order"""
+    for chunk in pd.read_csv(path, parse_dates=[time_column], chunksize=chunksize):
+        chunk = chunk.drop("Unnamed: 0", axis=1, errors="ignore")
+        for record in chunk.to_dict("records"):
+            yield record
+        await asyncio.sleep(0)
+
+
+async def tagged(kind: str, records: AsyncIterator[dict]) -> AsyncIterator[tuple]:
+    """Yields (kind, record) for every record of a single kind source"""
+    async for record in records:
+        yield kind, record
+
+
+async def listen_socket(
+    host: str, port: int, max_pending: int = 10000
+) -> AsyncIterator[tuple]:
+    """Accepts connections on a TCP socket and yields (kind, record) for
+    every json line received, the kind being read from its "kind" field.
+    At most `max_pending` events wait to be consumed, senders are paused
+    beyond that"""
+    queue = asyncio.Queue(maxsize=max_pending)
+
+    async def handle(reader, writer):
+        async for line in reader:
+            if line.strip():
+                record = json.loads(line)
+                await queue.put((record.pop("kind"), record))
+        writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.info(f"Listening for events on {host}:{port}")
+    async with server:
+        while True:
+            yield await queue.get()
+
+
+def jsonl_sink(path: str = "-") -> Callable[[DataFrame], None]:
+    """Returns a sink appending emitted rows to a json lines file, or to the
+    standard output for "-" """
+
+    def write(df: DataFrame) -> None:
+        # newer pandas end the last line with a newline, older ones do not
+        text = df.to_json(orient="records", lines=True, date_format="iso").rstrip("\n")
+        if path == "-":
+            sys.stdout.write(text + "\n")
+            sys.stdout.flush()
+            return
+        with open(path, "a") as f:
+            f.write(text + "\n")
+
+    return write
+
+
+class FeatureStream:
+    """
+    Computes the features of `get_all_feature` on live event sources. Every
+    device has a sliding buffer of its polling events and connectivity
+    changes, cut at the watermark minus the largest lookback and
+    lookahead, every time the watermark moves one `TRIM_STEP`, so memory
+    is bounded by the window length, the allowed lateness and that step,
+    whatever the input rate. An order is emitted, with the rows `get_all_feature`
+    produces for it, as soon as the watermark passes the end of its last
+    window
+
+    Parameters
+    ----------
+    sink: Callable[[DataFrame], None] : Receives every batch of emitted rows
+
+    config: StreamConfig : Watermark, pacing and output settings
+         (Default value = DEFAULT_STREAM)
+
+    windows: List[Window] : The windows to compute
+         (Default value = WINDOWS)
+
+    aggregations: List[Aggregation] : The aggregations to run
+         (Default value = AGGREGATIONS)
+    """
+
+    def __init__(
+        self,
+        sink: Callable[[DataFrame], None],
+        config: StreamConfig = DEFAULT_STREAM,
+        windows: List[Window] = WINDOWS,
+        aggregations: List[Aggregation] = AGGREGATIONS,
+    ):
+        self.sink = sink
+        self.config = config
+        self.windows = windows
+        self.aggregations = aggregations
+        self.lookback, self.lookahead = get_lookback_lookahead(windows)
+        # per device deques of (time, fields...) in arrival order
+        self.polling = {}
+        self.connectivity = {}
+        # heap of (window end, sequence, order_id, device_id, order time)
+        self.pending = []
+        self.sequence = 0
+        # orders received before any device_id, back filled by the next one
+        self.held = []
+        self.last_device = None
+        self.marks = {}
+        self.seen = {}
+        self.finished = set()
+        self.horizon = NO_MARK
+        self.ready_since = None
+        self.latencies = []
+        self.late_events = 0
+        self.late_orders = 0
+        self.emitted = 0
+        self.max_buffered = 0
+        self.changed = None
+        # watermark at which every paused source may resume, by source name
+        self.resume_at = {}
+
+    def watermark(self) -> int:
+        """Returns the event time, in nanoseconds, before which every source
+        is complete"""
+        now = time.monotonic()
+        live = [
+            mark
+            for name, mark in self.marks.items()
+            if name not in self.finished
+            and now - self.seen[name] < self.config.idle_timeout
+        ]
+        if not live:
+            if len(self.finished) == len(self.marks):
+                return -NO_MARK
+            live = [max(self.marks.values())]
+        return min(live) - self.config.allowed_lateness.value
+
+    def ingest(self, source: str, kind: str, record: dict) -> None:
+        """Adds one event of a source to the buffers"""
+        event_time = pd.Timestamp(record[EVENT_KINDS[kind]]).value
+        self.marks[source] = max(self.marks[source], event_time)
+        self.seen[source] = time.monotonic()
+        if kind == "orders":
+            self.add_order(record, event_time)
+            return
+        device_id = record.get("device_id")
+        if pd.isna(device_id) or event_time < self.horizon:
+            self.late_events += 1
+            return
+        if kind == "polling":
+            buffer = self.polling.setdefault(device_id, deque())
+            buffer.append((event_time,) + tuple(record.get(f) for f in POLLING_FIELDS))
+        elif kind == "connectivity_status":
+            buffer = self.connectivity.setdefault(device_id, deque())
+            buffer.append(
+                (event_time,) + tuple(record.get(f) for f in CONNECTIVITY_FIELDS)
+            )
+        else:
+            raise ValueError(f"Unknown event kind {kind}")
+
+    def add_order(self, record: dict, order_time: int) -> None:
+        """Queues an order until its windows close. A missing device_id is
+        forward filled from the previous order, or back filled from the next
+        one at the start of the stream, like `fix_missing_records`"""
+        device_id = record.get("device_id")
+        if pd.isna(device_id):
+            if self.last_device is None:
+                self.held.append((record["order_id"], order_time))
+                return
+            device_id = self.last_device
+        else:
+            self.last_device = device_id
+        for order_id, held_time in [(record["order_id"], order_time)] + self.held:
+            if held_time - self.lookback.value < self.horizon:
+                self.late_orders += 1
+            heapq.heappush(
+                self.pending,
+                (
+                    held_time + self.lookahead.value,
+                    self.sequence,
+                    order_id,
+                    device_id,
+                    held_time,
+                ),
+            )
+            self.sequence += 1
+        self.held = []
+
+    def note_ready(self, watermark: int) -> None:
+        """Records when the oldest pending order became ready"""
+        if self.ready_since is None and self.pending and self.pending[0][0] < watermark:
+            self.ready_since = time.monotonic()
+
+    def buffer_frame(
+        self, buffers: dict, devices: set, time_column: str, fields: List[str]
+    ) -> DataFrame:
+        """Returns the buffered events of some devices as a dataframe"""
+        rows = [
+            (device_id,) + event
+            for device_id in devices
+            for event in buffers.get(device_id, ())
+        ]
+        df = pd.DataFrame(rows, columns=["device_id", time_column] + fields)
+        df[time_column] = pd.to_datetime(df[time_column].astype("int64"))
+        return df
+
+    def compute(self, orders: DataFrame) -> DataFrame:
+        """Returns the rows of `get_all_feature` for a batch of orders, from
+        the buffers of their devices"""
+        devices = set(orders["device_id"])
+        polling = self.buffer_frame(
+            self.polling, devices, "polling_creation_time", POLLING_FIELDS
+        )
+        connectivity = self.buffer_frame(
+            self.connectivity,
+            devices,
+            "connectivity_creation_time",
+            CONNECTIVITY_FIELDS,
+        )
+        joined = interval_join(
+            polling,
+            orders,
+            max_lookback=self.lookback,
+            max_lookahead=self.lookahead,
+        )
+        return compute_features(
+            joined,
+            orders[["order_id"]],
+            self.windows,
+            self.aggregations,
+            self.config.output_format,
+            compute_connectivity_features(connectivity, orders, self.windows),
+        )
+
+    def flush(self) -> int:
+        """Emits the orders whose windows closed and trims the buffers,
+        returns the number of orders emitted"""
+        watermark = self.watermark()
+        emitted = self.emit(watermark)
+        if watermark < -NO_MARK:
+            self.trim(watermark - self.lookback.value - self.lookahead.value)
+        return emitted
+
+    def advance(self, watermark: int) -> None:
+        """Emits the orders whose windows closed and trims the buffers each
+        time the watermark moves one `TRIM_STEP`, so a burst of events is
+        cut as it is read instead of on the next flush"""
+        horizon = watermark - self.lookback.value - self.lookahead.value
+        if NO_MARK < watermark < -NO_MARK and (
+            horizon >= self.horizon + TRIM_STEP.value
+        ):
+            self.emit(watermark)
+            self.trim(horizon)
+
+    def emit(self, watermark: int) -> int:
+        """Emits the orders whose windows closed before `watermark`, returns
+        the number of orders emitted"""
+        ready = []
+        while self.pending and self.pending[0][0] < watermark:
+            ready.append(heapq.heappop(self.pending)[2:])
+        if ready:
+            orders = pd.DataFrame(
+                ready, columns=["order_id", "device_id", "order_creation_time"]
+            )
+            orders["order_creation_time"] = pd.to_datetime(
+                orders["order_creation_time"]
+            )
+            self.sink(self.compute(orders))
+            now = time.monotonic()
+            latency = now - (self.ready_since or now)
+            self.latencies.append(latency)
+            self.emitted += len(ready)
+            self.ready_since = None
+            self.note_ready(watermark)
+            logging.info(
+                f"{len(ready)} orders emitted {latency:.3f}s after their "
+                f"windows closed, {self.buffered()} events buffered"
+            )
+        return len(ready)
+
+    def trim(self, horizon: int) -> None:
+        """Drops the polling events older than `horizon`, and the
+        connectivity changes superseded by a change before it"""
+        self.horizon = max(self.horizon, horizon)
+        self.max_buffered = max(self.max_buffered, self.buffered())
+        for device_id in list(self.polling):
+            buffer = self.polling[device_id]
+            while buffer and buffer[0][0] < self.horizon:
+                buffer.popleft()
+            if not buffer:
+                del self.polling[device_id]
+        for buffer in self.connectivity.values():
+            # the last change before the horizon gives the status at it
+            while len(buffer) > 1 and buffer[1][0] < self.horizon:
+                buffer.popleft()
+
+    def buffered(self) -> int:
+        """Returns the number of buffered events"""
+        return sum(len(b) for b in self.polling.values()) + sum(
+            len(b) for b in self.connectivity.values()
+        )
+
+    async def consume(self, name: str, source: AsyncIterator[tuple]) -> None:
+        """Reads a source into the buffers, pausing while it is more than
+        `max_skew` ahead of the watermark"""
+        max_skew = self.config.max_skew.value
+        async for kind, record in source:
+            self.ingest(name, kind, record)
+            watermark = self.watermark()
+            self.advance(watermark)
+            self.note_ready(watermark)
+            if self.resume_at and watermark >= min(self.resume_at.values()):
+                async with self.changed:
+                    self.changed.notify_all()
+            if self.marks[name] > watermark + max_skew:
+                self.resume_at[name] = self.marks[name] - max_skew
+                async with self.changed:
+                    await self.changed.wait_for(
+                        lambda: self.marks[name] <= self.watermark() + max_skew
+                    )
+                del self.resume_at[name]
+        self.finished.add(name)
+        logging.info(f"Source {name} finished")
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def emit_loop(self) -> None:
+        """Emits the ready orders every `flush_interval` seconds"""
+        while True:
+            await asyncio.sleep(self.config.flush_interval)
+            self.flush()
+            async with self.changed:
+                self.changed.notify_all()
+
+    async def run(self, sources: dict) -> dict:
+        """
+        Consumes sources until they are all exhausted, live sources never
+        are, and emits every order
+
+        Parameters
+        ----------
+        sources: dict : Async iterators of (kind, record) by source name,
+            kind being one of `EVENT_KINDS`
+
+        Returns
+        -------
+        A dictionary of run statistics
+        """
+        self.changed = asyncio.Condition()
+        for name in sources:
+            self.marks[name] = NO_MARK
+            self.seen[name] = time.monotonic()
+        emitter = asyncio.create_task(self.emit_loop())
+        try:
+            await asyncio.gather(
+                *(self.consume(name, source) for name, source in sources.items())
+            )
+        finally:
+            emitter.cancel()
+        self.flush()
+        latencies = np.array(self.latencies or [0.0])
+        stats = {
+            "orders": self.emitted,
+            "late_events": self.late_events,
+            "late_orders": self.late_orders,
+            "max_buffered_events": self.max_buffered,
+            "median_latency_seconds": round(float(np.median(latencies)), 3),
+            "max_latency_seconds": round(float(latencies.max()), 3),
+        }
+        logging.info(f"Stream finished: {stats}")
+        return stats
+
+
+def file_sources(directory: str, suffix: str, follow: bool = False) -> dict:
+    """Returns one source per event kind reading `<kind><suffix>` files of a
+    directory, json lines files being tailed when `follow` is set"""
+    sources = {}
+    for kind, time_column in EVENT_KINDS.items():
+        path = os.path.join(directory, kind + suffix)
+        if not os.path.exists(path):
+            logging.info(f"No {path}, {kind} events are not read")
+            continue
+        if suffix == ".csv":
+            records = replay_csv(path, time_column)
+        else:
+            records = tail_jsonl(path, follow)
+        sources[kind] = tagged(kind, records)
+    return sources
+
+
+def parse_args():
+    """Parses the command line options of the streaming mode"""
+    parser = argparse.ArgumentParser(
+        description="Emit the polling features of every order as soon as its "
+        "windows close"
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        "--jsonl-dir",
+        help="read orders.jsonl, polling.jsonl and connectivity_status.jsonl "
+        "from this directory",
+    )
+    source.add_argument(
+        "--replay", help="replay the raw csv files of this directory as events"
+    )
+    source.add_argument(
+        "--listen",
+        help="host:port of a TCP socket receiving json lines with a kind field",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="keep tailing the json lines files for appended events",
+    )
+    parser.add_argument("--output", default="-", help="json lines file of the rows")
+    parser.add_argument("--output-format", choices=["long", "wide"], default="long")
+    parser.add_argument("--allowed-lateness", type=float, default=0.0, help="seconds")
+    parser.add_argument("--max-skew", type=float, default=300.0, help="seconds")
+    parser.add_argument("--idle-timeout", type=float, default=5.0, help="seconds")
+    parser.add_argument("--flush-interval", type=float, default=0.5, help="seconds")
+    parser.add_argument(
+        "--top-codes",
+        type=int,
+        default=None,
+        help="keep the counts of the K most frequent codes of every order and "
+        f"window and lump the others into {OTHER_CODE}",
+    )
+    parser.add_argument(
+        "--top-codes-error",
+        type=float,
+        default=None,
+        help="like --top-codes, with the smallest K whose counts are at most "
+        "this fraction of the window's events low, e.g. 0.1",
+    )
+    args = parser.parse_args()
+    if args.top_codes_error is not None:
+        if args.top_codes is not None:
+            parser.error("give either --top-codes or --top-codes-error")
+        try:
+            args.top_codes = get_top_k(args.top_codes_error)
+        except ValueError as error:
+            parser.error(f"--top-codes-error: {error}")
+    if args.top_codes is not None and args.output_format == "wide":
+        parser.error("--top-codes is only supported by the long output")
+    return args
+
+
+if __name__ == "__main__":
+    configure_logging()
+    args = parse_args()
+    if args.listen:
+        host, port = args.listen.rsplit(":", 1)
+        sources = {"socket": listen_socket(host, int(port))}
+    elif args.replay:
+        sources = file_sources(args.replay, ".csv")
+    else:
+        sources = file_sources(args.jsonl_dir, ".jsonl", args.follow)
+    config = StreamConfig(
+        allowed_lateness=pd.Timedelta(seconds=args.allowed_lateness),
+        max_skew=pd.Timedelta(seconds=args.max_skew),
+        idle_timeout=args.idle_timeout,
+        flush_interval=args.flush_interval,
+        output_format=args.output_format,
+    )
+    stream = FeatureStream(
+        jsonl_sink(args.output),
+        config,
+        aggregations=sketch_aggregations(AGGREGATIONS, args.top_codes),
+    )
+    asyncio.run(stream.run(sources))
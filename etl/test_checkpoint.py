@@ -0,0 +1,85 @@
+import importlib
+import sys
+
+import pandas as pd
+
+from checkpoint import CheckpointStore
+
+HELPER = """
+UNUSED_LIMIT = {limit}
+
+
+def add_one(values):
+    return values + {increment}
+
+
+def unused(values):
+    return values[:UNUSED_LIMIT]
+"""
+
+STAGE = """
+import helper_module
+
+
+def prepare(df):
+    return df.assign(value=helper_module.add_one(df["value"]))
+"""
+
+
+def import_stage(directory, increment, limit=10):
+    """Writes the helper and stage modules and imports them afresh"""
+    (directory / "helper_module.py").write_text(
+        HELPER.format(increment=increment, limit=limit)
+    )
+    (directory / "stage_module.py").write_text(STAGE)
+    for name in ["helper_module", "stage_module"]:
+        sys.modules.pop(name, None)
+    importlib.invalidate_caches()
+    return importlib.import_module("stage_module")
+
+
+def test_editing_a_helper_invalidates_the_stage(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path / "modules"))
+    (tmp_path / "modules").mkdir()
+    store = CheckpointStore(str(tmp_path / "checkpoints"))
+    df = pd.DataFrame({"value": [1, 2, 3]})
+
+    stage_module = import_stage(tmp_path / "modules", 1)
+    first = store.stage("prepare", stage_module.prepare, df)
+    assert first.value()["value"].tolist() == [2, 3, 4]
+    unchanged = store.stage("prepare", stage_module.prepare, df)
+    assert unchanged.key == first.key
+    assert store.load(unchanged.key) is not None
+
+    stage_module = import_stage(tmp_path / "modules", 10)
+    edited = store.stage("prepare", stage_module.prepare, df)
+    assert edited.key != first.key
+    assert store.load(edited.key) is None
+    assert edited.value()["value"].tolist() == [11, 12, 13]
+
+
+def test_editing_code_the_stage_does_not_call_keeps_the_key(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path / "modules"))
+    (tmp_path / "modules").mkdir()
+    store = CheckpointStore(str(tmp_path / "checkpoints"))
+    df = pd.DataFrame({"value": [1, 2, 3]})
+
+    stage_module = import_stage(tmp_path / "modules", 1)
+    first = store.stage("prepare", stage_module.prepare, df)
+    stage_module = import_stage(tmp_path / "modules", 1, limit=20)
+    unrelated = store.stage("prepare", stage_module.prepare, df)
+    assert unrelated.key == first.key
+
+
+def test_frames_differing_in_the_middle_rows_get_different_keys(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoints"))
+    first = pd.DataFrame({"value": range(1000)})
+    second = first.copy()
+    second.loc[500, "value"] = -7
+    assert repr(first) == repr(second)
+
+    summed = store.stage("sum", lambda df: df.sum().to_frame("sum"), first)
+    assert summed.value()["sum"].tolist() == [499500]
+    changed = store.stage("sum", lambda df: df.sum().to_frame("sum"), second)
+    assert changed.key != summed.key
+    assert changed.value()["sum"].tolist() == [499500 - 500 - 7]
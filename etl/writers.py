@@ -0,0 +1,239 @@
+import importlib.util
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from pandas.api.types import infer_dtype
+from pandas.core.frame import DataFrame
+
+from instrumentation import stage
+
+FORMATS = {"csv": "csv", "parquet": "parquet", "feather": "feather"}
+CSV_COMPRESSION_SUFFIXES = {
+    None: "",
+    "gzip": ".gz",
+    "bz2": ".bz2",
+    "zip": ".zip",
+    "xz": ".xz",
+    "zstd": ".zst",
+}
+INPUT_DUMPS = ["full", "sample", "skip"]
+
+
+class OutputConfig(NamedTuple):
+    """How the pipeline outputs are written
+
+    format: csv, parquet or feather
+    compression: the pandas compression of the files, e.g. gzip for csv or
+        snappy/zstd for parquet, None writes them uncompressed
+    partition_by: a column whose values split a frame into one directory
+        per value, e.g. date, frames without it are written whole
+    csv_chunksize: rows serialised at a time by the csv writer
+    input_dump: full writes the joined input frame, sample a fraction of
+        its rows and skip nothing
+    input_sample: the fraction of rows of a sampled input dump
+    background: write from a background thread, so that the next stage
+        runs while the previous frame is serialised
+    """
+
+    format: str = "csv"
+    compression: str = None
+    partition_by: str = None
+    csv_chunksize: int = None
+    input_dump: str = "full"
+    input_sample: float = 0.01
+    background: bool = True
+
+
+DEFAULT_OUTPUT = OutputConfig()
+
+
+def require_pyarrow(output: OutputConfig) -> None:
+    """Raises an ImportError when a format needs pyarrow and it is missing"""
+    if output.format != "csv" and importlib.util.find_spec("pyarrow") is None:
+        raise ImportError(
+            f"the {output.format} writer needs pyarrow, "
+            "run `pip install pyarrow` or write csv"
+        )
+
+
+def file_extension(output: OutputConfig) -> str:
+    """Returns the file extension of a format, with the csv compression"""
+    if output.format == "csv":
+        return "csv" + CSV_COMPRESSION_SUFFIXES[output.compression]
+    return FORMATS[output.format]
+
+
+def output_path(name: str, output: OutputConfig) -> str:
+    """Returns the file, or partitioned directory, of an output name"""
+    return f"{name}.{file_extension(output)}"
+
+
+def clear_output(name: str, output: OutputConfig) -> None:
+    """Removes what a previous run wrote for an output name"""
+    path = output_path(name, output)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def arrow_compatible(df: DataFrame) -> DataFrame:
+    """Returns a frame pyarrow can write: object columns mixing types, like
+    the code columns where missing codes are filled with 0, become text"""
+    mixed = [
+        column
+        for column in df.columns[df.dtypes == object]
+        if infer_dtype(df[column], skipna=True).startswith("mixed")
+    ]
+    if not mixed:
+        return df
+    df = df.copy()
+    for column in mixed:
+        df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+    return df
+
+
+def write_file(df: DataFrame, path: str, output: OutputConfig, append: bool) -> None:
+    """Writes one frame to one file in the configured format"""
+    if output.format == "csv":
+        df.to_csv(
+            path,
+            mode="a" if append else "w",
+            header=not append,
+            index=False,
+            compression=output.compression,
+            chunksize=output.csv_chunksize,
+        )
+    elif output.format == "parquet":
+        arrow_compatible(df).to_parquet(
+            path, index=False, compression=output.compression
+        )
+    else:
+        arrow_compatible(df).reset_index(drop=True).to_feather(
+            path, compression=output.compression
+        )
+
+
+def write_frame(
+    df: DataFrame, name: str, output: OutputConfig = DEFAULT_OUTPUT, part: int = None
+) -> str:
+    """
+    Writes a frame as `name` with the configured format, compression and
+    partitioning, replacing the output of a previous run
+
+    Parameters
+    ----------
+    df: DataFrame : The frame to write
+
+    name: str : The output name, without extension
+
+    output: OutputConfig : How to write it
+         (Default value = DEFAULT_OUTPUT)
+
+    part: int : The position of the frame when an output is written in
+        several parts, part 0 replaces the previous run. Csv parts are
+        appended to one file, other formats get one file per part
+         (Default value = None, a single frame)
+
+    Returns
+    -------
+    The path written
+    """
+    path = output_path(name, output)
+    if part in (None, 0):
+        clear_output(name, output)
+    start = time.perf_counter()
+    extension = file_extension(output)
+    if output.partition_by is not None and output.partition_by in df.columns:
+        for value, group in df.groupby(output.partition_by, sort=True):
+            directory = os.path.join(path, f"{output.partition_by}={value}")
+            os.makedirs(directory, exist_ok=True)
+            write_file(
+                group.drop(columns=output.partition_by),
+                os.path.join(directory, f"part-{part or 0:05d}.{extension}"),
+                output,
+                append=False,
+            )
+    elif part is not None and output.format != "csv":
+        os.makedirs(path, exist_ok=True)
+        write_file(
+            df, os.path.join(path, f"part-{part:05d}.{extension}"), output, False
+        )
+    else:
+        if output.partition_by is not None and part in (None, 0):
+            logging.info(f"{name} has no {output.partition_by} column, not partitioned")
+        write_file(df, path, output, append=bool(part))
+    logging.info(
+        f"{len(df)} rows written to {path} in {time.perf_counter() - start:.2f}s"
+    )
+    return path
+
+
+def select_input_dump(df: DataFrame, output: OutputConfig = DEFAULT_OUTPUT):
+    """Returns the rows of the joined input frame to dump, None to skip it"""
+    if output.input_dump == "skip":
+        return None
+    if output.input_dump == "sample":
+        return df.sample(frac=output.input_sample, random_state=0)
+    return df
+
+
+class OutputWriter:
+    """
+    Writes frames in the order they are submitted, from one background
+    thread when `output.background` is set. At most `max_pending` frames
+    wait to be written, so a fast producer blocks instead of holding every
+    batch in memory. Errors of the writer thread are raised by `wait`
+
+    Parameters
+    ----------
+    output: OutputConfig : How to write the frames
+         (Default value = DEFAULT_OUTPUT)
+
+    max_pending: int : The number of frames waiting to be written before
+        `write` blocks
+         (Default value = 2)
+    """
+
+    def __init__(self, output: OutputConfig = DEFAULT_OUTPUT, max_pending: int = 2):
+        require_pyarrow(output)
+        self.output = output
+        self.max_pending = max_pending
+        self.pending = []
+        self.executor = ThreadPoolExecutor(max_workers=1) if output.background else None
+
+    def write(self, df: DataFrame, name: str, part: int = None) -> None:
+        """Writes, or queues, a frame as `name`"""
+        if self.executor is None:
+            self.write_now(df, name, part)
+            return
+        while len(self.pending) >= self.max_pending:
+            self.pending.pop(0).result()
+        self.pending.append(self.executor.submit(self.write_now, df, name, part))
+
+    def write_now(self, df: DataFrame, name: str, part: int = None) -> None:
+        """Writes a frame as `name`, recorded as a write stage on the thread
+        that writes it"""
+        with stage(f"write {output_path(name, self.output)}", len(df)):
+            write_frame(df, name, self.output, part)
+
+    def wait(self) -> None:
+        """Blocks until every queued frame is written"""
+        with stage("wait for writers"):
+            while self.pending:
+                self.pending.pop(0).result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if exc_info[0] is None:
+                self.wait()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
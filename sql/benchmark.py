@@ -0,0 +1,203 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+
+from conversations import LOG_FORMAT, build_conversations, connect
+
+HISTORY_PATH = "conversations_benchmark.json"
+SIZES = [10**5, 10**6, 10**7]
+METHODS = ["single_scan", "cte"]
+# the CTE build of ddl_stmts.sql is broken, it builds no conversation (see
+# `conversations.build_conversations`), so it is not a baseline and is only
+# timed on request, where the conversation count check rejects it
+DEFAULT_METHODS = ["single_scan"]
+# the CTE build rescans the messages per order, 10^5 messages already take
+# tens of seconds, so it is only timed up to this size
+CTE_MAX_MESSAGES = 2 * 10**5
+
+# random chat messages, spread over orders at random so that no table is
+# already sorted by order_id
+GENERATE_MESSAGES = """
+WITH RECURSIVE seq(n) AS (
+  SELECT 0 UNION ALL SELECT n + 1 FROM seq WHERE n + 1 < :rows
+)
+INSERT INTO customer_courier_chat_messages (
+  sender_app_type, customer_id, from_id, to_id, chat_started_by_message,
+  order_id, order_stage, courier_id, message_sent_time
+)
+SELECT
+  CASE abs(random()) % 4
+    WHEN 0 THEN 'Customer iOS'
+    WHEN 1 THEN 'Customer Android'
+    WHEN 2 THEN 'Courier iOS'
+    ELSE 'Courier Android'
+  END,
+  order_id + 10000000,
+  order_id + 20000000,
+  order_id + 10000000,
+  FALSE,
+  order_id,
+  CASE abs(random()) % 4
+    WHEN 0 THEN 'ACCEPTED'
+    WHEN 1 THEN 'PICKING_UP'
+    WHEN 2 THEN 'ARRIVING'
+    ELSE 'ADDRESS_DELIVERY'
+  END,
+  order_id + 20000000,
+  datetime('2019-08-19', '+' || (order_id * 60 + abs(random()) % 3600) || ' seconds')
+FROM (SELECT abs(random()) % :orders + 1 AS order_id FROM seq)
+"""
+
+
+def generate_messages(connection, rows: int, messages_per_order: int = 10) -> int:
+    """
+    Fills the chat messages and orders tables of the ddl with random rows
+
+    Parameters
+    ----------
+    connection : A connection holding the ddl tables
+
+    rows: int : The number of chat messages
+
+    messages_per_order: int : The average number of messages per order
+         (Default value = 10)
+
+    Returns
+    -------
+    The number of orders
+    """
+    orders = max(rows // messages_per_order, 1)
+    with connection:
+        connection.execute(GENERATE_MESSAGES, {"rows": rows, "orders": orders})
+        connection.execute(
+            "INSERT INTO orders (order_id, city_code) "
+            "SELECT DISTINCT order_id, 'CITY' || (order_id % 50) "
+            "FROM customer_courier_chat_messages"
+        )
+    return orders
+
+
+def run_benchmark(
+    sizes: list = SIZES,
+    methods: list = DEFAULT_METHODS,
+    messages_per_order: int = 10,
+    history_path: str = HISTORY_PATH,
+    cte_max_messages: int = CTE_MAX_MESSAGES,
+) -> list:
+    """
+    Times the conversation builds on random chat messages of growing size,
+    each size in a fresh SQLite file, and appends the runs to a JSON
+    history file. A build whose cost grows linearly keeps a flat time per
+    million messages. Timings are only comparable between builds of the
+    same table, so every method has to build as many conversations as the
+    first one, otherwise a ValueError is raised before the size is recorded
+
+    Parameters
+    ----------
+    sizes: list : The chat message counts to benchmark
+         (Default value = SIZES)
+
+    methods: list : The builds to time, see `build_conversations`
+         (Default value = DEFAULT_METHODS)
+
+    messages_per_order: int : The average number of messages per order
+         (Default value = 10)
+
+    history_path: str : The JSON history file
+         (Default value = HISTORY_PATH)
+
+    cte_max_messages: int : The largest size the CTE build is timed at
+         (Default value = CTE_MAX_MESSAGES)
+
+    Returns
+    -------
+    A list with one record per size and method
+    """
+    history = []
+    if os.path.exists(history_path):
+        with open(history_path) as f:
+            history = json.load(f)
+    records = []
+    for rows in sizes:
+        timed = [m for m in methods if m != "cte" or rows <= cte_max_messages]
+        if len(timed) < len(methods):
+            logging.info(f"cte build skipped at {rows} messages")
+        size_records = []
+        with tempfile.TemporaryDirectory() as scratch:
+            connection = connect(os.path.join(scratch, "chat.db"))
+            generate_messages(connection, rows, messages_per_order)
+            for method in timed:
+                start = time.perf_counter()
+                conversations = build_conversations(connection, method)
+                seconds = time.perf_counter() - start
+                record = {
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "method": method,
+                    "messages": rows,
+                    "conversations": conversations,
+                    "seconds": round(seconds, 3),
+                    "seconds_per_million": round(seconds / rows * 10**6, 3),
+                }
+                logging.info(
+                    f"{method}: {rows} messages in {seconds:.2f}s, "
+                    f"{record['seconds_per_million']}s per million"
+                )
+                size_records.append(record)
+            connection.close()
+        counts = {record["method"]: record["conversations"] for record in size_records}
+        if len(set(counts.values())) > 1:
+            raise ValueError(
+                f"The builds disagree at {rows} messages, conversations per "
+                f"method: {counts}"
+            )
+        records.extend(size_records)
+        history.extend(size_records)
+        with open(history_path, "w") as f:
+            json.dump(history, f, indent=2)
+    return records
+
+
+def parse_args():
+    """Parses the command line options of the benchmark"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the customer_courier_conversations builds"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=SIZES,
+        help="chat message counts to benchmark",
+    )
+    parser.add_argument(
+        "--methods",
+        nargs="+",
+        choices=METHODS,
+        default=DEFAULT_METHODS,
+        help="builds to time, they must build the same conversation count; "
+        "cte, the broken CTE build of ddl_stmts.sql, builds none",
+    )
+    parser.add_argument("--messages-per-order", type=int, default=10)
+    parser.add_argument("--history", default=HISTORY_PATH)
+    parser.add_argument(
+        "--cte-max-messages",
+        type=int,
+        default=CTE_MAX_MESSAGES,
+        help="largest message count the CTE build is timed at",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+    args = parse_args()
+    run_benchmark(
+        args.sizes,
+        args.methods,
+        args.messages_per_order,
+        args.history,
+        args.cte_max_messages,
+    )
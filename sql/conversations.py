@@ -0,0 +1,314 @@
+import argparse
+import logging
+import os
+import sqlite3
+import time
+
+DDL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ddl_stmts.sql")
+LOG_FORMAT = "%(asctime)s %(levelname)s - SQL code - %(message)s"
+
+CONVERSATION_COLUMNS = [
+    "order_id",
+    "city_code",
+    "first_courier_messsage",
+    "first_customer_messsage",
+    "num_messages_courier",
+    "num_messages_customer",
+    "first_message_by",
+    "conversation_started_at",
+    "first_responsetime_delay_seconds",
+    "last_message_time",
+    "last_message_order_stage",
+]
+
+# one scan of the messages: a single window sorted by (order_id, time) gives
+# the first sender and the last order stage, and conditional aggregates give
+# the per sender counts and first messages of every order in the same pass.
+# {where} restricts the messages, it must keep every message of an order.
+# message_sent_time must be stored as YYYY-MM-DD HH:MM:SS (loader.py writes
+# it so): text min/max only follow time order for zero padded hours, and
+# strftime('%s') returns NULL on '2019-08-19 8:01:47'
+SINGLE_SCAN_SELECT = """
+SELECT
+  m.order_id,
+  o.city_code,
+  m.first_courier_messsage,
+  m.first_customer_messsage,
+  m.num_messages_courier,
+  m.num_messages_customer,
+  m.first_message_by,
+  m.conversation_started_at,
+  abs(
+    strftime('%s', m.first_courier_messsage)
+    - strftime('%s', m.first_customer_messsage)
+  ),
+  m.last_message_time,
+  m.last_message_order_stage
+FROM (
+  SELECT
+    order_id,
+    min(CASE WHEN sender = 'Courier' THEN message_sent_time END)
+      AS first_courier_messsage,
+    min(CASE WHEN sender = 'Customer' THEN message_sent_time END)
+      AS first_customer_messsage,
+    sum(sender = 'Courier') AS num_messages_courier,
+    sum(sender = 'Customer') AS num_messages_customer,
+    max(first_sender) AS first_message_by,
+    min(message_sent_time) AS conversation_started_at,
+    max(message_sent_time) AS last_message_time,
+    max(last_order_stage) AS last_message_order_stage
+  FROM (
+    SELECT
+      order_id,
+      message_sent_time,
+      CASE
+        WHEN substr(sender_app_type, 1, 7) = 'Courier' THEN 'Courier'
+        WHEN substr(sender_app_type, 1, 8) = 'Customer' THEN 'Customer'
+      END AS sender,
+      first_value(
+        CASE
+          WHEN substr(sender_app_type, 1, 7) = 'Courier' THEN 'Courier'
+          WHEN substr(sender_app_type, 1, 8) = 'Customer' THEN 'Customer'
+        END
+      ) OVER conversation AS first_sender,
+      last_value(order_stage) OVER conversation AS last_order_stage
+    FROM customer_courier_chat_messages
+    {where}
+    WINDOW conversation AS (
+      PARTITION BY order_id
+      ORDER BY message_sent_time, rowid
+      ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+    )
+  )
+  GROUP BY order_id
+) AS m
+LEFT JOIN orders AS o ON o.order_id = m.order_id
+WHERE true
+"""
+CONVERSATION_INSERT = (
+    "INSERT INTO customer_courier_conversations " f"({', '.join(CONVERSATION_COLUMNS)})"
+)
+SINGLE_SCAN_BUILD = CONVERSATION_INSERT + SINGLE_SCAN_SELECT.format(where="")
+# recomputes the orders of temp.affected_orders from the messages up to the
+# watermark :high, and replaces their rows
+INCREMENTAL_UPSERT = (
+    CONVERSATION_INSERT
+    + SINGLE_SCAN_SELECT.format(
+        where="WHERE order_id IN (SELECT order_id FROM temp.affected_orders) "
+        "AND rowid <= :high"
+    )
+    + "ON CONFLICT (order_id) DO UPDATE SET "
+    + ", ".join(f"{c} = excluded.{c}" for c in CONVERSATION_COLUMNS[1:])
+)
+
+
+def read_statements(path: str = DDL_PATH) -> list:
+    """
+    Reads a sql script, drops the comments and returns its statements
+
+    Parameters
+    ----------
+    path: str : The sql script
+         (Default value = DDL_PATH)
+
+    Returns
+    -------
+    A list of statements, without the trailing semicolon
+    """
+    with open(path) as f:
+        lines = [line.split("--", 1)[0] for line in f]
+    statements = " ".join(" ".join(lines).split()).split(";")
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def get_statements(prefix: str, path: str = DDL_PATH) -> list:
+    """Returns the statements of a sql script starting with `prefix`, case
+    insensitive, e.g. "CREATE TABLE" for the schema"""
+    return [
+        statement
+        for statement in read_statements(path)
+        if statement.upper().startswith(prefix.upper())
+    ]
+
+
+def get_cte_build(path: str = DDL_PATH) -> str:
+    """Returns the CTE build of customer_courier_conversations of the ddl"""
+    return next(
+        statement
+        for statement in get_statements("WITH", path)
+        if "INSERT INTO customer_courier_conversations" in statement
+    )
+
+
+def connect(database: str = ":memory:") -> sqlite3.Connection:
+    """Opens an embedded SQLite database and creates the tables and the
+    indexes of the ddl"""
+    connection = sqlite3.connect(database)
+    for statement in get_statements("CREATE TABLE") + get_statements("CREATE INDEX"):
+        connection.execute(statement)
+    connection.commit()
+    return connection
+
+
+def get_watermark(connection: sqlite3.Connection) -> int:
+    """Returns the rowid of the last chat message in the conversations"""
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS conversation_watermarks "
+        "(name text PRIMARY KEY, value integer)"
+    )
+    row = connection.execute(
+        "SELECT value FROM conversation_watermarks WHERE name = 'messages'"
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def set_watermark(connection: sqlite3.Connection, value: int) -> None:
+    """Records the rowid of the last chat message in the conversations"""
+    get_watermark(connection)
+    connection.execute(
+        "INSERT OR REPLACE INTO conversation_watermarks (name, value) "
+        "VALUES ('messages', ?)",
+        (value,),
+    )
+
+
+def get_last_message(connection: sqlite3.Connection) -> int:
+    """Returns the largest rowid of the chat messages"""
+    return connection.execute(
+        "SELECT coalesce(max(rowid), 0) FROM customer_courier_chat_messages"
+    ).fetchone()[0]
+
+
+def load_sample_messages(connection: sqlite3.Connection) -> int:
+    """Inserts the sample chat messages of the ddl, returns the row count.
+    Their single digit hours, e.g. '2019-08-19 8:01:47', are zero padded
+    like the loader does, so that the builds compare and subtract them"""
+    rows = 0
+    for statement in get_statements("INSERT INTO customer_courier_chat_messages"):
+        rows += connection.execute(statement).rowcount
+    connection.execute(
+        "UPDATE customer_courier_chat_messages "
+        "SET message_sent_time = substr(message_sent_time, 1, 11) || '0' "
+        "|| substr(message_sent_time, 12) "
+        "WHERE message_sent_time "
+        "GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9] [0-9]:*'"
+    )
+    connection.commit()
+    return rows
+
+
+def build_conversations(
+    connection: sqlite3.Connection, method: str = "single_scan"
+) -> int:
+    """
+    Rebuilds customer_courier_conversations from the chat messages in one
+    transaction
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection : A connection holding the ddl tables
+
+    method: str : "single_scan" for the window function build, "cte" for
+        the eight CTE build of ddl_stmts.sql, "incremental" to only
+        update the orders with new messages, see `update_conversations`.
+        The CTE build is broken: it inner joins the courier and the
+        customer counts, so an order needs messages from both senders, and
+        it keeps the first sender and the last order stage of the messages
+        at the table wide min() and max() times, so at most the one or two
+        orders holding them remain and usually none does. It is kept to
+        show the original query, not as a baseline
+         (Default value = "single_scan")
+
+    Returns
+    -------
+    The number of conversations inserted
+    """
+    if method == "incremental":
+        return update_conversations(connection)
+    statement = SINGLE_SCAN_BUILD if method == "single_scan" else get_cte_build()
+    start = time.perf_counter()
+    with connection:
+        connection.execute("DELETE FROM customer_courier_conversations")
+        connection.execute(statement)
+        # rowcount is -1 for statements starting with WITH
+        rows = connection.execute("SELECT changes()").fetchone()[0]
+        set_watermark(connection, get_last_message(connection))
+    logging.info(
+        f"{rows} conversations built with the {method} query in "
+        f"{time.perf_counter() - start:.2f}s"
+    )
+    return rows
+
+
+def update_conversations(connection: sqlite3.Connection) -> int:
+    """
+    Recomputes only the orders that received chat messages since the last
+    build and upserts them into customer_courier_conversations. New
+    messages are the rows past the rowid watermark, a range scan of the
+    table b-tree, and the affected orders are read through the
+    (order_id, message_sent_time) index instead of a full table scan
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection : A connection holding the ddl tables
+
+    Returns
+    -------
+    The number of conversations upserted
+    """
+    start = time.perf_counter()
+    with connection:
+        low = get_watermark(connection)
+        high = get_last_message(connection)
+        connection.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS affected_orders "
+            "(order_id integer PRIMARY KEY)"
+        )
+        connection.execute("DELETE FROM temp.affected_orders")
+        connection.execute(
+            "INSERT INTO temp.affected_orders SELECT DISTINCT order_id "
+            "FROM customer_courier_chat_messages "
+            "WHERE rowid > ? AND rowid <= ? AND order_id IS NOT NULL",
+            (low, high),
+        )
+        connection.execute(INCREMENTAL_UPSERT, {"high": high})
+        rows = connection.execute("SELECT changes()").fetchone()[0]
+        set_watermark(connection, high)
+    logging.info(
+        f"{rows} conversations upserted from messages {low + 1} to {high} in "
+        f"{time.perf_counter() - start:.2f}s"
+    )
+    return rows
+
+
+def parse_args():
+    """Parses the command line options of the conversation build"""
+    parser = argparse.ArgumentParser(
+        description="Build customer_courier_conversations in SQLite"
+    )
+    parser.add_argument("--database", default=":memory:")
+    parser.add_argument(
+        "--method",
+        choices=["single_scan", "cte", "incremental"],
+        default="single_scan",
+        help="single_scan: one window function pass (default), "
+        "cte: the CTE build of ddl_stmts.sql, broken, it builds no conversation, "
+        "incremental: upsert the orders with messages since the last build",
+    )
+    parser.add_argument(
+        "--load-sample",
+        action="store_true",
+        help="insert the sample chat messages of ddl_stmts.sql first",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+    args = parse_args()
+    connection = connect(args.database)
+    if args.load_sample:
+        load_sample_messages(connection)
+    build_conversations(connection, args.method)
+    for row in connection.execute("SELECT * FROM customer_courier_conversations"):
+        print(row)
@@ -34,6 +34,11 @@ CREATE TABLE IF NOT EXISTS customer_courier_conversations(
   PRIMARY KEY (order_id)
 );
 
+-- indexes supporting the per order builds: the messages of an order in time order,
+-- and the sender type prefix used by the conditional counts
+CREATE INDEX IF NOT EXISTS chat_messages_order_time ON customer_courier_chat_messages (order_id, message_sent_time);
+CREATE INDEX IF NOT EXISTS chat_messages_sender_order ON customer_courier_chat_messages ((substring(sender_app_type, 1, 7)), order_id, message_sent_time);
+
 -- insert ddl statement, to insert records into the customer_courier_chat_messages table
 INSERT INTO customer_courier_chat_messages (sender_app_type, customer_id, from_id, to_id, chat_started_by_message, order_id, order_stage, courier_id, message_sent_time)
                                             VALUES
@@ -0,0 +1,410 @@
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+
+from conversations import DDL_PATH, LOG_FORMAT, connect, get_statements
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+# sqlite settings of a bulk load: no fsync per commit and a large page cache,
+# the previous values are restored at the end of the load
+BULK_PRAGMAS = {
+    "synchronous": "OFF",
+    "journal_mode": "MEMORY",
+    "temp_store": "MEMORY",
+    "cache_size": "-262144",
+}
+PLACEHOLDERS = {"qmark": "?", "format": "%s", "pyformat": "%s"}
+
+
+def get_table_columns(table: str, path: str = DDL_PATH) -> list:
+    """
+    Returns the columns of a table of a sql script, from its CREATE TABLE
+    statement
+
+    Parameters
+    ----------
+    table: str : The table name
+
+    path: str : The sql script
+         (Default value = DDL_PATH)
+
+    Returns
+    -------
+    A list of (name, type) tuples
+    """
+    for statement in get_statements("CREATE TABLE", path):
+        match = re.match(
+            r"CREATE TABLE (?:IF NOT EXISTS )?(\w+)\s*\((.*)\)$", statement
+        )
+        if match and match.group(1) == table:
+            definitions = [d.strip() for d in match.group(2).split(",")]
+            return [
+                tuple(d.split()[:2])
+                for d in definitions
+                if d and not d.upper().startswith("PRIMARY KEY")
+            ]
+    raise ValueError(f"{table} is not created in {path}")
+
+
+def to_integer(value):
+    """Validates an integer field"""
+    return int(value)
+
+
+def to_bool(value):
+    """Validates a bool field, stored as 0 or 1"""
+    if isinstance(value, bool):
+        return int(value)
+    text = str(value).strip().lower()
+    if text in ("true", "t", "1", "yes"):
+        return 1
+    if text in ("false", "f", "0", "no"):
+        return 0
+    raise ValueError(f"{value!r} is not a bool")
+
+
+def to_timestamp(value):
+    """Validates a timestamp field and writes it as YYYY-MM-DD HH:MM:SS, so
+    that text comparisons follow time order"""
+    text = str(value).strip().replace("T", " ")
+    if len(text) == 19:
+        # already in the stored layout, fromisoformat only validates it
+        datetime.fromisoformat(text)
+        return text
+    try:
+        parsed = datetime.strptime(text[:19], TIMESTAMP_FORMAT)
+    except ValueError:
+        parsed = datetime.fromisoformat(text)
+    return parsed.strftime(TIMESTAMP_FORMAT)
+
+
+CONVERTERS = {
+    "integer": to_integer,
+    "text": str,
+    "bool": to_bool,
+    "timestamp": to_timestamp,
+}
+
+
+def convert_row(record: dict, columns: list) -> tuple:
+    """Returns the values of a record in column order, converted to the ddl
+    types. Missing and empty fields are NULL, invalid ones raise ValueError"""
+    values = []
+    for name, column_type in columns:
+        value = record.get(name)
+        if value is None or value == "":
+            values.append(None)
+            continue
+        try:
+            values.append(CONVERTERS[column_type.lower()](value))
+        except (TypeError, ValueError) as error:
+            raise ValueError(f"{name}: {error}") from None
+    return tuple(values)
+
+
+def read_records(path: str):
+    """Yields the records of a csv file, or of a .jsonl/.json lines file, as
+    dictionaries"""
+    with open(path, newline="") as f:
+        if path.endswith((".jsonl", ".json")):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+
+def iter_batches(records, batch_size: int):
+    """Yields lists of at most `batch_size` records"""
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def source_key(path: str) -> str:
+    """Returns a key of a file path, size and modification time, a resumed
+    load only skips rows of the same file"""
+    stat = os.stat(path)
+    description = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def execute_all(connection, statements: list) -> None:
+    """Runs statements, in order, on a DB-API connection"""
+    cursor = connection.cursor()
+    for statement in statements:
+        cursor.execute(statement)
+
+
+def create_load_tables(connection) -> None:
+    """Creates the tables keeping the progress of the loads and the indexes
+    dropped by an unfinished load"""
+    execute_all(
+        connection,
+        [
+            "CREATE TABLE IF NOT EXISTS load_progress "
+            "(source text PRIMARY KEY, path text, rows_read integer)",
+            "CREATE TABLE IF NOT EXISTS load_dropped_indexes "
+            "(name text PRIMARY KEY, table_name text, statement text)",
+        ],
+    )
+    connection.commit()
+
+
+def get_rows_read(connection, key: str, placeholder: str) -> int:
+    """Returns the number of rows of a file committed by previous loads"""
+    cursor = connection.cursor()
+    cursor.execute(
+        f"SELECT rows_read FROM load_progress WHERE source = {placeholder}", (key,)
+    )
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def set_rows_read(connection, key: str, path: str, rows: int, placeholder: str):
+    """Records the rows of a file committed so far, in the open transaction"""
+    cursor = connection.cursor()
+    cursor.execute(f"DELETE FROM load_progress WHERE source = {placeholder}", (key,))
+    cursor.execute(
+        "INSERT INTO load_progress (source, path, rows_read) "
+        f"VALUES ({placeholder}, {placeholder}, {placeholder})",
+        (key, path, rows),
+    )
+
+
+def drop_indexes(connection, table: str, placeholder: str) -> list:
+    """
+    Drops the indexes of a table of an SQLite database, after saving their
+    statements in load_dropped_indexes, and returns every statement to
+    rebuild, including the ones a failed load had already dropped
+
+    Parameters
+    ----------
+    connection : The DB-API connection
+
+    table: str : The table being loaded
+
+    placeholder: str : The parameter marker of the connection
+
+    Returns
+    -------
+    A list of CREATE INDEX statements
+    """
+    cursor = connection.cursor()
+    if isinstance(connection, sqlite3.Connection):
+        cursor.execute(
+            "SELECT name, sql FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+            (table,),
+        )
+        for name, statement in cursor.fetchall():
+            cursor.execute(
+                "INSERT OR REPLACE INTO load_dropped_indexes "
+                "(name, table_name, statement) VALUES (?, ?, ?)",
+                (name, table, statement),
+            )
+            cursor.execute(f"DROP INDEX {name}")
+    connection.commit()
+    cursor.execute(
+        "SELECT name, statement FROM load_dropped_indexes "
+        f"WHERE table_name = {placeholder}",
+        (table,),
+    )
+    return cursor.fetchall()
+
+
+def rebuild_indexes(connection, indexes: list, placeholder: str) -> None:
+    """Recreates dropped indexes and forgets them once committed"""
+    cursor = connection.cursor()
+    for name, statement in indexes:
+        start = time.perf_counter()
+        cursor.execute(statement)
+        cursor.execute(
+            f"DELETE FROM load_dropped_indexes WHERE name = {placeholder}", (name,)
+        )
+        logging.info(f"Index {name} rebuilt in {time.perf_counter() - start:.2f}s")
+    connection.commit()
+
+
+def set_pragmas(connection, pragmas: dict) -> dict:
+    """Sets pragmas of an SQLite connection, returns their previous values.
+    Other connections are left as they are"""
+    if not isinstance(connection, sqlite3.Connection):
+        return {}
+    previous = {}
+    for name, value in pragmas.items():
+        previous[name] = connection.execute(f"PRAGMA {name}").fetchone()[0]
+        connection.execute(f"PRAGMA {name} = {value}")
+    return previous
+
+
+def load_file(
+    connection,
+    path: str,
+    table: str = "customer_courier_chat_messages",
+    batch_size: int = 50_000,
+    batches_per_transaction: int = 20,
+    drop_table_indexes: bool = True,
+    paramstyle: str = "qmark",
+    rejects_path: str = None,
+) -> dict:
+    """
+    Bulk loads a csv or json lines export into a table of ddl_stmts.sql.
+    Rows are validated against the ddl types and inserted with batched
+    `executemany`, several batches per transaction. Every commit also
+    records the rows read from the file, so a load that fails resumes
+    after the last committed batch when it is run again
+
+    Parameters
+    ----------
+    connection : A DB-API connection holding the ddl tables
+
+    path: str : The csv or json lines file
+
+    table: str : The table to load
+         (Default value = "customer_courier_chat_messages")
+
+    batch_size: int : Rows per `executemany` call
+         (Default value = 50_000)
+
+    batches_per_transaction: int : Batches committed together
+         (Default value = 20)
+
+    drop_table_indexes: bool : Drop the indexes of the table during the
+        load and rebuild them at the end, SQLite only
+         (Default value = True)
+
+    paramstyle: str : The parameter style of the DB-API driver, qmark,
+        format or pyformat
+         (Default value = "qmark")
+
+    rejects_path: str : A json lines file receiving the invalid rows and
+        their errors
+         (Default value = None, path with a .rejects.jsonl suffix)
+
+    Returns
+    -------
+    A dictionary with the rows inserted, rejected and per second
+    """
+    placeholder = PLACEHOLDERS[paramstyle]
+    columns = get_table_columns(table)
+    insert = (
+        f"INSERT INTO {table} ({', '.join(name for name, _ in columns)}) "
+        f"VALUES ({', '.join([placeholder] * len(columns))})"
+    )
+    rejects_path = rejects_path or path + ".rejects.jsonl"
+    key = source_key(path)
+    create_load_tables(connection)
+    skipped = get_rows_read(connection, key, placeholder)
+    if skipped:
+        logging.info(f"Resuming {path} after {skipped} committed rows")
+    indexes = drop_indexes(connection, table, placeholder) if drop_table_indexes else []
+    previous_pragmas = set_pragmas(connection, BULK_PRAGMAS)
+
+    batches = iter_batches(
+        itertools.islice(read_records(path), skipped, None), batch_size
+    )
+    rows_read, inserted, rejected = skipped, 0, 0
+    committed = skipped
+    start = time.perf_counter()
+    cursor = connection.cursor()
+    try:
+        with open(rejects_path, "a") as rejects:
+            finished = False
+            while not finished:
+                # rejects are written once their transaction is committed
+                transaction_rejects = []
+                for _ in range(batches_per_transaction):
+                    batch = next(batches, None)
+                    if batch is None:
+                        finished = True
+                        break
+                    rows = []
+                    for position, record in enumerate(batch, rows_read + 1):
+                        try:
+                            rows.append(convert_row(record, columns))
+                        except ValueError as error:
+                            transaction_rejects.append(
+                                {"row": position, "error": str(error), **record}
+                            )
+                    cursor.executemany(insert, rows)
+                    inserted += len(rows)
+                    rows_read += len(batch)
+                if rows_read > committed:
+                    set_rows_read(connection, key, path, rows_read, placeholder)
+                    connection.commit()
+                    committed = rows_read
+                    rejected += len(transaction_rejects)
+                    for reject in transaction_rejects:
+                        rejects.write(json.dumps(reject) + "\n")
+                    logging.info(
+                        f"{committed} rows of {path} committed, "
+                        f"{inserted / (time.perf_counter() - start):,.0f} rows/s"
+                    )
+    except Exception:
+        connection.rollback()
+        logging.error(
+            f"Load of {path} failed after {committed} committed rows, "
+            "run it again to resume"
+        )
+        raise
+    finally:
+        set_pragmas(connection, previous_pragmas)
+
+    rebuild_indexes(connection, indexes, placeholder)
+    elapsed = time.perf_counter() - start
+    summary = {
+        "path": path,
+        "rows_inserted": inserted,
+        "rows_rejected": rejected,
+        "rows_resumed_after": skipped,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(inserted / elapsed) if elapsed else None,
+    }
+    logging.info(f"Load finished: {summary}")
+    if rejected:
+        logging.warning(f"{rejected} invalid rows written to {rejects_path}")
+    return summary
+
+
+def parse_args():
+    """Parses the command line options of the loader"""
+    parser = argparse.ArgumentParser(
+        description="Bulk load chat message exports into SQLite"
+    )
+    parser.add_argument("files", nargs="+", help="csv or json lines exports")
+    parser.add_argument("--database", default="chat.db")
+    parser.add_argument("--table", default="customer_courier_chat_messages")
+    parser.add_argument("--batch-size", type=int, default=50_000)
+    parser.add_argument("--batches-per-transaction", type=int, default=20)
+    parser.add_argument(
+        "--keep-indexes",
+        action="store_true",
+        help="insert with the indexes in place instead of rebuilding them",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+    args = parse_args()
+    connection = connect(args.database)
+    for path in args.files:
+        load_file(
+            connection,
+            path,
+            args.table,
+            args.batch_size,
+            args.batches_per_transaction,
+            not args.keep_indexes,
+        )